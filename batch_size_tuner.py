@@ -0,0 +1,329 @@
+import json
+import logging
+import math
+import platform
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import torch
+from transformers import PretrainedConfig, PreTrainedModel, TrainingArguments
+
+from freezing import set_requires_grad
+from optimizers import OptimizerArguments, estimate_optimizer_state_bytes
+from tiny_models import create_random_batch
+
+LOGGER = logging.getLogger(__name__)
+
+# Batch size is probed only if memory predicted from smaller batch is at most this fraction of the limit
+PREDICTION_TOLERANCE = 1.1
+
+
+@dataclass
+class BatchSizeTunerArguments:
+    auto_batch_size: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Probe the largest per device batch size which fits in memory and set gradient accumulation to keep"
+                " the effective batch size"
+            )
+        },
+    )
+    target_batch_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Effective batch size (per device batch size x gradient accumulation x processes), default: from"
+                " --per_device_train_batch_size and --gradient_accumulation_steps"
+            )
+        },
+    )
+    max_memory_mb: Optional[float] = field(
+        default=None,
+        metadata={"help": "Memory limit of training process, default: MEMORY_FRACTION of GPU or available RAM"},
+    )
+    memory_fraction: float = field(default=0.9, metadata={"help": "Fraction of device memory used by training"})
+    probe_steps: int = field(default=2, metadata={"help": "Number of training steps measured for each batch size"})
+    batch_size_cache_file: str = field(
+        default=".cache_training/batch_sizes.json",
+        metadata={"help": "Cache of probed batch sizes per model, sequence length and host"},
+    )
+
+
+def read_available_memory_mb() -> float:
+    for line in Path("/proc/meminfo").read_text().split("\n"):
+        if line.startswith("MemAvailable"):
+            return int(line.split()[1]) / 2**10
+    raise RuntimeError("Missing MemAvailable in /proc/meminfo")
+
+
+def get_memory_limit_mb(tuner_args: BatchSizeTunerArguments, training_args: TrainingArguments) -> float:
+    if tuner_args.max_memory_mb is not None:
+        return tuner_args.max_memory_mb
+    if training_args.device.type == "cuda":
+        return torch.cuda.get_device_properties(training_args.device).total_memory / 2**20 * tuner_args.memory_fraction
+    # Processes on one host share RAM
+    return read_available_memory_mb() * tuner_args.memory_fraction / max(training_args.world_size, 1)
+
+
+def create_probe_batch(
+    config: PretrainedConfig, batch_size: int, seq_length: int, target_length: Optional[int]
+) -> dict[str, torch.Tensor]:
+    batch = create_random_batch(config, batch_size, seq_length)
+    if config.is_encoder_decoder:
+        # Decoder of model with trimmed vocabulary uses indexes of output tokens
+        num_output_tokens = len(getattr(config, "output_token_ids", None) or range(config.vocab_size))
+        batch["labels"] = torch.randint(3, num_output_tokens, (batch_size, target_length))
+    elif config.num_labels == 1:
+        # Regression
+        batch["labels"] = batch["labels"].float()
+    return batch
+
+
+def get_training_state_memory_mb(model: PreTrainedModel, optimizer_state_bytes: int) -> float:
+    # Weights, gradients and optimizer state (created by Trainer after the probe)
+    parameter_bytes = sum(parameter.numel() * parameter.element_size() for parameter in model.parameters())
+    gradient_bytes = sum(
+        parameter.numel() * parameter.element_size() for parameter in model.parameters() if parameter.requires_grad
+    )
+    return (parameter_bytes + gradient_bytes + optimizer_state_bytes) / 2**20
+
+
+def measure_peak_memory_mb(
+    model: PreTrainedModel,
+    batch: dict[str, torch.Tensor],
+    training_args: TrainingArguments,
+    num_steps: int,
+    optimizer_state_bytes: int,
+) -> float:
+    device = training_args.device
+    batch = {key: value.to(device) for key, value in batch.items()}
+    autocast = (
+        torch.autocast(device.type, dtype=torch.bfloat16 if training_args.bf16 else torch.float16)
+        if training_args.fp16 or training_args.bf16
+        else nullcontext()
+    )
+
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        for _ in range(num_steps):
+            with autocast:
+                loss = model(**batch).loss
+            loss.backward()
+        return (torch.cuda.max_memory_allocated(device) + optimizer_state_bytes) / 2**20
+
+    # CPU allocator has no peak statistics - tensors saved for backward are added to training state
+    saved_bytes = 0
+
+    def pack_hook(tensor: torch.Tensor) -> torch.Tensor:
+        nonlocal saved_bytes
+        saved_bytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    max_saved_bytes = 0
+    for _ in range(num_steps):
+        saved_bytes = 0
+        with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda tensor: tensor), autocast:
+            loss = model(**batch).loss
+        loss.backward()
+        max_saved_bytes = max(max_saved_bytes, saved_bytes)
+    return get_training_state_memory_mb(model, optimizer_state_bytes) + max_saved_bytes / 2**20
+
+
+def find_max_batch_size(
+    model: PreTrainedModel,
+    seq_length: int,
+    target_length: Optional[int],
+    training_args: TrainingArguments,
+    tuner_args: BatchSizeTunerArguments,
+    optimizer_args: OptimizerArguments,
+    max_batch_size: int,
+) -> int:
+    memory_limit_mb = get_memory_limit_mb(tuner_args, training_args)
+    trainable_parameters = [parameter for parameter in model.parameters() if parameter.requires_grad]
+    optimizer_state_bytes = estimate_optimizer_state_bytes(trainable_parameters, optimizer_args, training_args)
+    state_memory_mb = get_training_state_memory_mb(model, optimizer_state_bytes)
+    measured_memory_mb: dict[int, float] = {}
+
+    def fits_in_memory(batch_size: int) -> bool:
+        # Activations grow linearly with batch size - batch which would not fit is not run (CPU has no OOM error)
+        fitting_batch_sizes = [size for size, memory_mb in measured_memory_mb.items() if memory_mb <= memory_limit_mb]
+        if fitting_batch_sizes:
+            size = max(fitting_batch_sizes)
+            predicted_memory_mb = state_memory_mb + (measured_memory_mb[size] - state_memory_mb) / size * batch_size
+            if predicted_memory_mb > memory_limit_mb * PREDICTION_TOLERANCE:
+                LOGGER.info(f"Batch size {batch_size}: skipped, predicted {predicted_memory_mb:.0f} MB")
+                return False
+
+        batch = create_probe_batch(model.config, batch_size, seq_length, target_length)
+        try:
+            peak_memory_mb = measure_peak_memory_mb(
+                model, batch, training_args, tuner_args.probe_steps, optimizer_state_bytes
+            )
+        except torch.cuda.OutOfMemoryError:
+            peak_memory_mb = math.inf
+        except RuntimeError as error:
+            # CPU allocator failure
+            if "memory" not in str(error):
+                raise
+            peak_memory_mb = math.inf
+        finally:
+            model.zero_grad(set_to_none=True)
+        measured_memory_mb[batch_size] = peak_memory_mb
+        LOGGER.info(f"Batch size {batch_size}: {peak_memory_mb:.0f} MB (limit: {memory_limit_mb:.0f} MB)")
+        return peak_memory_mb <= memory_limit_mb
+
+    is_training = model.training
+    model.to(training_args.device)
+    model.train()
+    # Probe does not change random state - training is the same as without it
+    devices = [training_args.device] if training_args.device.type == "cuda" else []
+    with torch.random.fork_rng(devices=devices):
+        # Doubling until batch size does not fit (low fits, high does not), then binary search between them
+        low, batch_size = 0, 1
+        while batch_size <= max_batch_size and fits_in_memory(batch_size):
+            low, batch_size = batch_size, batch_size * 2
+        high = min(batch_size, max_batch_size + 1)
+        while high - low > 1:
+            middle = (low + high) // 2
+            if fits_in_memory(middle):
+                low = middle
+            else:
+                high = middle
+    model.train(is_training)
+    if training_args.device.type == "cuda":
+        torch.cuda.empty_cache()
+
+    if low == 0:
+        raise RuntimeError(f"Batch size 1 does not fit in memory limit: {memory_limit_mb:.0f} MB")
+    return low
+
+
+def create_cache_key(
+    model: PreTrainedModel,
+    model_name: str,
+    seq_length: int,
+    target_length: Optional[int],
+    batch_size_limit: int,
+    training_args: TrainingArguments,
+    tuner_args: BatchSizeTunerArguments,
+    optimizer_args: OptimizerArguments,
+) -> str:
+    device_name = (
+        torch.cuda.get_device_name(training_args.device) if training_args.device.type == "cuda" else "cpu"
+    )
+    key = {
+        "model": model_name,
+        "model_class": type(model).__name__,
+        # Differs with LoRA and freezing configuration
+        "trainable_parameters": sum(parameter.numel() for parameter in model.parameters() if parameter.requires_grad),
+        "seq_length": seq_length,
+        "target_length": target_length,
+        "batch_size_limit": batch_size_limit,
+        "host": platform.node(),
+        "device": device_name,
+        "precision": "fp16" if training_args.fp16 else "bf16" if training_args.bf16 else "fp32",
+        "gradient_checkpointing": training_args.gradient_checkpointing,
+        # Size of optimizer state
+        "optimizer": optimizer_args.memory_efficient_optimizer or training_args.optim,
+        "max_memory_mb": tuner_args.max_memory_mb,
+        "memory_fraction": tuner_args.memory_fraction,
+    }
+    return json.dumps(key, sort_keys=True)
+
+
+def get_max_batch_size(
+    model: PreTrainedModel,
+    model_name: str,
+    seq_length: int,
+    target_length: Optional[int],
+    batch_size_limit: int,
+    tuner_args: BatchSizeTunerArguments,
+    training_args: TrainingArguments,
+    optimizer_args: OptimizerArguments,
+) -> int:
+    cache_path = Path(tuner_args.batch_size_cache_file)
+    cache = json.loads(cache_path.read_text()) if cache_path.exists() else {}
+    cache_key = create_cache_key(
+        model, model_name, seq_length, target_length, batch_size_limit, training_args, tuner_args, optimizer_args
+    )
+    if cache_key in cache:
+        max_batch_size = cache[cache_key]
+        LOGGER.info(f"Using cached max batch size: {max_batch_size}")
+    else:
+        if training_args.gradient_checkpointing:
+            # Enabled by Trainer only at the beginning of training
+            model.gradient_checkpointing_enable(
+                gradient_checkpointing_kwargs=training_args.gradient_checkpointing_kwargs
+            )
+        max_batch_size = find_max_batch_size(
+            model, seq_length, target_length, training_args, tuner_args, optimizer_args, batch_size_limit
+        )
+        if training_args.should_save:
+            cache[cache_key] = max_batch_size
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            cache_path.write_text(json.dumps(cache, indent=2))
+    return max_batch_size
+
+
+def apply_batch_size_tuning(
+    model: PreTrainedModel,
+    model_name: str,
+    seq_length: int,
+    tuner_args: BatchSizeTunerArguments,
+    training_args: TrainingArguments,
+    target_length: Optional[int] = None,
+    unfrozen_parameter_names: Optional[set[str]] = None,
+    optimizer_args: Optional[OptimizerArguments] = None,
+) -> None:
+    """Sets per device batch size and gradient accumulation steps of training arguments.
+
+    Parameters in `unfrozen_parameter_names` (unfrozen later by gradual unfreezing) are trainable in the probe, their
+    gradients, optimizer state and saved activations are part of memory of training. Size of optimizer state
+    depends on `optimizer_args` (AdamW if not set).
+    """
+    if not tuner_args.auto_batch_size:
+        return
+
+    num_processes = max(training_args.world_size, 1)
+    target_batch_size = tuner_args.target_batch_size or (
+        training_args.per_device_train_batch_size * training_args.gradient_accumulation_steps * num_processes
+    )
+    # Larger batch than the effective one is never used
+    batch_size_limit = math.ceil(target_batch_size / num_processes)
+    max_batch_size = None
+    # Probed only by the first process - processes with different batch sizes would desynchronize collectives
+    if training_args.process_index == 0:
+        unfrozen_parameters = set_requires_grad(model, unfrozen_parameter_names or set(), requires_grad=True)
+        try:
+            max_batch_size = get_max_batch_size(
+                model,
+                model_name,
+                seq_length,
+                target_length,
+                batch_size_limit,
+                tuner_args,
+                training_args,
+                optimizer_args or OptimizerArguments(),
+            )
+        finally:
+            for parameter in unfrozen_parameters:
+                parameter.requires_grad = False
+    if num_processes > 1:
+        max_batch_sizes = [max_batch_size]
+        torch.distributed.broadcast_object_list(max_batch_sizes, src=0)
+        max_batch_size = max_batch_sizes[0]
+
+    # The smallest accumulation, batch size is reduced to keep effective batch size as close as possible
+    gradient_accumulation_steps = math.ceil(target_batch_size / (max_batch_size * num_processes))
+    batch_size = math.ceil(target_batch_size / (gradient_accumulation_steps * num_processes))
+    training_args.per_device_train_batch_size = batch_size
+    training_args.gradient_accumulation_steps = gradient_accumulation_steps
+    LOGGER.info(
+        f"Using per device batch size {batch_size} with {gradient_accumulation_steps} gradient accumulation steps,"
+        f" effective batch size: {batch_size * gradient_accumulation_steps * num_processes}"
+        f" (target: {target_batch_size}, max batch size: {max_batch_size})"
+    )
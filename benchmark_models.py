@@ -0,0 +1,214 @@
+import json
+import logging
+import platform
+import resource
+import subprocess
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import torch
+from transformers import HfArgumentParser, PreTrainedModel
+
+from compilation import COMPILE_BACKEND_CHOICES
+from custom_model import MODEL_NAME_TO_CLASS
+from tiny_models import create_random_batch, create_tiny_config
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class BenchmarkArguments:
+    models: list[str] = field(
+        default_factory=lambda: list(MODEL_NAME_TO_CLASS.keys()),
+        metadata={"help": "Custom models to benchmark", "choices": list(MODEL_NAME_TO_CLASS.keys())},
+    )
+    batch_sizes: list[int] = field(default_factory=lambda: [1, 8, 32], metadata={"help": "Batch sizes"})
+    seq_lengths: list[int] = field(default_factory=lambda: [128, 512], metadata={"help": "Sequence lengths"})
+    backends: list[str] = field(
+        default_factory=lambda: ["eager"],
+        metadata={
+            "help": "Backends of torch.compile, eager runs model without compilation",
+            "choices": ["eager", *COMPILE_BACKEND_CHOICES],
+        },
+    )
+    hidden_size: int = field(default=256, metadata={"help": "Hidden size of random model"})
+    num_hidden_layers: int = field(default=2, metadata={"help": "Number of layers of random model"})
+    num_attention_heads: int = field(default=4, metadata={"help": "Number of attention heads of random model"})
+    warmup_steps: int = field(default=3, metadata={"help": "Number of not measured iterations"})
+    steps: int = field(default=10, metadata={"help": "Number of measured iterations"})
+    device: str = field(default="cuda" if torch.cuda.is_available() else "cpu", metadata={"help": "Device"})
+    output_file: str = field(default="out/benchmark/models.json", metadata={"help": "Path to JSON with results"})
+    compare_file: Optional[str] = field(
+        default=None, metadata={"help": "Path to JSON with results of previous revision to compare with"}
+    )
+
+
+@dataclass
+class BenchmarkResult:
+    model: str
+    backend: str
+    batch_size: int
+    seq_length: int
+    forward_ms: float
+    forward_backward_ms: float
+    forward_samples_per_second: float
+    train_samples_per_second: float
+    activation_mb: float
+    peak_allocated_mb: float
+    peak_rss_mb: float
+    graph_breaks: int
+
+
+def synchronize(device: str) -> None:
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def measure_ms(fn, device: str, warmup_steps: int, steps: int) -> float:
+    for _ in range(warmup_steps):
+        fn()
+    synchronize(device)
+    start_time = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    synchronize(device)
+    return (time.perf_counter() - start_time) / steps * 1000
+
+
+def measure_activation_mb(model: PreTrainedModel, batch: dict[str, torch.Tensor]) -> float:
+    # Size of tensors saved for backward - dominant part of training memory which depends on the head
+    saved_bytes = 0
+
+    def pack_hook(tensor: torch.Tensor) -> torch.Tensor:
+        nonlocal saved_bytes
+        saved_bytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda tensor: tensor):
+        loss = model(**batch).loss
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+    return saved_bytes / 2**20
+
+
+def count_graph_breaks(model: PreTrainedModel, batch: dict[str, torch.Tensor]) -> int:
+    # Each graph break splits compiled graph and runs Python code between parts
+    torch._dynamo.reset()
+    explanation = torch._dynamo.explain(model)(**batch)
+    torch._dynamo.reset()
+    return explanation.graph_break_count
+
+
+def benchmark_model(
+    model_name: str, backend: str, batch_size: int, seq_length: int, benchmark_args: BenchmarkArguments
+) -> BenchmarkResult:
+    torch.manual_seed(42)
+    config = create_tiny_config(
+        model_name,
+        max_seq_length=seq_length,
+        hidden_size=benchmark_args.hidden_size,
+        num_hidden_layers=benchmark_args.num_hidden_layers,
+        num_attention_heads=benchmark_args.num_attention_heads,
+    )
+    model = MODEL_NAME_TO_CLASS[model_name](config).to(benchmark_args.device)
+    batch = {k: v.to(benchmark_args.device) for k, v in create_random_batch(config, batch_size, seq_length).items()}
+    graph_breaks = count_graph_breaks(model, batch)
+    # Compiled module shares parameters with the original one
+    compiled_model = model if backend == "eager" else torch.compile(model, backend=backend)
+    if benchmark_args.device.startswith("cuda"):
+        torch.cuda.reset_peak_memory_stats()
+
+    def forward() -> None:
+        with torch.no_grad():
+            compiled_model(**batch)
+
+    def forward_backward() -> None:
+        compiled_model(**batch).loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    model.eval()
+    forward_ms = measure_ms(forward, benchmark_args.device, benchmark_args.warmup_steps, benchmark_args.steps)
+    model.train()
+    forward_backward_ms = measure_ms(
+        forward_backward, benchmark_args.device, benchmark_args.warmup_steps, benchmark_args.steps
+    )
+    # Measured without compilation - saved tensors hooks are not traced by torch.compile
+    activation_mb = measure_activation_mb(model, batch)
+
+    return BenchmarkResult(
+        model=model_name,
+        backend=backend,
+        batch_size=batch_size,
+        seq_length=seq_length,
+        forward_ms=round(forward_ms, 3),
+        forward_backward_ms=round(forward_backward_ms, 3),
+        forward_samples_per_second=round(batch_size / forward_ms * 1000, 2),
+        train_samples_per_second=round(batch_size / forward_backward_ms * 1000, 2),
+        activation_mb=round(activation_mb, 2),
+        peak_allocated_mb=(
+            round(torch.cuda.max_memory_allocated() / 2**20, 2) if benchmark_args.device.startswith("cuda") else 0.0
+        ),
+        # Peak of whole process - grows monotonically between benchmarks on CPU
+        peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10, 2),
+        graph_breaks=graph_breaks,
+    )
+
+
+def get_git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results: list[dict], previous_results: list[dict]) -> None:
+    # Results saved before backends were benchmarked are eager
+    previous = {
+        (r["model"], r.get("backend", "eager"), r["batch_size"], r["seq_length"]): r for r in previous_results
+    }
+    for result in results:
+        key = (result["model"], result["backend"], result["batch_size"], result["seq_length"])
+        if key not in previous:
+            continue
+        ratio = result["forward_backward_ms"] / previous[key]["forward_backward_ms"]
+        LOGGER.info(f"{key}: forward+backward {ratio:.2f}x of previous revision")
+        previous_graph_breaks = previous[key].get("graph_breaks")
+        if previous_graph_breaks is not None and result["graph_breaks"] > previous_graph_breaks:
+            LOGGER.warning(f"{key}: graph breaks increased from {previous_graph_breaks} to {result['graph_breaks']}")
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    parser = HfArgumentParser((BenchmarkArguments,))
+    benchmark_args, = parser.parse_args_into_dataclasses()
+
+    results = []
+    for model_name in benchmark_args.models:
+        for backend in benchmark_args.backends:
+            for seq_length in benchmark_args.seq_lengths:
+                for batch_size in benchmark_args.batch_sizes:
+                    result = benchmark_model(model_name, backend, batch_size, seq_length, benchmark_args)
+                    LOGGER.info(result)
+                    results.append(asdict(result))
+
+    output_path = Path(benchmark_args.output_file)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    metadata = {
+        "git_revision": get_git_revision(),
+        "torch_version": torch.__version__,
+        "device": benchmark_args.device,
+        "num_threads": torch.get_num_threads(),
+        "platform": platform.platform(),
+        "arguments": asdict(benchmark_args),
+    }
+    output_path.write_text(json.dumps({"metadata": metadata, "results": results}, indent=2))
+    LOGGER.info(f"Saved benchmark results in: {output_path}")
+
+    if benchmark_args.compare_file is not None:
+        compare_results(results, json.loads(Path(benchmark_args.compare_file).read_text())["results"])
+
+
+if __name__ == "__main__":
+    main()
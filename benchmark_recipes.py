@@ -0,0 +1,251 @@
+import json
+import logging
+import os
+import random
+import shlex
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Optional
+
+from transformers import AutoModelForSequenceClassification, HfArgumentParser, T5ForConditionalGeneration
+
+from phase_timer import PHASE_TIMINGS_ENV
+from prepare_imdb import MAP_LABEL_TRANSLATION
+from tiny_models import TINY_WORDS, create_tiny_config, create_tiny_tokenizer
+
+LOGGER = logging.getLogger(__name__)
+
+TRAINING_SCRIPTS = {"run_glue.py", "run_translation.py"}
+# Phases in order of execution, each phase ends with mark saved by PhaseTimer
+PHASES = ["model_loaded", "tokenized", "trained", "saved", "evaluated", "finished"]
+PHASE_NAMES = {
+    "model_loaded": "startup",
+    "tokenized": "tokenization",
+    "trained": "training",
+    "saved": "save",
+    "evaluated": "eval",
+    "finished": "other",
+}
+
+
+@dataclass
+class BenchmarkRecipesArguments:
+    recipes: list[str] = field(
+        default_factory=list,
+        metadata={"help": "Recipe files to replay, e.g. run/roberta_baseline.sh. All training recipes if not set"},
+    )
+    work_dir: str = field(default="out/benchmark/recipes", metadata={"help": "Directory for models, data and outputs"})
+    num_train_samples: int = field(default=500, metadata={"help": "Number of synthetic training samples"})
+    num_eval_samples: int = field(default=100, metadata={"help": "Number of synthetic validation/test samples"})
+    mean_words: int = field(default=230, metadata={"help": "Mean number of words in synthetic review"})
+    seed: int = field(default=42, metadata={"help": "Seed of synthetic data"})
+    output_file: Optional[str] = field(
+        default=None, metadata={"help": "Path to JSON with results, default: WORK_DIR/results.json"}
+    )
+
+
+@dataclass
+class RecipeResult:
+    recipe: str
+    return_code: int
+    wall_time: float
+    phases: dict[str, float]
+
+
+def create_synthetic_text(rng: random.Random, label: int, mean_words: int) -> str:
+    # Long tailed length distribution similar to IMDB reviews
+    num_words = min(max(int(rng.lognormvariate(0, 0.7) * mean_words * 0.8), 10), 10 * mean_words)
+    # Label dependent vocabulary - classifiers are able to learn something
+    half = len(TINY_WORDS) // 2
+    words = [
+        rng.choice(TINY_WORDS[:half] if (rng.random() < 0.6) == (label == 1) else TINY_WORDS[half:])
+        for _ in range(num_words)
+    ]
+    return " ".join(words)
+
+
+def create_synthetic_data(data_dir: Path, benchmark_args: BenchmarkRecipesArguments) -> None:
+    rng = random.Random(benchmark_args.seed)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    for split, num_samples in [
+        ("train", benchmark_args.num_train_samples),
+        ("valid", benchmark_args.num_eval_samples),
+        ("test", benchmark_args.num_eval_samples),
+    ]:
+        data = []
+        for _ in range(num_samples):
+            label = rng.randint(0, 1)
+            data.append({"label": label, "text": create_synthetic_text(rng, label, benchmark_args.mean_words)})
+
+        # The same files as created by prepare_imdb.py, limited versions are identical
+        text = "".join(f"{json.dumps(data_line)}\n" for data_line in data)
+        text_s2s = "".join(
+            f"{json.dumps({'label': MAP_LABEL_TRANSLATION[d['label']], 'text': d['text']})}\n" for d in data
+        )
+        for suffix in ["", "-5k"]:
+            (data_dir / f"{split}{suffix}.json").write_text(text)
+            (data_dir / f"s2s-{split}{suffix}.json").write_text(text_s2s)
+    LOGGER.info(f"Saved synthetic data in: {data_dir}")
+
+
+def create_tiny_models(models_dir: Path) -> dict[str, Path]:
+    model_paths = {}
+    for model_type in ["roberta", "gpt2", "t5"]:
+        # Directory name has to contain model type - run_glue.py checks it for custom models
+        model_path = models_dir / f"tiny-{model_type}"
+        config = create_tiny_config(model_type, max_seq_length=512)
+        if model_type == "t5":
+            model = T5ForConditionalGeneration(config)
+        else:
+            model = AutoModelForSequenceClassification.from_config(config)
+        model.save_pretrained(model_path)
+        create_tiny_tokenizer(model_type).save_pretrained(model_path)
+        model_paths[model_type] = model_path
+    LOGGER.info(f"Saved tiny models in: {models_dir}")
+    return model_paths
+
+
+def parse_recipe(recipe_path: Path) -> Optional[tuple[str, list[str]]]:
+    text = recipe_path.read_text().replace("\\\n", " ")
+    for line in text.split("\n"):
+        tokens = shlex.split(line, comments=True)
+        if len(tokens) < 2 or tokens[0] != "python" or tokens[1] not in TRAINING_SCRIPTS:
+            continue
+        # Recipes with shell variables (evaluation, loops) can not be replayed as is
+        if any("$" in token for token in tokens):
+            return None
+        return tokens[1], tokens[2:]
+    return None
+
+
+def parse_arguments(tokens: list[str]) -> dict[str, Optional[str]]:
+    arguments = {}
+    i = 0
+    while i < len(tokens):
+        key = tokens[i]
+        if "=" in key:
+            key, value = key.split("=", 1)
+        elif i + 1 < len(tokens) and not tokens[i + 1].startswith("--"):
+            value = tokens[i + 1]
+            i += 1
+        else:
+            value = None
+        arguments[key] = value
+        i += 1
+    return arguments
+
+
+def rewrite_arguments(
+    arguments: dict[str, Optional[str]], model_paths: dict[str, Path], data_dir: Path, output_dir: Path
+) -> list[str]:
+    arguments = dict(arguments)
+    model_name = arguments["--model_name_or_path"]
+    model_type = next(model_type for model_type in model_paths if model_type in model_name)
+    arguments["--model_name_or_path"] = str(model_paths[model_type])
+    for key in ["--train_file", "--validation_file", "--test_file"]:
+        if key in arguments:
+            arguments[key] = str(data_dir / Path(arguments[key]).name)
+    arguments["--output_dir"] = str(output_dir)
+    arguments["--overwrite_output_dir"] = None
+
+    tokens = []
+    for key, value in arguments.items():
+        tokens.append(key)
+        if value is not None:
+            tokens.append(value)
+    return tokens
+
+
+def compute_phases(launch_time: float, end_time: float, marks: dict[str, float]) -> dict[str, float]:
+    phases = {}
+    previous_time = launch_time
+    for phase_end in PHASES:
+        # Phase was skipped (e.g. no training) - zero duration
+        mark_time = marks.get(phase_end, previous_time)
+        phases[PHASE_NAMES[phase_end]] = round(mark_time - previous_time, 3)
+        previous_time = mark_time
+    phases["other"] = round(phases["other"] + end_time - previous_time, 3)
+    return phases
+
+
+def run_recipe(
+    recipe_path: Path, model_paths: dict[str, Path], data_dir: Path, work_dir: Path
+) -> Optional[RecipeResult]:
+    parsed_recipe = parse_recipe(recipe_path)
+    if parsed_recipe is None:
+        LOGGER.info(f"Skipping recipe: {recipe_path}")
+        return None
+
+    script, tokens = parsed_recipe
+    output_dir = work_dir / "outputs" / recipe_path.stem
+    arguments = rewrite_arguments(parse_arguments(tokens), model_paths, data_dir, output_dir)
+    timings_path = work_dir / "timings" / f"{recipe_path.stem}.json"
+    timings_path.parent.mkdir(parents=True, exist_ok=True)
+    timings_path.unlink(missing_ok=True)
+
+    env = dict(os.environ)
+    env.update(
+        {
+            PHASE_TIMINGS_ENV: str(timings_path),
+            "HF_HUB_OFFLINE": "1",
+            "HF_DATASETS_OFFLINE": "1",
+            "HF_EVALUATE_OFFLINE": "1",
+            "TRANSFORMERS_OFFLINE": "1",
+            "HF_HUB_DISABLE_TELEMETRY": "1",
+        }
+    )
+    LOGGER.info(f"Running recipe: {recipe_path}")
+    launch_time = time.time()
+    process = subprocess.run([sys.executable, script, *arguments], env=env, capture_output=True, text=True)
+    end_time = time.time()
+    if process.returncode != 0:
+        LOGGER.error(f"Recipe {recipe_path} failed:\n{process.stderr[-5000:]}")
+
+    marks = json.loads(timings_path.read_text()) if timings_path.exists() else {}
+    return RecipeResult(
+        recipe=str(recipe_path),
+        return_code=process.returncode,
+        wall_time=round(end_time - launch_time, 3),
+        phases=compute_phases(launch_time, end_time, marks),
+    )
+
+
+def log_results(results: list[RecipeResult]) -> None:
+    phase_names = list(dict.fromkeys(PHASE_NAMES.values()))
+    LOGGER.info("\t".join(["recipe", "status", "wall_time"] + phase_names))
+    for result in results:
+        status = "OK" if result.return_code == 0 else "FAILED"
+        values = [f"{result.phases[name]:.2f}" for name in phase_names]
+        LOGGER.info("\t".join([Path(result.recipe).stem, status, f"{result.wall_time:.2f}"] + values))
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    parser = HfArgumentParser((BenchmarkRecipesArguments,))
+    benchmark_args, = parser.parse_args_into_dataclasses()
+
+    work_dir = Path(benchmark_args.work_dir)
+    data_dir = work_dir / "data"
+    create_synthetic_data(data_dir, benchmark_args)
+    model_paths = create_tiny_models(work_dir / "models")
+
+    recipes = benchmark_args.recipes or sorted(str(path) for path in Path("run").glob("*.sh"))
+    results = []
+    for recipe in recipes:
+        result = run_recipe(Path(recipe), model_paths, data_dir, work_dir)
+        if result is not None:
+            results.append(result)
+    log_results(results)
+
+    output_path = Path(benchmark_args.output_file or work_dir / "results.json")
+    output_path.write_text(json.dumps([asdict(result) for result in results], indent=2))
+    LOGGER.info(f"Saved results in: {output_path}")
+    if any(result.return_code != 0 for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+from transformers import AutoTokenizer, HfArgumentParser
+
+from truncation import TRUNCATION_STRATEGIES, TextTruncator
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class BenchmarkTokenizationArguments:
+    tokenizer_name: str = field(metadata={"help": "Tokenizer name or path, e.g. roberta-base"})
+    data_file: str = field(default="data/train.json", metadata={"help": "JSON lines file with texts"})
+    text_column: str = field(default="text", metadata={"help": "Name of text field"})
+    max_length: int = field(default=128, metadata={"help": "Maximum number of tokens"})
+    strategies: list[str] = field(
+        default_factory=lambda: TRUNCATION_STRATEGIES[1:],
+        metadata={"help": "Truncation strategies to compare", "choices": TRUNCATION_STRATEGIES[1:]},
+    )
+    chars_per_token: float = field(default=8.0, metadata={"help": "Number of characters per token used to cut texts"})
+    batch_size: int = field(default=1000, metadata={"help": "Number of texts tokenized at once"})
+    cache_dir: Optional[str] = field(default=None, metadata={"help": "Where to store downloaded tokenizer"})
+    output_file: Optional[str] = field(default=None, metadata={"help": "Path to JSON with results"})
+
+
+def read_texts(file_path: Path, text_column: str) -> list[str]:
+    with open(file_path, "rt") as f_read:
+        return [json.loads(line)[text_column] for line in f_read if line.strip()]
+
+
+def tokenize_in_batches(tokenize_fn, texts: list[str], batch_size: int) -> tuple[list[list[int]], float]:
+    all_ids = []
+    start_time = time.perf_counter()
+    for i in range(0, len(texts), batch_size):
+        all_ids.extend(tokenize_fn(texts[i:i + batch_size])["input_ids"])
+    return all_ids, time.perf_counter() - start_time
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    parser = HfArgumentParser((BenchmarkTokenizationArguments,))
+    benchmark_args, = parser.parse_args_into_dataclasses()
+
+    texts = read_texts(Path(benchmark_args.data_file), benchmark_args.text_column)
+    LOGGER.info(f"Loaded {len(texts)} texts from: {benchmark_args.data_file}")
+
+    results = []
+    for strategy in benchmark_args.strategies:
+        tokenizer = AutoTokenizer.from_pretrained(benchmark_args.tokenizer_name, cache_dir=benchmark_args.cache_dir)
+        text_truncator = TextTruncator(
+            tokenizer, benchmark_args.max_length, strategy, chars_per_token=benchmark_args.chars_per_token
+        )
+        truncated_ids, truncated_time = tokenize_in_batches(text_truncator, texts, benchmark_args.batch_size)
+
+        # Reference: full text tokenization truncated on the same side, head_tail has no tokenizer equivalent
+        tokenizer.truncation_side = "left" if strategy == "tail" else "right"
+        full_ids, full_time = tokenize_in_batches(
+            lambda batch: tokenizer(batch, max_length=benchmark_args.max_length, truncation=True),
+            texts,
+            benchmark_args.batch_size,
+        )
+        result = {
+            "strategy": strategy,
+            "full_seconds": round(full_time, 3),
+            "truncated_seconds": round(truncated_time, 3),
+            "speedup": round(full_time / truncated_time, 2),
+            "fallbacks": text_truncator.num_fallbacks,
+        }
+        if strategy != "head_tail":
+            result["identical_fraction"] = round(sum(a == b for a, b in zip(full_ids, truncated_ids)) / len(texts), 4)
+        LOGGER.info(result)
+        results.append(result)
+
+    if benchmark_args.output_file is not None:
+        Path(benchmark_args.output_file).write_text(json.dumps(results, indent=2))
+        LOGGER.info(f"Saved results in: {benchmark_args.output_file}")
+
+
+if __name__ == "__main__":
+    main()
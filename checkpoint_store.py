@@ -0,0 +1,162 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Optional
+
+import torch
+from safetensors.torch import load_file, save
+from transformers import Trainer
+from transformers.trainer import TRAINING_ARGS_NAME
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+
+LOGGER = logging.getLogger(__name__)
+
+MANIFEST_NAME = "tensor_manifest.json"
+STORE_DIR_NAME = "tensor_store"
+
+
+class TensorStore:
+    """Directory of tensors addressed by hash of their content, each unique tensor is written once.
+
+    Checkpoint contains manifest mapping names of tensors to hashes instead of weights, tensors which do not change
+    between checkpoints (e.g. frozen layers) are shared by all of them.
+    """
+
+    def __init__(self, store_dir: Path) -> None:
+        self.store_dir = store_dir
+        # Name -> (data pointer, version counter, hash), in-place updates (optimizer step) increase version counter
+        self.hash_cache: dict[str, tuple[int, int, str]] = {}
+
+    def get_path(self, tensor_hash: str) -> Path:
+        return self.store_dir / f"{tensor_hash}.safetensors"
+
+    def save_state_dict(self, state_dict: dict[str, torch.Tensor], checkpoint_dir: Path) -> None:
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        manifest, num_written, written_bytes = {}, 0, 0
+        for name, tensor in state_dict.items():
+            cached = self.hash_cache.get(name)
+            if cached is not None and cached[:2] == (tensor.data_ptr(), tensor._version):
+                tensor_hash = cached[2]
+                if self.get_path(tensor_hash).exists():
+                    manifest[name] = tensor_hash
+                    continue
+
+            # Serialized tensor contains also dtype and shape - equal bytes are equal tensors
+            data = save({"tensor": tensor.detach().cpu().contiguous()})
+            tensor_hash = hashlib.blake2b(data, digest_size=20).hexdigest()
+            self.hash_cache[name] = (tensor.data_ptr(), tensor._version, tensor_hash)
+            manifest[name] = tensor_hash
+            tensor_path = self.get_path(tensor_hash)
+            if not tensor_path.exists():
+                # Written under temporary name - interrupted save does not leave incomplete tensor
+                tmp_path = tensor_path.with_suffix(".tmp")
+                tmp_path.write_bytes(data)
+                os.replace(tmp_path, tensor_path)
+                num_written += 1
+                written_bytes += len(data)
+
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        manifest_data = {"store_dir": os.path.relpath(self.store_dir, checkpoint_dir), "tensors": manifest}
+        (checkpoint_dir / MANIFEST_NAME).write_text(json.dumps(manifest_data, indent=2))
+        LOGGER.info(
+            f"Saved {len(manifest)} tensors in {checkpoint_dir}, written {num_written} new tensors"
+            f" ({written_bytes / 2**20:.2f} MB)"
+        )
+
+    def collect_garbage(self, checkpoint_dirs: list[Path]) -> None:
+        referenced_hashes = set()
+        for checkpoint_dir in checkpoint_dirs:
+            if (checkpoint_dir / MANIFEST_NAME).exists():
+                referenced_hashes.update(json.loads((checkpoint_dir / MANIFEST_NAME).read_text())["tensors"].values())
+        removed_paths = [path for path in self.store_dir.glob("*.safetensors") if path.stem not in referenced_hashes]
+        for path in removed_paths:
+            path.unlink()
+        if removed_paths:
+            LOGGER.info(f"Removed {len(removed_paths)} tensors not used by checkpoints from: {self.store_dir}")
+
+
+def has_manifest(checkpoint_dir: str | Path) -> bool:
+    return (Path(checkpoint_dir) / MANIFEST_NAME).exists()
+
+
+def load_manifest_state_dict(checkpoint_dir: str | Path) -> dict[str, torch.Tensor]:
+    manifest_data = json.loads((Path(checkpoint_dir) / MANIFEST_NAME).read_text())
+    store = TensorStore(Path(checkpoint_dir) / manifest_data["store_dir"])
+    # Tensors are memory mapped, shared tensors are read once
+    tensors = {}
+    for tensor_hash in set(manifest_data["tensors"].values()):
+        tensors[tensor_hash] = load_file(store.get_path(tensor_hash), device="cpu")["tensor"]
+    return {name: tensors[tensor_hash] for name, tensor_hash in manifest_data["tensors"].items()}
+
+
+@torch.no_grad()
+def load_manifest_into_model(model: torch.nn.Module, checkpoint_dir: str | Path) -> None:
+    incompatible_keys = model.load_state_dict(load_manifest_state_dict(checkpoint_dir), strict=False)
+    if incompatible_keys.missing_keys or incompatible_keys.unexpected_keys:
+        raise ValueError(
+            f"Tensors of {checkpoint_dir} do not match model, missing: {incompatible_keys.missing_keys},"
+            f" unexpected: {incompatible_keys.unexpected_keys}"
+        )
+
+
+class CheckpointStoreTrainerMixin:
+    """Trainer saving weights of checkpoints in `TensorStore` of output directory.
+
+    Final model (`save_model`) is saved as usual. Tensors not used by checkpoints kept after rotation are removed.
+    """
+
+    checkpoint_store: Optional[TensorStore] = None
+    is_saving_checkpoint: bool = False
+
+    def _save_checkpoint(self, model, trial, *args: Any, **kwargs: Any) -> None:
+        self.is_saving_checkpoint = True
+        try:
+            super()._save_checkpoint(model, trial, *args, **kwargs)
+        finally:
+            self.is_saving_checkpoint = False
+
+    def _save(self, output_dir: Optional[str] = None, state_dict: Optional[dict[str, torch.Tensor]] = None) -> None:
+        # Adapters of PEFT models are small - frozen backbone is not saved in checkpoints
+        if not self.is_saving_checkpoint or getattr(self.model, "peft_config", None) is not None:
+            return super()._save(output_dir, state_dict)
+
+        output_dir = Path(output_dir if output_dir is not None else self.args.output_dir)
+        if self.checkpoint_store is None:
+            self.checkpoint_store = TensorStore(Path(self.args.output_dir) / STORE_DIR_NAME)
+        model = self.accelerator.unwrap_model(self.model)
+        # Tensors of state dict share version counters with parameters - unchanged parameters are not hashed again
+        self.checkpoint_store.save_state_dict(state_dict if state_dict is not None else model.state_dict(), output_dir)
+        # Set by save_pretrained - class of model is created from config of checkpoint (e.g. custom heads)
+        model.config.architectures = [model.__class__.__name__]
+        model.config.save_pretrained(output_dir)
+        if model.can_generate() and model.generation_config is not None:
+            model.generation_config.save_pretrained(output_dir)
+        if self.processing_class is not None:
+            self.processing_class.save_pretrained(output_dir)
+        torch.save(self.args, output_dir / TRAINING_ARGS_NAME)
+
+    def _load_from_checkpoint(self, resume_from_checkpoint: str, model=None) -> None:
+        if not has_manifest(resume_from_checkpoint):
+            return super()._load_from_checkpoint(resume_from_checkpoint, model)
+        LOGGER.info(f"Loading model from tensor store of checkpoint: {resume_from_checkpoint}")
+        load_manifest_into_model(model if model is not None else self.model, resume_from_checkpoint)
+
+    def _load_best_model(self) -> None:
+        best_model_checkpoint = self.state.best_model_checkpoint
+        if best_model_checkpoint is None or not has_manifest(best_model_checkpoint):
+            return super()._load_best_model()
+        LOGGER.info(f"Loading best model from tensor store of checkpoint: {best_model_checkpoint}")
+        load_manifest_into_model(self.model, best_model_checkpoint)
+
+    def _rotate_checkpoints(self, use_mtime: bool = False, output_dir: Optional[str] = None) -> None:
+        super()._rotate_checkpoints(use_mtime=use_mtime, output_dir=output_dir)
+        if self.checkpoint_store is not None:
+            checkpoint_dirs = list(Path(self.args.output_dir).glob(f"{PREFIX_CHECKPOINT_DIR}-*"))
+            self.checkpoint_store.collect_garbage(checkpoint_dirs)
+
+
+def create_checkpoint_store_trainer_cls(trainer_cls: type[Trainer]) -> type[Trainer]:
+    # Keep name of original class in logs
+    return type(trainer_cls.__name__, (CheckpointStoreTrainerMixin, trainer_cls), {})
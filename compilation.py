@@ -0,0 +1,22 @@
+import logging
+import os
+
+from transformers import TrainingArguments
+
+LOGGER = logging.getLogger(__name__)
+
+COMPILE_BACKEND_CHOICES = ["inductor", "aot_eager", "cudagraphs"]
+
+
+def apply_compile(compile_backend: str | None, training_args: TrainingArguments) -> None:
+    # Keep --torch_compile flags from TrainingArguments when backend is not selected
+    if compile_backend is None:
+        return
+
+    training_args.torch_compile = True
+    training_args.torch_compile_backend = compile_backend
+    # Accelerate reads dynamo settings from environment, which TrainingArguments sets only on initialization
+    os.environ["ACCELERATE_DYNAMO_BACKEND"] = compile_backend
+    if training_args.torch_compile_mode is not None:
+        os.environ["ACCELERATE_DYNAMO_MODE"] = training_args.torch_compile_mode
+    LOGGER.info(f"Using torch.compile with backend: {compile_backend}")
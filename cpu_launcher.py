@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+from functools import partial
+from pathlib import Path
+
+from transformers import HfArgumentParser
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class CpuLauncherArguments:
+    num_processes: int = field(default=2, metadata={"help": "Number of data parallel training processes"})
+    script: str = field(
+        default="run_glue.py", metadata={"help": "Training script, remaining arguments are passed to it"}
+    )
+    master_port: int = field(default=29500, metadata={"help": "Port of gloo rendezvous"})
+    use_logical_cores: bool = field(
+        default=False, metadata={"help": "Use all hyper-threads, by default one thread per physical core is used"}
+    )
+    scaling_benchmark: bool = field(
+        default=False,
+        metadata={"help": "Train with 1, 2, 4, ..., NUM_PROCESSES processes and report throughput of each"},
+    )
+    benchmark_max_steps: int = field(default=50, metadata={"help": "Number of training steps in scaling benchmark"})
+    benchmark_output_dir: str = field(
+        default="out/cpu_scaling", metadata={"help": "Output directory of scaling benchmark runs and report"}
+    )
+
+
+def parse_cpu_list(cpu_list: str) -> list[int]:
+    cpus = []
+    for part in cpu_list.strip().split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def is_first_thread_of_core(cpu: int) -> bool:
+    siblings_path = Path(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list")
+    return not siblings_path.exists() or min(parse_cpu_list(siblings_path.read_text())) == cpu
+
+
+def read_numa_nodes(use_logical_cores: bool) -> list[list[int]]:
+    available_cpus = os.sched_getaffinity(0)
+    if not use_logical_cores:
+        # One hyper-thread per physical core - threads of one core share its execution units
+        available_cpus = {cpu for cpu in available_cpus if is_first_thread_of_core(cpu)}
+
+    node_paths = sorted(Path("/sys/devices/system/node").glob("node[0-9]*"), key=lambda path: int(path.name[4:]))
+    nodes = [
+        sorted(set(parse_cpu_list((node_path / "cpulist").read_text())) & available_cpus) for node_path in node_paths
+    ]
+    nodes = [node for node in nodes if node]
+    # Without NUMA information all CPUs are one node
+    return nodes if nodes else [sorted(available_cpus)]
+
+
+def assign_cores(nodes: list[list[int]], num_processes: int) -> list[list[int]]:
+    if num_processes < len(nodes):
+        # Fewer processes than nodes - process uses cores of several nodes
+        return [[cpu for node in nodes[rank::num_processes] for cpu in node] for rank in range(num_processes)]
+
+    # Processes are spread evenly over nodes, cores of one process are on one node (local memory allocations)
+    cores = []
+    for node_index, node in enumerate(nodes):
+        num_node_processes = num_processes // len(nodes) + int(node_index < num_processes % len(nodes))
+        cores_per_process = len(node) // num_node_processes
+        if cores_per_process == 0:
+            raise ValueError(f"Not enough cores for {num_node_processes} processes on NUMA node: {node}")
+        cores.extend(node[i * cores_per_process:(i + 1) * cores_per_process] for i in range(num_node_processes))
+    return cores
+
+
+def launch(script: str, script_args: list[str], num_processes: int, launcher_args: CpuLauncherArguments) -> None:
+    cores = assign_cores(read_numa_nodes(launcher_args.use_logical_cores), num_processes)
+    processes = []
+    for rank, rank_cores in enumerate(cores):
+        LOGGER.info(f"Rank {rank}: {len(rank_cores)} threads on cores {rank_cores}")
+        env = dict(
+            os.environ,
+            RANK=str(rank),
+            LOCAL_RANK=str(rank),
+            WORLD_SIZE=str(num_processes),
+            LOCAL_WORLD_SIZE=str(num_processes),
+            MASTER_ADDR="127.0.0.1",
+            MASTER_PORT=str(launcher_args.master_port),
+            OMP_NUM_THREADS=str(len(rank_cores)),
+            MKL_NUM_THREADS=str(len(rank_cores)),
+        )
+        command = [sys.executable, script, *script_args, "--use_cpu", "--ddp_backend", "gloo"]
+        # Pinned before start of process - memory is allocated on NUMA node of the cores (first touch)
+        processes.append(subprocess.Popen(command, env=env, preexec_fn=partial(os.sched_setaffinity, 0, rank_cores)))
+
+    # Other ranks would wait in collectives forever if one of them fails - all processes are polled in each check
+    return_codes = [process.poll() for process in processes]
+    while any(return_code is None for return_code in return_codes):
+        if any(return_code not in (None, 0) for return_code in return_codes):
+            for process, return_code in zip(processes, return_codes):
+                if return_code is None:
+                    process.terminate()
+        time.sleep(1)
+        return_codes = [process.poll() for process in processes]
+    failed_ranks = [rank for rank, process in enumerate(processes) if process.returncode != 0]
+    if failed_ranks:
+        raise RuntimeError(f"Training failed in ranks: {failed_ranks}")
+
+
+def run_scaling_benchmark(script_args: list[str], launcher_args: CpuLauncherArguments) -> None:
+    max_processes = launcher_args.num_processes
+    process_counts = [2**i for i in range(max_processes.bit_length()) if 2**i < max_processes] + [max_processes]
+
+    report = []
+    for num_processes in process_counts:
+        output_dir = Path(launcher_args.benchmark_output_dir) / f"processes-{num_processes}"
+        # Later arguments override arguments of training recipe - only training is measured
+        benchmark_args = [
+            "--max_steps", str(launcher_args.benchmark_max_steps),
+            "--save_strategy", "no",
+            "--eval_strategy", "no",
+            "--evaluation_strategy", "no",
+            "--load_best_model_at_end", "False",
+            "--do_eval", "False",
+            "--do_predict", "False",
+            "--overwrite_output_dir",
+            "--output_dir", str(output_dir),
+        ]
+        launch(launcher_args.script, script_args + benchmark_args, num_processes, launcher_args)
+        metrics = json.loads((output_dir / "train_results.json").read_text())
+        report.append({"num_processes": num_processes, "samples_per_second": metrics["train_samples_per_second"]})
+
+    base_samples_per_second = report[0]["samples_per_second"]
+    LOGGER.info(f"{'processes':>10} {'samples/s':>10} {'speedup':>10} {'efficiency':>10}")
+    for result in report:
+        result["speedup"] = result["samples_per_second"] / base_samples_per_second
+        result["efficiency"] = result["speedup"] / result["num_processes"]
+        LOGGER.info(
+            f"{result['num_processes']:>10} {result['samples_per_second']:>10.2f} {result['speedup']:>10.2f}"
+            f" {result['efficiency']:>10.2%}"
+        )
+
+    report_path = Path(launcher_args.benchmark_output_dir) / "scaling.json"
+    report_path.write_text(json.dumps(report, indent=2))
+    LOGGER.info(f"Saved scaling report in: {report_path}")
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    parser = HfArgumentParser((CpuLauncherArguments,))
+    launcher_args, script_args = parser.parse_args_into_dataclasses(return_remaining_strings=True)
+
+    if launcher_args.scaling_benchmark:
+        run_scaling_benchmark(script_args, launcher_args)
+    else:
+        launch(launcher_args.script, script_args, launcher_args.num_processes, launcher_args)
+
+
+if __name__ == "__main__":
+    main()
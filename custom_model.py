@@ -14,10 +14,104 @@ from transformers.modeling_outputs import (
     SequenceClassifierOutput,
     SequenceClassifierOutputWithPast,
 )
+from transformers.models.roberta.modeling_roberta import RobertaClassificationHead
 
 LOGGER = logging.getLogger(__name__)
 
 
+def resolve_problem_type(config, num_labels: int, labels: torch.Tensor) -> str:
+    # Not stored in configuration - mutation of module state in forward breaks torch.compile graphs
+    if config.problem_type is not None:
+        return config.problem_type
+    if num_labels == 1:
+        return "regression"
+    if labels.dtype == torch.long or labels.dtype == torch.int:
+        return "single_label_classification"
+    return "multi_label_classification"
+
+
+def classification_loss(config, num_labels: int, logits: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+    problem_type = resolve_problem_type(config, num_labels, labels)
+
+    # Compute loss in fp32 - logits can be in fp16/bf16 under autocast
+    logits = logits.float()
+    if problem_type == "regression":
+        loss_fct = MSELoss()
+        if num_labels == 1:
+            return loss_fct(logits.squeeze(), labels.squeeze().float())
+        return loss_fct(logits, labels.float())
+    elif problem_type == "single_label_classification":
+        loss_fct = CrossEntropyLoss()
+        return loss_fct(logits.view(-1, num_labels), labels.view(-1))
+    elif problem_type == "multi_label_classification":
+        loss_fct = BCEWithLogitsLoss()
+        return loss_fct(logits, labels.float())
+    raise ValueError(f"Unknown problem type: {problem_type}")
+
+
+# RoBERTa - common forward of custom heads
+
+
+class RobertaForSequenceClassificationCustomBase(RobertaForSequenceClassification):
+    """Forward without graph breaks in torch.compile, subclasses define backbone and `classifier` head.
+
+    Head is called with output of last layer and hidden states of all layers (None if `config.use_hidden_states` is
+    not set).
+    """
+
+    def forward(
+        self,
+        input_ids: Optional[torch.LongTensor] = None,
+        attention_mask: Optional[torch.FloatTensor] = None,
+        token_type_ids: Optional[torch.LongTensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        head_mask: Optional[torch.FloatTensor] = None,
+        inputs_embeds: Optional[torch.FloatTensor] = None,
+        labels: Optional[torch.LongTensor] = None,
+        output_attentions: Optional[bool] = None,
+        output_hidden_states: Optional[bool] = None,
+        return_dict: Optional[bool] = None,
+    ) -> Union[Tuple[torch.Tensor], SequenceClassifierOutput]:
+        return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+        output_hidden_states = (
+            output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
+        )
+
+        # Always use dict output from backbone - classifier needs access to hidden states by name
+        outputs = self.roberta(
+            input_ids,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+            position_ids=position_ids,
+            head_mask=head_mask,
+            inputs_embeds=inputs_embeds,
+            output_attentions=output_attentions,
+            output_hidden_states=self.config.use_hidden_states or output_hidden_states,
+            return_dict=True,
+        )
+        sequence_output = outputs[0]
+        logits = self.classifier(sequence_output, hidden_states=outputs.hidden_states)
+        # Return hidden states only if requested, do not mutate backbone output (breaks activation recomputation)
+        hidden_states = outputs.hidden_states if output_hidden_states else None
+
+        loss = None
+        if labels is not None:
+            # move labels to correct device to enable model parallelism
+            labels = labels.to(logits.device)
+            loss = classification_loss(self.config, self.num_labels, logits, labels)
+
+        if not return_dict:
+            output = (logits,) + tuple(v for v in (hidden_states, outputs.attentions) if v is not None)
+            return ((loss,) + output) if loss is not None else output
+
+        return SequenceClassifierOutput(
+            loss=loss,
+            logits=logits,
+            hidden_states=hidden_states,
+            attentions=outputs.attentions,
+        )
+
+
 # RoBERTa - simple example
 
 
@@ -48,7 +142,7 @@ class RobertaClassificationHeadCustomSimple(nn.Module):
         return x
 
 
-class RobertaForSequenceClassificationCustomSimple(RobertaForSequenceClassification):
+class RobertaForSequenceClassificationCustomSimple(RobertaForSequenceClassificationCustomBase):
     def __init__(self, config):
         super().__init__(config)
         self.num_labels = config.num_labels
@@ -77,18 +171,17 @@ class RobertaClassificationHeadCustom(nn.Module):
         self.dropout = nn.Dropout(classifier_dropout)
         self.out_proj = nn.Linear(hidden_size, config.num_labels)
 
-    def forward(self, features, **kwargs):
-        if "hidden_states" in kwargs and kwargs["hidden_states"] is not None:
-            x = torch.cat(
-                (
-                    features[:, 0, :],
-                    # take <s> token (equiv. to [CLS]) from hidden states from last layer
-                    kwargs["hidden_states"][-2][:, 0, :],
-                ),
-                dim=1,
-            )
-        else:
+    def forward(self, features, hidden_states=None, **kwargs):
+        if hidden_states is None:
             raise RuntimeError("Missing hidden state to process forward")
+        x = torch.cat(
+            (
+                features[:, 0, :],
+                # take <s> token (equiv. to [CLS]) from hidden states from last layer
+                hidden_states[-2][:, 0, :],
+            ),
+            dim=1,
+        )
 
         x = self.dense_1(x)
         x = torch.relu(x)
@@ -102,7 +195,7 @@ class RobertaClassificationHeadCustom(nn.Module):
         return x
 
 
-class RobertaForSequenceClassificationCustom(RobertaForSequenceClassification):
+class RobertaForSequenceClassificationCustom(RobertaForSequenceClassificationCustomBase):
     def __init__(self, config):
         super().__init__(config)
         self.num_labels = config.num_labels
@@ -114,6 +207,154 @@ class RobertaForSequenceClassificationCustom(RobertaForSequenceClassification):
         # Initialize weights and apply final processing
         self.post_init()
 
+
+# RoBERTa - Example 2
+
+
+# Keys of checkpoints saved before fusion of input and hidden branches, converted on load
+UNFUSED_DUAL_BRANCH_KEYS = [r"dense_1_input\.(weight|bias)", r"dense_1_hidden\.(weight|bias)"]
+
+
+def fuse_dual_branch_state_dict(state_dict, prefix, *args):
+    # Rows of fused projection are outputs of input branch followed by outputs of hidden branch
+    for name in ["weight", "bias"]:
+        input_key, hidden_key = f"{prefix}dense_1_input.{name}", f"{prefix}dense_1_hidden.{name}"
+        if input_key in state_dict and hidden_key in state_dict:
+            state_dict[f"{prefix}dense_1.{name}"] = torch.cat((state_dict.pop(input_key), state_dict.pop(hidden_key)))
+            # Missing keys are reported by from_pretrained before conversion - fused weights are loaded anyway
+            LOGGER.info(f"Fused input and hidden branches of old checkpoint into: {prefix}dense_1.{name}")
+
+
+class RobertaClassificationHeadCustomAlternative(nn.Module):
+    def __init__(self, config):
+        super().__init__()
+        hidden_size = config.hidden_size
+
+        # Input and hidden branches fused into one projection, output is concatenation of both branches
+        self.dense_1 = nn.Linear(hidden_size, 4 * hidden_size)
+        self.dense_2 = nn.Linear(4 * hidden_size, hidden_size)
+        self._register_load_state_dict_pre_hook(fuse_dual_branch_state_dict)
+        classifier_dropout = (
+            config.classifier_dropout if config.classifier_dropout is not None else config.hidden_dropout_prob
+        )
+        self.dropout = nn.Dropout(classifier_dropout)
+        self.out_proj = nn.Linear(hidden_size, config.num_labels)
+
+    def forward(self, features, hidden_states=None, **kwargs):
+        # Hidden state of last layer is `features` - both branches are computed by one matmul without concatenation
+        x = features[:, 0, :]  # take <s> token (equiv. to [CLS])
+
+        x = self.dense_1(x)
+        x = torch.relu(x)
+        x = self.dropout(x)
+
+        x = self.dense_2(x)
+        x = torch.relu(x)
+        x = self.dropout(x)
+
+        x = self.out_proj(x)
+        return x
+
+
+class RobertaForSequenceClassificationCustomAlternative(RobertaForSequenceClassificationCustomBase):
+    # Separate branches of old checkpoints are fused by `fuse_dual_branch_state_dict`
+    _keys_to_ignore_on_load_unexpected = UNFUSED_DUAL_BRANCH_KEYS
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.num_labels = config.num_labels
+        self.config = config
+
+        self.roberta = RobertaModel(config, add_pooling_layer=False)
+        self.classifier = RobertaClassificationHeadCustomAlternative(config)
+
+        # Initialize weights and apply final processing
+        self.post_init()
+
+
+# RoBERTa - early exit
+
+
+def default_early_exit_layers(num_hidden_layers: int) -> list[int]:
+    # Exit after every quarter of encoder, e.g. layers 3, 6 and 9 of 12
+    step = max(num_hidden_layers // 4, 1)
+    return list(range(step, num_hidden_layers, step))
+
+
+class RobertaEarlyExitHead(nn.Module):
+    def __init__(self, config):
+        super().__init__()
+        classifier_dropout = (
+            config.classifier_dropout if config.classifier_dropout is not None else config.hidden_dropout_prob
+        )
+        self.dropout = nn.Dropout(classifier_dropout)
+        self.out_proj = nn.Linear(config.hidden_size, config.num_labels)
+
+    def forward(self, features, **kwargs):
+        x = features[:, 0, :]  # take <s> token (equiv. to [CLS])
+        x = self.dropout(x)
+        x = self.out_proj(x)
+        return x
+
+
+class RobertaForSequenceClassificationEarlyExit(RobertaForSequenceClassification):
+    def __init__(self, config):
+        super().__init__(config)
+        self.num_labels = config.num_labels
+        self.config = config
+        if getattr(config, "early_exit_layers", None) is None:
+            config.early_exit_layers = default_early_exit_layers(config.num_hidden_layers)
+        # Inference only - stop encoder when probability of predicted class reaches threshold, disabled if None
+        self.early_exit_threshold = getattr(config, "early_exit_threshold", None)
+        # Number of layers used by each sample in the last forward
+        self.exit_layers = None
+
+        self.roberta = RobertaModel(config, add_pooling_layer=False)
+        self.exit_classifiers = nn.ModuleList([RobertaEarlyExitHead(config) for _ in config.early_exit_layers])
+
+        # Initialize weights and apply final processing
+        self.post_init()
+
+    def forward_early_exit(
+        self,
+        input_ids: Optional[torch.LongTensor],
+        attention_mask: Optional[torch.FloatTensor],
+        token_type_ids: Optional[torch.LongTensor],
+        position_ids: Optional[torch.LongTensor],
+        inputs_embeds: Optional[torch.FloatTensor],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        hidden = self.roberta.embeddings(
+            input_ids=input_ids, position_ids=position_ids, token_type_ids=token_type_ids, inputs_embeds=inputs_embeds
+        )
+        batch_size, seq_length = hidden.shape[:2]
+        if attention_mask is None:
+            attention_mask = torch.ones(batch_size, seq_length, device=hidden.device)
+        extended_attention_mask = self.roberta.get_extended_attention_mask(attention_mask, (batch_size, seq_length))
+
+        num_layers = len(self.roberta.encoder.layer)
+        logits = torch.zeros(batch_size, self.num_labels, device=hidden.device)
+        exit_layers = torch.full((batch_size,), num_layers, dtype=torch.long, device=hidden.device)
+        # Indexes of samples which are still processed - confident samples are removed from batch
+        active = torch.arange(batch_size, device=hidden.device)
+        exit_classifiers = dict(zip(self.config.early_exit_layers, self.exit_classifiers))
+        for layer_index, layer in enumerate(self.roberta.encoder.layer, start=1):
+            hidden = layer(hidden, attention_mask=extended_attention_mask)[0]
+            if layer_index not in exit_classifiers:
+                continue
+
+            exit_logits = exit_classifiers[layer_index](hidden).float()
+            confident = torch.softmax(exit_logits, dim=-1).max(dim=-1).values >= self.early_exit_threshold
+            logits[active[confident]] = exit_logits[confident]
+            exit_layers[active[confident]] = layer_index
+            active = active[~confident]
+            if len(active) == 0:
+                return logits, exit_layers
+            hidden = hidden[~confident]
+            extended_attention_mask = extended_attention_mask[~confident]
+
+        logits[active] = self.classifier(hidden).float()
+        return logits, exit_layers
+
     def forward(
         self,
         input_ids: Optional[torch.LongTensor] = None,
@@ -129,6 +370,21 @@ class RobertaForSequenceClassificationCustom(RobertaForSequenceClassification):
     ) -> Union[Tuple[torch.Tensor], SequenceClassifierOutput]:
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
+        # Early exit only in inference of classification - regression has no confidence
+        if not self.training and self.early_exit_threshold is not None and self.num_labels > 1:
+            logits, self.exit_layers = self.forward_early_exit(
+                input_ids, attention_mask, token_type_ids, position_ids, inputs_embeds
+            )
+            loss = None
+            if labels is not None:
+                loss = classification_loss(self.config, self.num_labels, logits, labels.to(logits.device))
+            if not return_dict:
+                return (loss, logits) if loss is not None else (logits,)
+            return SequenceClassifierOutput(loss=loss, logits=logits)
+
+        output_hidden_states = (
+            output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
+        )
         outputs = self.roberta(
             input_ids,
             attention_mask=attention_mask,
@@ -137,100 +393,73 @@ class RobertaForSequenceClassificationCustom(RobertaForSequenceClassification):
             head_mask=head_mask,
             inputs_embeds=inputs_embeds,
             output_attentions=output_attentions,
-            output_hidden_states=self.config.use_hidden_states,
-            return_dict=return_dict,
+            output_hidden_states=True,
+            return_dict=True,
         )
         sequence_output = outputs[0]
-        logits = self.classifier(sequence_output, hidden_states=outputs.hidden_states)
-        del outputs.hidden_states
+        logits = self.classifier(sequence_output)
+        # Index 0 of hidden states is output of embeddings - index of layer is index of its output
+        exit_logits = [
+            exit_classifier(outputs.hidden_states[layer_index])
+            for layer_index, exit_classifier in zip(self.config.early_exit_layers, self.exit_classifiers)
+        ]
+        hidden_states = outputs.hidden_states if output_hidden_states else None
+        self.exit_layers = None
 
         loss = None
         if labels is not None:
             # move labels to correct device to enable model parallelism
             labels = labels.to(logits.device)
-            if self.config.problem_type is None:
-                if self.num_labels == 1:
-                    self.config.problem_type = "regression"
-                elif self.num_labels > 1 and (labels.dtype == torch.long or labels.dtype == torch.int):
-                    self.config.problem_type = "single_label_classification"
-                else:
-                    self.config.problem_type = "multi_label_classification"
-
-            if self.config.problem_type == "regression":
-                loss_fct = MSELoss()
-                if self.num_labels == 1:
-                    loss = loss_fct(logits.squeeze(), labels.squeeze())
-                else:
-                    loss = loss_fct(logits, labels)
-            elif self.config.problem_type == "single_label_classification":
-                loss_fct = CrossEntropyLoss()
-                loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
-            elif self.config.problem_type == "multi_label_classification":
-                loss_fct = BCEWithLogitsLoss()
-                loss = loss_fct(logits, labels)
+            # Joint training of all exits, loss weighted by depth - deeper classifiers are more accurate
+            layer_indexes = self.config.early_exit_layers + [len(self.roberta.encoder.layer)]
+            losses = [
+                layer_index * classification_loss(self.config, self.num_labels, layer_logits, labels)
+                for layer_index, layer_logits in zip(layer_indexes, exit_logits + [logits])
+            ]
+            loss = sum(losses) / sum(layer_indexes)
 
         if not return_dict:
-            output = (logits,) + outputs[2:]
+            output = (logits,) + tuple(v for v in (hidden_states, outputs.attentions) if v is not None)
             return ((loss,) + output) if loss is not None else output
 
         return SequenceClassifierOutput(
             loss=loss,
             logits=logits,
-            hidden_states=outputs.hidden_states,
+            hidden_states=hidden_states,
             attentions=outputs.attentions,
         )
 
 
-# RoBERTa - Example 2
+# RoBERTa - many heads on one backbone
 
+# Custom models and heads which read hidden states of all layers, other ones use only output of the last layer
+HIDDEN_STATES_NAMES = {"roberta_hidden"}
 
-class RobertaClassificationHeadCustomAlternative(nn.Module):
-    def __init__(self, config):
-        super().__init__()
-        hidden_size = config.hidden_size
+ROBERTA_HEAD_NAME_TO_CLASS = {
+    "roberta": RobertaClassificationHead,
+    "roberta_simple": RobertaClassificationHeadCustomSimple,
+    "roberta_hidden": RobertaClassificationHeadCustom,
+    "roberta_hidden_v2": RobertaClassificationHeadCustomAlternative,
+}
 
-        self.dense_1_input = nn.Linear(hidden_size, 2 * hidden_size)
-        self.dense_1_hidden = nn.Linear(hidden_size, 2 * hidden_size)
-        self.dense_2 = nn.Linear(4 * hidden_size, hidden_size)
-        classifier_dropout = (
-            config.classifier_dropout if config.classifier_dropout is not None else config.hidden_dropout_prob
-        )
-        self.dropout = nn.Dropout(classifier_dropout)
-        self.out_proj = nn.Linear(hidden_size, config.num_labels)
-
-    def forward(self, features, **kwargs):
-        x = features[:, 0, :]  # take <s> token (equiv. to [CLS])
-        if "hidden_states" in kwargs and kwargs["hidden_states"] is not None:
-            # take <s> token (equiv. to [CLS]) from hidden states from last layer
-            hidden = kwargs["hidden_states"][-1][:, 0, :]
-        else:
-            raise RuntimeError("Missing hidden state to process forward")
-
-        x = self.dense_1_input(x)
-        x = torch.relu(x)
-        x = self.dropout(x)
-
-        hidden = self.dense_1_hidden(hidden)
-        hidden = torch.relu(hidden)
-        hidden = self.dropout(hidden)
-
-        x = torch.cat((x, hidden), dim=1)
-        x = self.dense_2(x)
-        x = torch.relu(x)
-        x = self.dropout(x)
-
-        x = self.out_proj(x)
-        return x
 
+class RobertaForSequenceClassificationMultiHead(RobertaForSequenceClassification):
+    # Separate branches of old checkpoints are fused by `fuse_dual_branch_state_dict`
+    _keys_to_ignore_on_load_unexpected = UNFUSED_DUAL_BRANCH_KEYS
 
-class RobertaForSequenceClassificationCustomAlternative(RobertaForSequenceClassification):
     def __init__(self, config):
         super().__init__(config)
         self.num_labels = config.num_labels
         self.config = config
+        if getattr(config, "multi_head_names", None) is None:
+            config.multi_head_names = [name for name in ROBERTA_HEAD_NAME_TO_CLASS if name != "roberta"]
+        config.use_hidden_states = any(name in HIDDEN_STATES_NAMES for name in config.multi_head_names)
 
         self.roberta = RobertaModel(config, add_pooling_layer=False)
-        self.classifier = RobertaClassificationHeadCustomAlternative(config)
+        # All heads are trained on output of one backbone forward, losses are summed
+        self.classifier = nn.ModuleDict(
+            {name: ROBERTA_HEAD_NAME_TO_CLASS[name](config) for name in config.multi_head_names}
+        )
 
         # Initialize weights and apply final processing
         self.post_init()
@@ -249,6 +478,9 @@ class RobertaForSequenceClassificationCustomAlternative(RobertaForSequenceClassi
         return_dict: Optional[bool] = None,
     ) -> Union[Tuple[torch.Tensor], SequenceClassifierOutput]:
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+        output_hidden_states = (
+            output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
+        )
 
         outputs = self.roberta(
             input_ids,
@@ -259,49 +491,125 @@ class RobertaForSequenceClassificationCustomAlternative(RobertaForSequenceClassi
             inputs_embeds=inputs_embeds,
             output_attentions=output_attentions,
             output_hidden_states=self.config.use_hidden_states,
-            return_dict=return_dict,
+            return_dict=True,
         )
         sequence_output = outputs[0]
-        logits = self.classifier(sequence_output, hidden_states=outputs.hidden_states)
-        del outputs.hidden_states
+        # Logits of all heads: batch size x number of heads x number of labels
+        logits = torch.stack(
+            [
+                self.classifier[name](sequence_output, hidden_states=outputs.hidden_states)
+                for name in self.config.multi_head_names
+            ],
+            dim=1,
+        )
+        hidden_states = outputs.hidden_states if output_hidden_states else None
 
         loss = None
         if labels is not None:
             # move labels to correct device to enable model parallelism
             labels = labels.to(logits.device)
-            if self.config.problem_type is None:
-                if self.num_labels == 1:
-                    self.config.problem_type = "regression"
-                elif self.num_labels > 1 and (labels.dtype == torch.long or labels.dtype == torch.int):
-                    self.config.problem_type = "single_label_classification"
-                else:
-                    self.config.problem_type = "multi_label_classification"
-
-            if self.config.problem_type == "regression":
-                loss_fct = MSELoss()
-                if self.num_labels == 1:
-                    loss = loss_fct(logits.squeeze(), labels.squeeze())
-                else:
-                    loss = loss_fct(logits, labels)
-            elif self.config.problem_type == "single_label_classification":
-                loss_fct = CrossEntropyLoss()
-                loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
-            elif self.config.problem_type == "multi_label_classification":
-                loss_fct = BCEWithLogitsLoss()
-                loss = loss_fct(logits, labels)
+            loss = sum(
+                classification_loss(self.config, self.num_labels, logits[:, i], labels)
+                for i in range(logits.shape[1])
+            )
 
         if not return_dict:
-            output = (logits,) + outputs[2:]
+            output = (logits,) + tuple(v for v in (hidden_states, outputs.attentions) if v is not None)
             return ((loss,) + output) if loss is not None else output
 
         return SequenceClassifierOutput(
             loss=loss,
             logits=logits,
-            hidden_states=outputs.hidden_states,
+            hidden_states=hidden_states,
             attentions=outputs.attentions,
         )
 
 
+# GPT-2 - common forward of custom heads #
+
+
+class GPT2ForSequenceClassificationCustomBase(GPT2ForSequenceClassification):
+    """Forward without graph breaks in torch.compile, subclasses define backbone and `score` head.
+
+    Head is called for all positions with output of last layer and hidden states of all layers (None if
+    `config.use_hidden_states` is not set), logits of the last non-padding token are returned.
+    """
+
+    def forward(
+        self,
+        input_ids: Optional[torch.LongTensor] = None,
+        past_key_values: Optional[Tuple[Tuple[torch.Tensor]]] = None,
+        attention_mask: Optional[torch.FloatTensor] = None,
+        token_type_ids: Optional[torch.LongTensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        head_mask: Optional[torch.FloatTensor] = None,
+        inputs_embeds: Optional[torch.FloatTensor] = None,
+        labels: Optional[torch.LongTensor] = None,
+        use_cache: Optional[bool] = None,
+        output_attentions: Optional[bool] = None,
+        output_hidden_states: Optional[bool] = None,
+        return_dict: Optional[bool] = None,
+    ) -> Union[Tuple, SequenceClassifierOutputWithPast]:
+        return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+        output_hidden_states = (
+            output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
+        )
+
+        # Always use dict output from backbone - score head needs access to hidden states by name
+        transformer_outputs = self.transformer(
+            input_ids,
+            past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+            position_ids=position_ids,
+            head_mask=head_mask,
+            inputs_embeds=inputs_embeds,
+            use_cache=use_cache,
+            output_attentions=output_attentions,
+            output_hidden_states=self.config.use_hidden_states or output_hidden_states,
+            return_dict=True,
+        )
+        hidden_states = transformer_outputs[0]
+        logits = self.score(hidden_states, hidden_states=transformer_outputs.hidden_states)
+        # Return hidden states only if requested, do not mutate backbone output (breaks activation recomputation)
+        all_hidden_states = transformer_outputs.hidden_states if output_hidden_states else None
+
+        batch_size = input_ids.shape[0] if input_ids is not None else inputs_embeds.shape[0]
+        if self.config.pad_token_id is None:
+            if batch_size != 1:
+                raise ValueError("Cannot handle batch sizes > 1 if no padding token is defined.")
+            sequence_lengths = -1
+        elif input_ids is not None:
+            # Position before the first padding token, -1 (the last position) if there is no padding
+            sequence_lengths = (torch.eq(input_ids, self.config.pad_token_id).int().argmax(-1) - 1).to(logits.device)
+        else:
+            # Padding tokens can not be detected in `inputs_embeds` - the last position is used
+            sequence_lengths = -1
+
+        pooled_logits = logits[torch.arange(batch_size, device=logits.device), sequence_lengths]
+
+        loss = None
+        if labels is not None:
+            # move labels to correct device to enable model parallelism
+            labels = labels.to(pooled_logits.device)
+            loss = classification_loss(self.config, self.num_labels, pooled_logits, labels)
+        if not return_dict:
+            output = (pooled_logits,) + tuple(
+                v
+                for v in (transformer_outputs.past_key_values, all_hidden_states, transformer_outputs.attentions)
+                if v is not None
+            )
+            return ((loss,) + output) if loss is not None else output
+
+        return SequenceClassifierOutputWithPast(
+            loss=loss,
+            logits=pooled_logits,
+            past_key_values=transformer_outputs.past_key_values,
+            hidden_states=all_hidden_states,
+            attentions=transformer_outputs.attentions,
+        )
+
+
 # GPT-2 - simple example #
 
 
@@ -314,7 +622,7 @@ class GPT2ClassificationHeadCustomSimple(nn.Module):
         self.dropout = nn.Dropout(config.resid_pdrop)
         self.out_proj = nn.Linear(hidden_size, config.num_labels, bias=False)
 
-    def forward(self, x):
+    def forward(self, x, **kwargs):
         x = self.dense_1(x)
         x = torch.relu(x)
         x = self.dropout(x)
@@ -327,7 +635,7 @@ class GPT2ClassificationHeadCustomSimple(nn.Module):
         return x
 
 
-class GPT2ForSequenceClassificationCustomSimple(GPT2ForSequenceClassification):
+class GPT2ForSequenceClassificationCustomSimple(GPT2ForSequenceClassificationCustomBase):
     def __init__(self, config):
         super().__init__(config)
         self.num_labels = config.num_labels
@@ -349,28 +657,19 @@ class GPT2ClassificationHeadCustom(nn.Module):
     def __init__(self, config):
         super().__init__()
         hidden_size = config.n_embd
-        self.dense_1_input = nn.Linear(hidden_size, 2 * hidden_size)
-        self.dense_1_hidden = nn.Linear(hidden_size, 2 * hidden_size)
+        # Input and hidden branches fused into one projection, output is concatenation of both branches
+        self.dense_1 = nn.Linear(hidden_size, 4 * hidden_size)
         self.dense_2 = nn.Linear(4 * hidden_size, hidden_size)
+        self._register_load_state_dict_pre_hook(fuse_dual_branch_state_dict)
         self.dropout = nn.Dropout(config.resid_pdrop)
         self.out_proj = nn.Linear(hidden_size, config.num_labels, bias=False)
 
-    def forward(self, x, **kwargs):
-        if "hidden_states" in kwargs and kwargs["hidden_states"] is not None:
-            # Get hidden states from last layer
-            hidden = kwargs["hidden_states"][-1]
-        else:
-            raise RuntimeError("Missing hidden state to process forward")
-
-        x = self.dense_1_input(x)
+    def forward(self, x, hidden_states=None, **kwargs):
+        # Hidden state of last layer (after final layer norm) is `x` - both branches are computed by one matmul
+        x = self.dense_1(x)
         x = torch.relu(x)
         x = self.dropout(x)
 
-        hidden = self.dense_1_hidden(hidden)
-        hidden = torch.relu(hidden)
-        hidden = self.dropout(hidden)
-
-        x = torch.cat((x, hidden), dim=2)
         x = self.dense_2(x)
         x = torch.relu(x)
         x = self.dropout(x)
@@ -379,7 +678,10 @@ class GPT2ClassificationHeadCustom(nn.Module):
         return x
 
 
-class GPT2ForSequenceClassificationCustom(GPT2ForSequenceClassification):
+class GPT2ForSequenceClassificationCustom(GPT2ForSequenceClassificationCustomBase):
+    # Separate branches of old checkpoints are fused by `fuse_dual_branch_state_dict`
+    _keys_to_ignore_on_load_unexpected = UNFUSED_DUAL_BRANCH_KEYS
+
     def __init__(self, config):
         super().__init__(config)
         self.num_labels = config.num_labels
@@ -393,94 +695,13 @@ class GPT2ForSequenceClassificationCustom(GPT2ForSequenceClassification):
         # Initialize weights and apply final processing
         self.post_init()
 
-    def forward(
-        self,
-        input_ids: Optional[torch.LongTensor] = None,
-        past_key_values: Optional[Tuple[Tuple[torch.Tensor]]] = None,
-        attention_mask: Optional[torch.FloatTensor] = None,
-        token_type_ids: Optional[torch.LongTensor] = None,
-        position_ids: Optional[torch.LongTensor] = None,
-        head_mask: Optional[torch.FloatTensor] = None,
-        inputs_embeds: Optional[torch.FloatTensor] = None,
-        labels: Optional[torch.LongTensor] = None,
-        use_cache: Optional[bool] = None,
-        output_attentions: Optional[bool] = None,
-        output_hidden_states: Optional[bool] = None,
-        return_dict: Optional[bool] = None,
-    ) -> Union[Tuple, SequenceClassifierOutputWithPast]:
-        return_dict = return_dict if return_dict is not None else self.config.use_return_dict
-
-        transformer_outputs = self.transformer(
-            input_ids,
-            past_key_values=past_key_values,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            use_cache=use_cache,
-            output_attentions=output_attentions,
-            output_hidden_states=self.config.use_hidden_states,
-            return_dict=return_dict,
-        )
-        hidden_states = transformer_outputs[0]
-        logits = self.score(hidden_states, hidden_states=transformer_outputs.hidden_states)
-        del transformer_outputs.hidden_states
-
-        if input_ids is not None:
-            batch_size, sequence_length = input_ids.shape[:2]
-        else:
-            batch_size, sequence_length = inputs_embeds.shape[:2]
 
-        assert (
-            self.config.pad_token_id is not None or batch_size == 1
-        ), "Cannot handle batch sizes > 1 if no padding token is defined."
-        if self.config.pad_token_id is None:
-            sequence_lengths = -1
-        else:
-            if input_ids is not None:
-                sequence_lengths = (torch.eq(input_ids, self.config.pad_token_id).long().argmax(-1) - 1).to(
-                    logits.device
-                )
-            else:
-                sequence_lengths = -1
-                LOGGER.warning(
-                    f"{self.__class__.__name__} will not detect padding tokens in `inputs_embeds`. Results may be "
-                    "unexpected if using padding tokens in conjunction with `inputs_embeds.`"
-                )
-
-        pooled_logits = logits[torch.arange(batch_size, device=logits.device), sequence_lengths]
-
-        loss = None
-        if labels is not None:
-            if self.config.problem_type is None:
-                if self.num_labels == 1:
-                    self.config.problem_type = "regression"
-                elif self.num_labels > 1 and (labels.dtype == torch.long or labels.dtype == torch.int):
-                    self.config.problem_type = "single_label_classification"
-                else:
-                    self.config.problem_type = "multi_label_classification"
-
-            if self.config.problem_type == "regression":
-                loss_fct = MSELoss()
-                if self.num_labels == 1:
-                    loss = loss_fct(pooled_logits.squeeze(), labels.squeeze())
-                else:
-                    loss = loss_fct(pooled_logits, labels)
-            elif self.config.problem_type == "single_label_classification":
-                loss_fct = CrossEntropyLoss()
-                loss = loss_fct(pooled_logits.view(-1, self.num_labels), labels.view(-1))
-            elif self.config.problem_type == "multi_label_classification":
-                loss_fct = BCEWithLogitsLoss()
-                loss = loss_fct(pooled_logits, labels)
-        if not return_dict:
-            output = (pooled_logits,) + transformer_outputs[1:]
-            return ((loss,) + output) if loss is not None else output
-
-        return SequenceClassifierOutputWithPast(
-            loss=loss,
-            logits=pooled_logits,
-            past_key_values=transformer_outputs.past_key_values,
-            hidden_states=transformer_outputs.hidden_states,
-            attentions=transformer_outputs.attentions,
-        )
+MODEL_NAME_TO_CLASS = {
+    "roberta_simple": RobertaForSequenceClassificationCustomSimple,
+    "roberta_hidden": RobertaForSequenceClassificationCustom,
+    "roberta_hidden_v2": RobertaForSequenceClassificationCustomAlternative,
+    "roberta_early_exit": RobertaForSequenceClassificationEarlyExit,
+    "roberta_multi_head": RobertaForSequenceClassificationMultiHead,
+    "gpt2_simple": GPT2ForSequenceClassificationCustomSimple,
+    "gpt2_hidden": GPT2ForSequenceClassificationCustom,
+}
@@ -0,0 +1,268 @@
+import hashlib
+import json
+import logging
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from transformers import (
+    AutoConfig,
+    AutoModelForSeq2SeqLM,
+    AutoModelForSequenceClassification,
+    AutoTokenizer,
+    PretrainedConfig,
+    PreTrainedModel,
+    PreTrainedTokenizerBase,
+    Trainer,
+)
+
+from custom_model import MODEL_NAME_TO_CLASS
+from prepare_imdb import MAP_LABEL_TRANSLATION, normalize_source_prefix
+from vocab_trimming import T5ForConditionalGenerationTrimmed
+
+LOGGER = logging.getLogger(__name__)
+
+SAMPLE_INDEX_COLUMN = "sample_index"
+
+
+@dataclass
+class DistillationArguments:
+    teacher_model_name_or_path: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Trained classification (run_glue.py) or seq2seq (run_translation.py) model used as teacher,"
+                " distillation is disabled if not set"
+            )
+        },
+    )
+    teacher_source_prefix: str = field(
+        default="",
+        metadata={
+            "help": (
+                "Source prefix used in training of seq2seq teacher, e.g. 'imdb classification' (normalized the same"
+                " way as in run_translation.py to 'imdb classification: ')"
+            )
+        },
+    )
+    teacher_max_seq_length: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Maximum number of tokens of teacher inputs, default: max_source_length of seq2seq teacher trained"
+                " by run_translation.py, otherwise max_seq_length of student"
+            )
+        },
+    )
+    teacher_logits_file: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Cache of teacher logits of training set (.npy) with fingerprint of teacher and data (.json),"
+                " default: OUTPUT_DIR/teacher_logits.npy"
+            )
+        },
+    )
+    teacher_batch_size: int = field(default=64, metadata={"help": "Batch size of teacher inference"})
+    distillation_temperature: float = field(default=2.0, metadata={"help": "Temperature of soft targets"})
+    distillation_alpha: float = field(
+        default=0.5, metadata={"help": "Weight of soft targets loss, hard targets (labels) have weight 1 - alpha"}
+    )
+    student_num_hidden_layers: Optional[int] = field(
+        default=None,
+        metadata={"help": "Keep only first N layers of student model, e.g. 6 layers of roberta-base"},
+    )
+
+
+def get_model_cls(config: PretrainedConfig) -> type:
+    # Custom implementations have weights which are not loaded by auto classes
+    name_to_class = {
+        model_cls.__name__: model_cls
+        for model_cls in [*MODEL_NAME_TO_CLASS.values(), T5ForConditionalGenerationTrimmed]
+    }
+    architecture = (config.architectures or [None])[0]
+    if architecture in name_to_class:
+        return name_to_class[architecture]
+    if config.is_encoder_decoder:
+        return AutoModelForSeq2SeqLM
+    return AutoModelForSequenceClassification
+
+
+def load_teacher(model_name_or_path: str) -> PreTrainedModel:
+    return get_model_cls(AutoConfig.from_pretrained(model_name_or_path)).from_pretrained(model_name_or_path)
+
+
+def get_teacher_max_length(config: PretrainedConfig, max_length: int) -> int:
+    # Seq2seq teacher saved by run_translation.py has max_source_length of its training in config
+    if config.is_encoder_decoder and getattr(config, "max_source_length", None) is not None:
+        return config.max_source_length
+    return max_length
+
+
+def get_label_token_ids(
+    tokenizer: PreTrainedTokenizerBase, label_list: list, output_token_ids: Optional[list[int]] = None
+) -> list[int]:
+    # Seq2seq teacher generates label words - classification logits are logits of their first tokens
+    label_token_ids = [
+        tokenizer(MAP_LABEL_TRANSLATION.get(label, str(label)), add_special_tokens=False).input_ids[0]
+        for label in label_list
+    ]
+    if len(set(label_token_ids)) != len(label_token_ids):
+        raise ValueError(f"Labels {label_list} do not have distinct first tokens: {label_token_ids}")
+    if output_token_ids is not None:
+        # Decoder of model with trimmed vocabulary predicts indexes of output tokens
+        missing_token_ids = [token_id for token_id in label_token_ids if token_id not in output_token_ids]
+        if missing_token_ids:
+            raise ValueError(f"Label tokens {missing_token_ids} are not in trimmed vocabulary of model")
+        label_token_ids = [output_token_ids.index(token_id) for token_id in label_token_ids]
+    return label_token_ids
+
+
+@torch.no_grad()
+def predict_logits(
+    model: PreTrainedModel,
+    tokenizer: PreTrainedTokenizerBase,
+    texts: list[str],
+    label_list: list,
+    max_length: int,
+    batch_size: int,
+    source_prefix: str = "",
+) -> np.ndarray:
+    model.eval()
+    device = model.device
+    source_prefix = normalize_source_prefix(source_prefix)
+    label_token_ids = (
+        get_label_token_ids(tokenizer, label_list, getattr(model.config, "output_token_ids", None))
+        if model.config.is_encoder_decoder
+        else None
+    )
+    # Batches of texts with similar length - less padding
+    order = np.argsort([len(text) for text in texts], kind="stable")
+    all_logits = np.zeros((len(texts), len(label_list)), dtype=np.float32)
+    for i in range(0, len(texts), batch_size):
+        indexes = order[i:i + batch_size]
+        batch = tokenizer(
+            [source_prefix + texts[index] for index in indexes],
+            max_length=max_length,
+            truncation=True,
+            padding=True,
+            return_tensors="pt",
+        ).to(device)
+        if label_token_ids is not None:
+            decoder_input_ids = torch.full(
+                (len(indexes), 1), model.config.decoder_start_token_id, dtype=torch.long, device=device
+            )
+            logits = model(**batch, decoder_input_ids=decoder_input_ids).logits[:, 0, label_token_ids]
+        else:
+            logits = model(**batch).logits
+            if logits.dim() == 3:
+                raise ValueError("Multi-head models are not supported as teachers, logits of one head are expected")
+        all_logits[indexes] = logits.float().cpu().numpy()
+    return all_logits
+
+
+def create_logits_fingerprint(
+    distillation_args: DistillationArguments, texts: list[str], label_list: list, max_length: int
+) -> dict[str, Any]:
+    # Everything which changes teacher logits - cache of different data with the same shape is not reused
+    texts_hash = hashlib.blake2b(digest_size=20)
+    for text in texts:
+        texts_hash.update(text.encode())
+        texts_hash.update(b"\0")
+    return {
+        "teacher_model_name_or_path": distillation_args.teacher_model_name_or_path,
+        "teacher_source_prefix": normalize_source_prefix(distillation_args.teacher_source_prefix),
+        "max_length": max_length,
+        "label_list": [str(label) for label in label_list],
+        "texts_hash": texts_hash.hexdigest(),
+    }
+
+
+def load_teacher_logits(
+    distillation_args: DistillationArguments,
+    texts: list[str],
+    label_list: list,
+    max_length: int,
+    output_dir: str,
+) -> np.memmap:
+    logits_path = Path(distillation_args.teacher_logits_file or Path(output_dir) / "teacher_logits.npy")
+    fingerprint_path = logits_path.with_suffix(".json")
+    max_length = distillation_args.teacher_max_seq_length or get_teacher_max_length(
+        AutoConfig.from_pretrained(distillation_args.teacher_model_name_or_path), max_length
+    )
+    fingerprint = create_logits_fingerprint(distillation_args, texts, label_list, max_length)
+    if logits_path.exists() and fingerprint_path.exists():
+        cached_fingerprint = json.loads(fingerprint_path.read_text())
+        if cached_fingerprint == fingerprint:
+            LOGGER.info(f"Using cached teacher logits from: {logits_path}")
+            return np.load(logits_path, mmap_mode="r")
+        LOGGER.warning(f"Cached teacher logits were computed for different data or teacher: {cached_fingerprint}")
+
+    LOGGER.info(
+        f"Computing teacher logits with: {distillation_args.teacher_model_name_or_path} (max length: {max_length})"
+    )
+    teacher = load_teacher(distillation_args.teacher_model_name_or_path)
+    teacher.to("cuda" if torch.cuda.is_available() else "cpu")
+    tokenizer = AutoTokenizer.from_pretrained(distillation_args.teacher_model_name_or_path)
+    logits = predict_logits(
+        teacher,
+        tokenizer,
+        texts,
+        label_list,
+        max_length,
+        distillation_args.teacher_batch_size,
+        source_prefix=distillation_args.teacher_source_prefix,
+    )
+    del teacher
+
+    logits_path.parent.mkdir(parents=True, exist_ok=True)
+    # Fingerprint is written after logits - interrupted save is not used as cache
+    fingerprint_path.unlink(missing_ok=True)
+    teacher_logits = np.lib.format.open_memmap(logits_path, mode="w+", dtype=np.float32, shape=logits.shape)
+    teacher_logits[:] = logits
+    teacher_logits.flush()
+    fingerprint_path.write_text(json.dumps(fingerprint, indent=2))
+    LOGGER.info(f"Saved teacher logits in: {logits_path}")
+    return np.load(logits_path, mmap_mode="r")
+
+
+class DistillationTrainer(Trainer):
+    """Trainer with loss mixing cross entropy of labels and KL divergence to cached teacher logits.
+
+    Training samples are matched with teacher logits by `sample_index` column.
+    """
+
+    def __init__(self, *args, teacher_logits: np.ndarray, temperature: float, alpha: float, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.teacher_logits = teacher_logits
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def _set_signature_columns_if_needed(self):
+        super()._set_signature_columns_if_needed()
+        # Keep index column which is not an argument of model forward
+        if SAMPLE_INDEX_COLUMN not in self._signature_columns:
+            self._signature_columns.append(SAMPLE_INDEX_COLUMN)
+
+    def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
+        sample_indexes = inputs.pop(SAMPLE_INDEX_COLUMN, None)
+        outputs = model(**inputs)
+        loss = outputs.loss
+        if sample_indexes is not None:
+            # Only rows of current batch are read from memory mapped file
+            teacher_logits = torch.from_numpy(self.teacher_logits[sample_indexes.cpu().numpy()])
+            teacher_logits = teacher_logits.to(outputs.logits.device)
+            student_log_probs = F.log_softmax(outputs.logits.float() / self.temperature, dim=-1)
+            teacher_probs = F.softmax(teacher_logits / self.temperature, dim=-1)
+            if student_log_probs.dim() == 3:
+                # Multi-head student (batch size x heads x labels) - each head is distilled, losses are summed as
+                # losses of labels
+                teacher_probs = teacher_probs.unsqueeze(1).expand_as(student_log_probs)
+            # Scaled by T^2 - gradients of soft targets have the same magnitude as of hard targets
+            soft_loss = F.kl_div(student_log_probs, teacher_probs, reduction="batchmean") * self.temperature**2
+            loss = self.alpha * soft_loss + (1 - self.alpha) * loss
+        return (loss, outputs) if return_outputs else loss
+
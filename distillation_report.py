@@ -0,0 +1,111 @@
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import torch
+from transformers import AutoTokenizer, HfArgumentParser
+
+from distillation import get_teacher_max_length, load_teacher, predict_logits
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class DistillationReportArguments:
+    teacher_model_name_or_path: str = field(metadata={"help": "Path to teacher model"})
+    student_model_name_or_path: str = field(metadata={"help": "Path to student model trained with distillation"})
+    teacher_source_prefix: str = field(
+        default="", metadata={"help": "Source prefix of seq2seq teacher, e.g. 'imdb classification'"}
+    )
+    test_file: str = field(default="data/test-5k.json", metadata={"help": "JSON lines file with text and label"})
+    max_seq_length: int = field(default=128, metadata={"help": "Maximum number of tokens"})
+    teacher_max_seq_length: Optional[int] = field(
+        default=None,
+        metadata={"help": "Maximum number of tokens of teacher, default: max_source_length of seq2seq teacher"},
+    )
+    batch_size: int = field(default=32, metadata={"help": "Batch size"})
+    max_samples: Optional[int] = field(default=None, metadata={"help": "Number of evaluated samples"})
+    output_file: Optional[str] = field(default=None, metadata={"help": "Path to JSON with report"})
+
+
+def evaluate_model(
+    model_name_or_path: str,
+    texts: list[str],
+    labels: np.ndarray,
+    report_args: DistillationReportArguments,
+    prefix: str,
+    max_length: Optional[int] = None,
+) -> dict[str, float]:
+    model = load_teacher(model_name_or_path)
+    model.to("cuda" if torch.cuda.is_available() else "cpu")
+    tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
+    label_list = sorted(set(labels.tolist()))
+    max_length = max_length or get_teacher_max_length(model.config, report_args.max_seq_length)
+
+    # Warmup - first iterations are slower (allocations, kernel selection)
+    predict_logits(
+        model, tokenizer, texts[:report_args.batch_size], label_list, max_length, 1, prefix
+    )
+    start_time = time.perf_counter()
+    logits = predict_logits(
+        model, tokenizer, texts, label_list, max_length, report_args.batch_size, prefix
+    )
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    elapsed_time = time.perf_counter() - start_time
+    return {
+        "accuracy": float((logits.argmax(axis=1) == labels).mean()),
+        "ms_per_sample": elapsed_time / len(texts) * 1000,
+        "num_parameters": model.num_parameters(),
+        "max_length": max_length,
+    }
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    parser = HfArgumentParser((DistillationReportArguments,))
+    report_args, = parser.parse_args_into_dataclasses()
+
+    texts, labels = [], []
+    with open(report_args.test_file, "rt") as f_read:
+        for line in f_read:
+            data = json.loads(line)
+            texts.append(data["text"])
+            # IMDB labels are 0/1 - the same as label IDs of models trained by run_glue.py
+            labels.append(int(data["label"]))
+    texts, labels = texts[:report_args.max_samples], np.array(labels[:report_args.max_samples])
+
+    teacher = evaluate_model(
+        report_args.teacher_model_name_or_path,
+        texts,
+        labels,
+        report_args,
+        report_args.teacher_source_prefix,
+        report_args.teacher_max_seq_length,
+    )
+    student = evaluate_model(report_args.student_model_name_or_path, texts, labels, report_args, "")
+    report = {
+        "teacher": teacher,
+        "student": student,
+        "speedup": teacher["ms_per_sample"] / student["ms_per_sample"],
+        "accuracy_retention": student["accuracy"] / teacher["accuracy"],
+        "parameters_ratio": student["num_parameters"] / teacher["num_parameters"],
+    }
+    LOGGER.info(f"Teacher: {teacher}")
+    LOGGER.info(f"Student: {student}")
+    LOGGER.info(
+        f"Speedup: {report['speedup']:.2f}x, accuracy retention: {report['accuracy_retention']:.2%},"
+        f" parameters: {report['parameters_ratio']:.2%}"
+    )
+
+    if report_args.output_file is not None:
+        Path(report_args.output_file).write_text(json.dumps(report, indent=2))
+        LOGGER.info(f"Saved report in: {report_args.output_file}")
+
+
+if __name__ == "__main__":
+    main()
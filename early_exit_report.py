@@ -0,0 +1,132 @@
+import json
+import logging
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import torch
+from transformers import AutoTokenizer, HfArgumentParser
+
+from custom_model import RobertaForSequenceClassificationEarlyExit
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class EarlyExitReportArguments:
+    model_name_or_path: str = field(metadata={"help": "Path to model trained with --custom_model roberta_early_exit"})
+    data_file: str = field(default="data/valid-5k.json", metadata={"help": "JSON lines file with text and label"})
+    thresholds: list[float] = field(
+        default_factory=lambda: [0.6, 0.7, 0.8, 0.9, 0.95, 0.99],
+        metadata={"help": "Early exit thresholds to compare with full model"},
+    )
+    max_seq_length: int = field(default=128, metadata={"help": "Maximum number of tokens"})
+    batch_size: int = field(default=1, metadata={"help": "Batch size, 1 measures latency of single request"})
+    max_samples: Optional[int] = field(default=1000, metadata={"help": "Number of evaluated samples"})
+    device: str = field(default="cuda" if torch.cuda.is_available() else "cpu", metadata={"help": "Device"})
+    output_file: Optional[str] = field(default=None, metadata={"help": "Path to JSON with report"})
+
+
+@dataclass
+class EarlyExitResult:
+    threshold: Optional[float]
+    accuracy: float
+    mean_exit_layer: float
+    ms_per_sample: float
+    speedup: float
+
+
+def read_data(file_path: Path, max_samples: Optional[int]) -> tuple[list[str], list[int]]:
+    texts, labels = [], []
+    with open(file_path, "rt") as f_read:
+        for line in f_read:
+            data = json.loads(line)
+            texts.append(data["text"])
+            # IMDB labels are 0/1 - the same as label IDs of model trained by run_glue.py
+            labels.append(int(data["label"]))
+            if max_samples is not None and len(texts) >= max_samples:
+                break
+    return texts, labels
+
+
+@torch.no_grad()
+def evaluate_threshold(
+    model: RobertaForSequenceClassificationEarlyExit,
+    batches: list[dict[str, torch.Tensor]],
+    labels: torch.Tensor,
+    threshold: Optional[float],
+) -> tuple[float, float, float]:
+    model.early_exit_threshold = threshold
+    num_layers = model.config.num_hidden_layers
+    predictions, exit_layers = [], []
+    start_time = time.perf_counter()
+    for batch in batches:
+        predictions.append(model(**batch).logits.argmax(dim=-1).cpu())
+        if model.exit_layers is not None:
+            exit_layers.append(model.exit_layers.cpu())
+        else:
+            exit_layers.append(torch.full((len(batch["input_ids"]),), num_layers))
+    elapsed_time = time.perf_counter() - start_time
+
+    accuracy = (torch.cat(predictions) == labels).float().mean().item()
+    mean_exit_layer = torch.cat(exit_layers).float().mean().item()
+    return accuracy, mean_exit_layer, elapsed_time / len(labels) * 1000
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    parser = HfArgumentParser((EarlyExitReportArguments,))
+    report_args, = parser.parse_args_into_dataclasses()
+
+    tokenizer = AutoTokenizer.from_pretrained(report_args.model_name_or_path)
+    model = RobertaForSequenceClassificationEarlyExit.from_pretrained(report_args.model_name_or_path)
+    model.to(report_args.device).eval()
+    LOGGER.info(f"Exit classifiers after layers: {model.config.early_exit_layers}")
+
+    texts, labels = read_data(Path(report_args.data_file), report_args.max_samples)
+    batches = []
+    for i in range(0, len(texts), report_args.batch_size):
+        batch = tokenizer(
+            texts[i:i + report_args.batch_size],
+            max_length=report_args.max_seq_length,
+            truncation=True,
+            padding=True,
+            return_tensors="pt",
+        )
+        batches.append({k: v.to(report_args.device) for k, v in batch.items()})
+    labels = torch.tensor(labels)
+
+    # Warmup - first iterations are slower (allocations, kernel selection)
+    evaluate_threshold(model, batches[:10], labels[:10 * report_args.batch_size], None)
+
+    results = []
+    full_ms = None
+    # The first one is full model without early exit - reference of speedup
+    for threshold in [None] + report_args.thresholds:
+        accuracy, mean_exit_layer, ms_per_sample = evaluate_threshold(model, batches, labels, threshold)
+        full_ms = full_ms or ms_per_sample
+        results.append(
+            EarlyExitResult(
+                threshold=threshold,
+                accuracy=round(accuracy, 4),
+                mean_exit_layer=round(mean_exit_layer, 2),
+                ms_per_sample=round(ms_per_sample, 3),
+                speedup=round(full_ms / ms_per_sample, 2),
+            )
+        )
+
+    LOGGER.info("threshold\taccuracy\tmean_exit_layer\tms_per_sample\tspeedup")
+    for result in results:
+        threshold = "full" if result.threshold is None else result.threshold
+        LOGGER.info(
+            f"{threshold}\t{result.accuracy}\t{result.mean_exit_layer}\t{result.ms_per_sample}\t{result.speedup}"
+        )
+
+    if report_args.output_file is not None:
+        Path(report_args.output_file).write_text(json.dumps([asdict(result) for result in results], indent=2))
+        LOGGER.info(f"Saved report in: {report_args.output_file}")
+
+
+if __name__ == "__main__":
+    main()
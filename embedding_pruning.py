@@ -0,0 +1,273 @@
+import copy
+import json
+import logging
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import torch
+from torch import nn
+from transformers import AutoConfig, AutoTokenizer, HfArgumentParser, PreTrainedModel, PreTrainedTokenizerBase
+
+from distillation import load_teacher, predict_logits
+
+LOGGER = logging.getLogger(__name__)
+
+SPECIAL_TOKEN_ID_NAMES = ["pad_token_id", "bos_token_id", "eos_token_id", "sep_token_id", "decoder_start_token_id"]
+
+
+class RemappedTokenizerMixin:
+    """Maps token IDs of original tokenizer to rows of pruned embeddings, decoding maps them back.
+
+    Special token IDs are remapped too - padding and methods adding special tokens use rows of pruned embeddings.
+    """
+
+    def set_pruned_token_ids(self, pruned_token_ids: list[int]) -> None:
+        self.pruned_token_ids = np.asarray(pruned_token_ids)
+        # Tokens not seen in corpus are mapped to unknown token (or the first one if tokenizer has no unknown token)
+        unk_token_id = super().unk_token_id
+        unk_index = pruned_token_ids.index(unk_token_id) if unk_token_id in pruned_token_ids else 0
+        self.token_id_to_index = np.full(max(pruned_token_ids + [len(self.get_vocab())]) + 1, unk_index)
+        self.token_id_to_index[self.pruned_token_ids] = np.arange(len(self.pruned_token_ids))
+
+    def remap_ids(self, input_ids):
+        if len(input_ids) > 0 and isinstance(input_ids[0], list):
+            return [self.token_id_to_index[ids].tolist() for ids in input_ids]
+        return self.token_id_to_index[input_ids].tolist()
+
+    def __call__(self, *args, padding=False, return_tensors=None, **kwargs):
+        # Padding after remapping - padded positions use remapped PAD token
+        encoding = super().__call__(*args, **kwargs)
+        for key in ["input_ids", "labels"]:
+            if key in encoding:
+                encoding[key] = self.remap_ids(encoding[key])
+        return self.pad(encoding, padding=padding, max_length=kwargs.get("max_length"), return_tensors=return_tensors)
+
+    def _decode(self, token_ids, **kwargs):
+        return super()._decode(self.pruned_token_ids[token_ids].tolist(), **kwargs)
+
+    def convert_ids_to_tokens(self, ids, skip_special_tokens: bool = False):
+        return super().convert_ids_to_tokens(self.pruned_token_ids[ids].tolist(), skip_special_tokens)
+
+    def __len__(self) -> int:
+        return len(self.pruned_token_ids)
+
+    def remap_token_id(self, token_id: Optional[int]) -> Optional[int]:
+        return None if token_id is None else int(self.token_id_to_index[token_id])
+
+    @property
+    def pad_token_id(self) -> Optional[int]:
+        return self.remap_token_id(super().pad_token_id)
+
+    @property
+    def bos_token_id(self) -> Optional[int]:
+        return self.remap_token_id(super().bos_token_id)
+
+    @property
+    def eos_token_id(self) -> Optional[int]:
+        return self.remap_token_id(super().eos_token_id)
+
+    @property
+    def unk_token_id(self) -> Optional[int]:
+        return self.remap_token_id(super().unk_token_id)
+
+    @property
+    def sep_token_id(self) -> Optional[int]:
+        return self.remap_token_id(super().sep_token_id)
+
+    @property
+    def cls_token_id(self) -> Optional[int]:
+        return self.remap_token_id(super().cls_token_id)
+
+    @property
+    def mask_token_id(self) -> Optional[int]:
+        return self.remap_token_id(super().mask_token_id)
+
+
+def create_remapped_tokenizer(
+    tokenizer: PreTrainedTokenizerBase, pruned_token_ids: list[int]
+) -> PreTrainedTokenizerBase:
+    tokenizer_cls = type(tokenizer)
+    # The same class name - saved tokenizer is loaded by AutoTokenizer as original one (remapping comes from config)
+    remapped_cls = type(tokenizer_cls.__name__, (RemappedTokenizerMixin, tokenizer_cls), {})
+    remapped_tokenizer = copy.copy(tokenizer)
+    remapped_tokenizer.__class__ = remapped_cls
+    remapped_tokenizer.set_pruned_token_ids(pruned_token_ids)
+    return remapped_tokenizer
+
+
+def load_tokenizer(model_name_or_path: str, **kwargs) -> PreTrainedTokenizerBase:
+    config = AutoConfig.from_pretrained(model_name_or_path, **kwargs)
+    tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, **kwargs)
+    if getattr(config, "pruned_token_ids", None):
+        tokenizer = create_remapped_tokenizer(tokenizer, config.pruned_token_ids)
+    return tokenizer
+
+
+def count_token_ids(
+    tokenizer: PreTrainedTokenizerBase, texts: list[str], batch_size: int = 1000
+) -> Counter:
+    counter = Counter()
+    for i in range(0, len(texts), batch_size):
+        for input_ids in tokenizer(texts[i:i + batch_size])["input_ids"]:
+            counter.update(input_ids)
+    return counter
+
+
+def find_pruned_token_ids(
+    tokenizer: PreTrainedTokenizerBase, counter: Counter, min_count: int = 1
+) -> list[int]:
+    token_ids = {token_id for token_id, count in counter.items() if count >= min_count}
+    token_ids.update(tokenizer.all_special_ids)
+    return sorted(token_ids)
+
+
+def prune_embeddings(model: PreTrainedModel, pruned_token_ids: list[int]) -> PreTrainedModel:
+    token_id_to_index = {token_id: i for i, token_id in enumerate(pruned_token_ids)}
+    index = torch.tensor(pruned_token_ids, device=model.device)
+    input_embeddings = model.get_input_embeddings()
+    output_embeddings = model.get_output_embeddings()
+    # Output projection over vocabulary (e.g. lm_head of T5) - decoder inputs and labels use remapped IDs
+    if output_embeddings is not None and output_embeddings.weight.shape[0] != input_embeddings.weight.shape[0]:
+        output_embeddings = None
+
+    old_padding_idx = input_embeddings.padding_idx
+    new_padding_idx = token_id_to_index[old_padding_idx] if old_padding_idx is not None else None
+    new_input_embeddings = nn.Embedding(
+        len(pruned_token_ids), input_embeddings.embedding_dim, padding_idx=new_padding_idx
+    )
+    new_input_embeddings.weight.data = input_embeddings.weight.data[index].clone()
+    model.set_input_embeddings(new_input_embeddings)
+    if output_embeddings is not None:
+        new_output_embeddings = nn.Linear(
+            output_embeddings.in_features, len(pruned_token_ids), bias=output_embeddings.bias is not None
+        )
+        new_output_embeddings.weight.data = output_embeddings.weight.data[index].clone()
+        if output_embeddings.bias is not None:
+            new_output_embeddings.bias.data = output_embeddings.bias.data[index].clone()
+        model.set_output_embeddings(new_output_embeddings)
+
+    config = model.config
+    for name in SPECIAL_TOKEN_ID_NAMES:
+        token_id = getattr(config, name, None)
+        if token_id is None:
+            continue
+        if token_id not in token_id_to_index:
+            raise ValueError(f"Missing {name} ({token_id}) in pruned tokens")
+        setattr(config, name, token_id_to_index[token_id])
+    # Generation configuration has its own copy of special token IDs
+    if getattr(model, "generation_config", None) is not None:
+        for name in SPECIAL_TOKEN_ID_NAMES:
+            token_id = getattr(model.generation_config, name, None)
+            if isinstance(token_id, int) and token_id in token_id_to_index:
+                setattr(model.generation_config, name, token_id_to_index[token_id])
+    config.vocab_size = len(pruned_token_ids)
+    config.pruned_token_ids = pruned_token_ids
+    # Tied output weights point to new input embeddings again
+    model.tie_weights()
+
+    # Position IDs of RoBERTa are computed from positions of PAD tokens
+    if old_padding_idx is not None:
+        for module in model.modules():
+            if not isinstance(module, nn.Embedding) and getattr(module, "padding_idx", None) == old_padding_idx:
+                module.padding_idx = new_padding_idx
+    return model
+
+
+@dataclass
+class PruneEmbeddingsArguments:
+    model_name_or_path: str = field(metadata={"help": "Path to trained model (run_glue.py or run_translation.py)"})
+    output_dir: str = field(metadata={"help": "Where to save model with pruned embeddings"})
+    train_files: list[str] = field(
+        default_factory=lambda: ["data/train-5k.json", "data/valid-5k.json"],
+        metadata={"help": "JSON lines files with corpus"},
+    )
+    text_keys: list[str] = field(
+        default_factory=lambda: ["text"],
+        metadata={"help": "Fields with texts, use 'text label' for seq2seq data"},
+    )
+    extra_texts: list[str] = field(
+        default_factory=list, metadata={"help": "Additional texts, e.g. source prefix 'imdb classification: '"}
+    )
+    min_count: int = field(default=1, metadata={"help": "Minimal number of occurrences of kept token"})
+    test_file: Optional[str] = field(default="data/test-5k.json", metadata={"help": "Data for parity check"})
+    source_prefix: str = field(default="", metadata={"help": "Source prefix of seq2seq model in parity check"})
+    max_seq_length: int = field(default=128, metadata={"help": "Maximum number of tokens in parity check"})
+    batch_size: int = field(default=32, metadata={"help": "Batch size in parity check"})
+
+
+def read_texts(file_paths: list[str], text_keys: list[str]) -> list[str]:
+    texts = []
+    for file_path in file_paths:
+        with open(file_path, "rt") as f_read:
+            for line in f_read:
+                data = json.loads(line)
+                texts.extend(str(data[key]) for key in text_keys)
+    return texts
+
+
+def get_directory_mb(directory: Path) -> float:
+    return sum(path.stat().st_size for path in directory.rglob("*") if path.is_file()) / 2**20
+
+
+def check_parity(prune_args: PruneEmbeddingsArguments, original_model: PreTrainedModel) -> None:
+    texts, labels = [], []
+    with open(prune_args.test_file, "rt") as f_read:
+        for line in f_read:
+            data = json.loads(line)
+            texts.append(data["text"])
+            labels.append(data["label"])
+    label_list = sorted(set(labels))
+    original_tokenizer = AutoTokenizer.from_pretrained(prune_args.model_name_or_path)
+
+    start_time = time.perf_counter()
+    model = load_teacher(prune_args.output_dir)
+    load_time = time.perf_counter() - start_time
+    tokenizer = load_tokenizer(prune_args.output_dir)
+
+    logits_args = (label_list, prune_args.max_seq_length, prune_args.batch_size, prune_args.source_prefix)
+    original_logits = predict_logits(original_model, original_tokenizer, texts, *logits_args)
+    logits = predict_logits(model, tokenizer, texts, *logits_args)
+    unknown_index = tokenizer.unk_token_id
+    num_unknown_texts = sum(unknown_index in input_ids for input_ids in tokenizer(texts)["input_ids"])
+
+    LOGGER.info(f"Loading time of pruned model: {load_time:.2f}s")
+    LOGGER.info(f"Test texts with tokens outside of pruned vocabulary: {num_unknown_texts / len(texts):.2%}")
+    LOGGER.info(f"Maximal absolute difference of logits: {np.abs(original_logits - logits).max():.6f}")
+    LOGGER.info(
+        f"Agreement of predictions: {(original_logits.argmax(axis=1) == logits.argmax(axis=1)).mean():.2%}"
+    )
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    parser = HfArgumentParser((PruneEmbeddingsArguments,))
+    prune_args, = parser.parse_args_into_dataclasses()
+
+    start_time = time.perf_counter()
+    model = load_teacher(prune_args.model_name_or_path)
+    LOGGER.info(f"Loading time of original model: {time.perf_counter() - start_time:.2f}s")
+    tokenizer = AutoTokenizer.from_pretrained(prune_args.model_name_or_path)
+    texts = read_texts(prune_args.train_files, prune_args.text_keys) + prune_args.extra_texts
+    pruned_token_ids = find_pruned_token_ids(tokenizer, count_token_ids(tokenizer, texts), prune_args.min_count)
+    LOGGER.info(f"Keeping {len(pruned_token_ids)} of {len(tokenizer)} tokens")
+
+    num_parameters = model.num_parameters()
+    # Original model is used in parity check
+    pruned_model = prune_embeddings(copy.deepcopy(model), pruned_token_ids)
+    LOGGER.info(f"Number of parameters: {num_parameters} -> {pruned_model.num_parameters()}")
+    pruned_model.save_pretrained(prune_args.output_dir)
+    tokenizer.save_pretrained(prune_args.output_dir)
+    LOGGER.info(
+        f"Saved pruned model in: {prune_args.output_dir} ({get_directory_mb(Path(prune_args.output_dir)):.1f} MB)"
+    )
+
+    if prune_args.test_file is not None:
+        check_parity(prune_args, model)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+import json
+import logging
+import multiprocessing
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import torch
+from safetensors.torch import load_file
+from transformers import AutoConfig, HfArgumentParser, PreTrainedModel, PreTrainedTokenizerBase
+from transformers.modeling_utils import no_init_weights
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+from transformers.utils import SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME
+
+from checkpoint_store import has_manifest, load_manifest_into_model
+from distillation import get_label_token_ids, get_model_cls
+from early_exit_report import read_data
+from embedding_pruning import load_tokenizer
+from prepare_imdb import normalize_source_prefix
+
+LOGGER = logging.getLogger(__name__)
+
+Batch = tuple[np.ndarray, dict[str, torch.Tensor]]
+
+# State of worker process, model skeleton is created once and weights of evaluated checkpoints are swapped
+WORKER_STATE = {}
+
+WEIGHTS_NAMES = [SAFE_WEIGHTS_NAME, SAFE_WEIGHTS_INDEX_NAME]
+
+
+@dataclass
+class EvaluateCheckpointsArguments:
+    output_dir: str = field(metadata={"help": "Output directory of training with checkpoint-* directories"})
+    test_file: str = field(default="data/test-5k.json", metadata={"help": "JSON lines file with text and label"})
+    source_prefix: str = field(
+        default="", metadata={"help": "Source prefix of seq2seq model, e.g. 'imdb classification'"}
+    )
+    max_seq_length: int = field(default=128, metadata={"help": "Maximum number of tokens"})
+    batch_size: int = field(default=32, metadata={"help": "Batch size"})
+    max_samples: Optional[int] = field(default=None, metadata={"help": "Number of evaluated samples"})
+    num_workers: int = field(
+        default=1, metadata={"help": "Number of CPU processes evaluating checkpoints in parallel, 1 - no processes"}
+    )
+    output_file: Optional[str] = field(
+        default=None, metadata={"help": "Path to JSON with results, default: OUTPUT_DIR/checkpoints_evaluation.json"}
+    )
+
+
+@dataclass
+class CheckpointResult:
+    checkpoint: str
+    global_step: Optional[int]
+    # Mean accuracy of heads for multi-head models
+    accuracy: float
+    load_ms: float
+    ms_per_sample: float
+    head_accuracies: Optional[dict[str, float]] = None
+
+
+def find_checkpoints(output_dir: Path) -> list[Path]:
+    checkpoints = sorted(
+        output_dir.glob(f"{PREFIX_CHECKPOINT_DIR}-*"), key=lambda path: int(path.name.rsplit("-", 1)[-1])
+    )
+    # Final model is saved directly in output directory
+    checkpoints.append(output_dir)
+    found_checkpoints = []
+    for checkpoint in checkpoints:
+        if has_manifest(checkpoint) or any((checkpoint / name).exists() for name in WEIGHTS_NAMES):
+            found_checkpoints.append(checkpoint)
+        elif checkpoint != output_dir:
+            LOGGER.warning(f"Skipping checkpoint without safetensors weights (e.g. LoRA adapter): {checkpoint}")
+    return found_checkpoints
+
+
+def find_weight_files(checkpoint: Path) -> list[Path]:
+    index_path = checkpoint / SAFE_WEIGHTS_INDEX_NAME
+    if index_path.exists():
+        weight_map = json.loads(index_path.read_text())["weight_map"]
+        return [checkpoint / file_name for file_name in sorted(set(weight_map.values()))]
+    return [checkpoint / SAFE_WEIGHTS_NAME]
+
+
+def create_model_skeleton(checkpoint: Path) -> PreTrainedModel:
+    # Model is created from config - checkpoints saved with --deduplicate_checkpoints have no weight files, weights
+    # of all checkpoints are set by swap_weights
+    config = AutoConfig.from_pretrained(checkpoint)
+    model_cls = get_model_cls(config)
+    with no_init_weights():
+        model = model_cls(config) if issubclass(model_cls, PreTrainedModel) else model_cls.from_config(config)
+    # Tying is skipped without initialization of weights
+    model.tie_weights()
+    return model
+
+
+@torch.no_grad()
+def swap_weights(model: PreTrainedModel, checkpoint: Path) -> None:
+    # Checkpoints saved with --deduplicate_checkpoints
+    if has_manifest(checkpoint):
+        load_manifest_into_model(model, checkpoint)
+        return
+
+    state_dict = model.state_dict()
+    # Tied weights (e.g. LM head) are saved once
+    data_pointers = [tensor.data_ptr() for tensor in state_dict.values()]
+    tied_names = {name for name, tensor in state_dict.items() if data_pointers.count(tensor.data_ptr()) > 1}
+
+    missing_names, unexpected_names = set(state_dict.keys()), set()
+    for weight_file in find_weight_files(checkpoint):
+        # Tensors are memory mapped and copied in place into parameters of model, load hooks convert old formats
+        incompatible_keys = model.load_state_dict(load_file(weight_file, device="cpu"), strict=False)
+        missing_names &= set(incompatible_keys.missing_keys)
+        unexpected_names.update(incompatible_keys.unexpected_keys)
+    missing_names -= tied_names
+    if missing_names or unexpected_names:
+        raise ValueError(
+            f"Weights of {checkpoint} do not match model, missing: {sorted(missing_names)},"
+            f" unexpected: {sorted(unexpected_names)}"
+        )
+
+
+def create_batches(
+    tokenizer: PreTrainedTokenizerBase, texts: list[str], max_length: int, batch_size: int, source_prefix: str
+) -> list[Batch]:
+    # Batches of texts with similar length - less padding
+    order = np.argsort([len(text) for text in texts], kind="stable")
+    # The same inputs as in training by run_translation.py
+    source_prefix = normalize_source_prefix(source_prefix)
+    batches = []
+    for i in range(0, len(texts), batch_size):
+        indexes = order[i:i + batch_size]
+        batch = tokenizer(
+            [source_prefix + texts[index] for index in indexes],
+            max_length=max_length,
+            truncation=True,
+            padding=True,
+            return_tensors="pt",
+        )
+        batches.append((indexes, dict(batch)))
+    return batches
+
+
+@torch.no_grad()
+def predict_labels(model: PreTrainedModel, batches: list[Batch], label_token_ids: Optional[list[int]]) -> np.ndarray:
+    # Predictions of multi-head model: number of samples x number of heads
+    model.eval()
+    num_heads = len(getattr(model.config, "multi_head_names", None) or [])
+    predictions_shape = (sum(len(indexes) for indexes, _ in batches),) + ((num_heads,) if num_heads else ())
+    predictions = np.zeros(predictions_shape, dtype=np.int64)
+    for indexes, batch in batches:
+        batch = {key: value.to(model.device) for key, value in batch.items()}
+        if label_token_ids is not None:
+            # Seq2seq model - label with the most probable first token
+            decoder_input_ids = torch.full(
+                (len(indexes), 1), model.config.decoder_start_token_id, dtype=torch.long, device=model.device
+            )
+            logits = model(**batch, decoder_input_ids=decoder_input_ids).logits[:, 0, label_token_ids]
+        else:
+            logits = model(**batch).logits
+        predictions[indexes] = logits.argmax(dim=-1).cpu().numpy()
+    return predictions
+
+
+def evaluate_checkpoint(
+    model: PreTrainedModel,
+    checkpoint: Path,
+    batches: list[Batch],
+    labels: np.ndarray,
+    label_token_ids: Optional[list[int]],
+) -> CheckpointResult:
+    start_time = time.perf_counter()
+    swap_weights(model, checkpoint)
+    load_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    predictions = predict_labels(model, batches, label_token_ids)
+    elapsed_time = time.perf_counter() - start_time
+    global_step = checkpoint.name.rsplit("-", 1)[-1] if checkpoint.name.startswith(PREFIX_CHECKPOINT_DIR) else None
+    head_accuracies = None
+    if predictions.ndim == 2:
+        head_accuracies = {
+            name: float((predictions[:, i] == labels).mean()) for i, name in enumerate(model.config.multi_head_names)
+        }
+    return CheckpointResult(
+        checkpoint=str(checkpoint),
+        global_step=int(global_step) if global_step is not None else None,
+        accuracy=float((predictions == labels[:, None] if predictions.ndim == 2 else predictions == labels).mean()),
+        load_ms=round(load_time * 1000, 3),
+        ms_per_sample=round(elapsed_time / len(labels) * 1000, 3),
+        head_accuracies=head_accuracies,
+    )
+
+
+def init_worker(
+    checkpoint: Path,
+    batches: list[Batch],
+    labels: np.ndarray,
+    label_token_ids: Optional[list[int]],
+    num_threads: int,
+) -> None:
+    torch.set_num_threads(num_threads)
+    WORKER_STATE["model"] = create_model_skeleton(checkpoint)
+    WORKER_STATE["batches"] = batches
+    WORKER_STATE["labels"] = labels
+    WORKER_STATE["label_token_ids"] = label_token_ids
+
+
+def evaluate_checkpoint_in_worker(checkpoint: Path) -> CheckpointResult:
+    return evaluate_checkpoint(
+        WORKER_STATE["model"],
+        checkpoint,
+        WORKER_STATE["batches"],
+        WORKER_STATE["labels"],
+        WORKER_STATE["label_token_ids"],
+    )
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    parser = HfArgumentParser((EvaluateCheckpointsArguments,))
+    eval_args, = parser.parse_args_into_dataclasses()
+
+    output_dir = Path(eval_args.output_dir)
+    checkpoints = find_checkpoints(output_dir)
+    if not checkpoints:
+        raise ValueError(f"Missing checkpoints with safetensors weights in: {output_dir}")
+    LOGGER.info(f"Evaluating {len(checkpoints)} checkpoints: {[checkpoint.name for checkpoint in checkpoints]}")
+
+    # Data is tokenized once for all checkpoints, tokenizer is the same in all checkpoints of one training
+    texts, labels = read_data(Path(eval_args.test_file), eval_args.max_samples)
+    labels = np.array(labels)
+    tokenizer = load_tokenizer(str(checkpoints[0]))
+    batches = create_batches(
+        tokenizer, texts, eval_args.max_seq_length, eval_args.batch_size, eval_args.source_prefix
+    )
+    model = create_model_skeleton(checkpoints[0])
+    label_list = sorted(set(labels.tolist()))
+    label_token_ids = (
+        get_label_token_ids(tokenizer, label_list, getattr(model.config, "output_token_ids", None))
+        if model.config.is_encoder_decoder
+        else None
+    )
+
+    if eval_args.num_workers > 1:
+        # Each worker creates its own model skeleton, model of main process is not needed
+        del model
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(
+            eval_args.num_workers,
+            initializer=init_worker,
+            # Cores are split between workers
+            initargs=(
+                checkpoints[0],
+                batches,
+                labels,
+                label_token_ids,
+                max(1, (os.cpu_count() or 1) // eval_args.num_workers),
+            ),
+        ) as pool:
+            results = pool.map(evaluate_checkpoint_in_worker, checkpoints)
+    else:
+        model.to("cuda" if torch.cuda.is_available() else "cpu")
+        results = [
+            evaluate_checkpoint(model, checkpoint, batches, labels, label_token_ids) for checkpoint in checkpoints
+        ]
+
+    LOGGER.info(f"{'checkpoint':<40} {'accuracy':>10} {'load ms':>10} {'ms/sample':>10}")
+    for result in results:
+        LOGGER.info(
+            f"{Path(result.checkpoint).name:<40} {result.accuracy:>10.4f} {result.load_ms:>10.1f}"
+            f" {result.ms_per_sample:>10.3f}"
+        )
+        if result.head_accuracies is not None:
+            LOGGER.info(f"{'':<40} heads: {result.head_accuracies}")
+    best_result = max(results, key=lambda result: result.accuracy)
+    LOGGER.info(f"Best checkpoint: {best_result.checkpoint} (accuracy: {best_result.accuracy:.4f})")
+
+    output_path = Path(eval_args.output_file or output_dir / "checkpoints_evaluation.json")
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    output_path.write_text(json.dumps([asdict(result) for result in results], indent=2))
+    LOGGER.info(f"Saved results in: {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import logging
+import re
+import sys
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from torch import nn
+from transformers import (
+    AutoModelForSequenceClassification,
+    T5ForConditionalGeneration,
+    TrainerCallback,
+    TrainerControl,
+    TrainerState,
+    TrainingArguments,
+)
+from transformers.pytorch_utils import ALL_LAYERNORM_LAYERS
+from transformers.trainer_pt_utils import get_parameter_names
+
+from tiny_models import create_tiny_config
+
+LOGGER = logging.getLogger(__name__)
+
+# Names of module lists with transformer layers: RoBERTa (encoder.layer), GPT-2 (h), T5 (encoder.block, decoder.block)
+LAYER_STACK_NAMES = {"layer", "h", "block"}
+EMBEDDINGS_REGEX = r"(embeddings|wte|wpe|shared|embed_tokens)[.]"
+# Layer stacks of models used in training scripts, checked on tiny models
+EXPECTED_LAYER_STACKS = {
+    "roberta": {"roberta.encoder.layer"},
+    "gpt2": {"transformer.h"},
+    "t5": {"encoder.block", "decoder.block"},
+}
+
+
+@dataclass
+class FreezingArguments:
+    freeze_layers: Optional[str] = field(
+        default=None,
+        metadata={"help": "Indices of transformer layers to freeze, e.g. '0-3' or '0,2,4-5'"},
+    )
+    freeze_layers_stack: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Regex of layer stack names used with --freeze_layers, e.g. 'encoder' to freeze only T5 encoder"
+            " blocks. All stacks are used if not set"
+        },
+    )
+    freeze_embeddings: bool = field(default=False, metadata={"help": "Freeze input (and tied output) embeddings"})
+    freeze_regex: Optional[str] = field(
+        default=None,
+        metadata={"help": "Regex of parameter names to freeze, e.g. '^roberta[.]encoder[.]layer[.][0-5][.]'"},
+    )
+    unfreeze_schedule: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Gradual unfreezing schedule as 'epoch:layers' pairs, e.g. '1:8-11,2:4-7,3:all' unfreezes layers"
+            " 8-11 after first epoch, 4-7 after second and everything after third. Epochs can be fractional. Not"
+            " supported in distributed training"
+        },
+    )
+
+
+@dataclass
+class UnfreezeStep:
+    epoch: float
+    layers: Optional[list[int]]  # None - unfreeze all parameters
+
+
+def parse_layers(layers_spec: str) -> list[int]:
+    layers = []
+    for part in layers_spec.split(","):
+        part = part.strip()
+        if "-" in part:
+            start, end = part.split("-")
+            layers.extend(range(int(start), int(end) + 1))
+        else:
+            layers.append(int(part))
+    return layers
+
+
+def parse_unfreeze_schedule(schedule_spec: str) -> list[UnfreezeStep]:
+    steps = []
+    for part in re.split(r",(?=[^,]*:)", schedule_spec):
+        epoch, layers_spec = part.split(":")
+        layers = None if layers_spec.strip() == "all" else parse_layers(layers_spec)
+        steps.append(UnfreezeStep(float(epoch), layers))
+    return sorted(steps, key=lambda step: step.epoch)
+
+
+def find_layer_stacks(model: nn.Module) -> dict[str, nn.ModuleList]:
+    layer_stacks = {
+        name: module
+        for name, module in model.named_modules()
+        if isinstance(module, nn.ModuleList) and name.split(".")[-1] in LAYER_STACK_NAMES
+    }
+    # Only the outermost stacks - T5 block contains list of its sub-layers (encoder.block.0.layer)
+    return {
+        name: module
+        for name, module in layer_stacks.items()
+        if not any(name.startswith(f"{other_name}.") for other_name in layer_stacks)
+    }
+
+
+def find_layer_parameter_names(model: nn.Module, layers: list[int], stack_regex: Optional[str] = None) -> set[str]:
+    layer_stacks = find_layer_stacks(model)
+    if stack_regex is not None:
+        layer_stacks = {name: stack for name, stack in layer_stacks.items() if re.search(stack_regex, name)}
+    if not layer_stacks:
+        raise ValueError(f"Not found layer stacks in model: {model.__class__.__name__}")
+
+    parameter_names = set()
+    for stack_name, stack in layer_stacks.items():
+        for layer_index in layers:
+            if layer_index >= len(stack):
+                raise ValueError(f"Layer {layer_index} does not exist in {stack_name} ({len(stack)} layers)")
+            parameter_names.update(f"{stack_name}.{layer_index}.{name}" for name, _ in stack[layer_index].named_parameters())
+    return parameter_names
+
+
+def find_frozen_parameter_names(model: nn.Module, freezing_args: FreezingArguments) -> set[str]:
+    parameter_names = set()
+    if freezing_args.freeze_layers is not None:
+        layers = parse_layers(freezing_args.freeze_layers)
+        parameter_names.update(find_layer_parameter_names(model, layers, freezing_args.freeze_layers_stack))
+
+    for name, _ in model.named_parameters():
+        if freezing_args.freeze_embeddings and re.search(EMBEDDINGS_REGEX, name):
+            parameter_names.add(name)
+        if freezing_args.freeze_regex is not None and re.search(freezing_args.freeze_regex, name):
+            parameter_names.add(name)
+    return parameter_names
+
+
+def set_requires_grad(model: nn.Module, parameter_names: set[str], requires_grad: bool) -> list[nn.Parameter]:
+    changed_parameters = []
+    for name, param in model.named_parameters():
+        if name in parameter_names and param.requires_grad != requires_grad:
+            param.requires_grad = requires_grad
+            changed_parameters.append(param)
+    return changed_parameters
+
+
+def apply_freezing(model: nn.Module, freezing_args: FreezingArguments, world_size: int = 1) -> list[TrainerCallback]:
+    if freezing_args.unfreeze_schedule is not None and world_size > 1:
+        # DDP reduces gradients only of parameters which required them when model was wrapped - unfrozen layers
+        # would be updated with gradients of each process and replicas would diverge
+        raise ValueError("Gradual unfreezing (--unfreeze_schedule) is not supported in distributed training")
+
+    # Frozen parameters are skipped by Trainer when creating optimizer - no optimizer state for them
+    frozen_names = find_frozen_parameter_names(model, freezing_args)
+    if not frozen_names:
+        return []
+
+    frozen_parameters = set_requires_grad(model, frozen_names, requires_grad=False)
+    num_frozen = sum(param.numel() for param in frozen_parameters)
+    num_all = sum(param.numel() for param in model.parameters())
+    LOGGER.info(f"Frozen {len(frozen_parameters)} tensors: {num_frozen:,} / {num_all:,} parameters")
+
+    if freezing_args.unfreeze_schedule is None:
+        return []
+    return [GradualUnfreezingTrainerCallback(parse_unfreeze_schedule(freezing_args.unfreeze_schedule), freezing_args)]
+
+
+class GradualUnfreezingTrainerCallback(TrainerCallback):
+    def __init__(self, schedule: list[UnfreezeStep], freezing_args: FreezingArguments) -> None:
+        self.schedule = list(schedule)
+        self.freezing_args = freezing_args
+
+    def on_train_begin(
+        self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs: Any
+    ) -> None:
+        if state.epoch is not None and state.epoch > 0 and self.schedule and self.schedule[0].epoch <= state.epoch:
+            LOGGER.warning(
+                "Resuming training after unfreezing step, optimizer state from checkpoint will not match parameter"
+                " groups - restart training with updated freezing arguments instead"
+            )
+
+    def on_step_begin(
+        self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs: Any
+    ) -> None:
+        while self.schedule and state.epoch >= self.schedule[0].epoch:
+            self.unfreeze(self.schedule.pop(0), args, kwargs["model"], kwargs["optimizer"], kwargs["lr_scheduler"])
+
+    def find_parameter_names(self, step: UnfreezeStep, model: nn.Module) -> set[str]:
+        if step.layers is None:
+            return {name for name, _ in model.named_parameters()}
+        return find_layer_parameter_names(model, step.layers, self.freezing_args.freeze_layers_stack)
+
+    def unfreeze(self, step: UnfreezeStep, args: TrainingArguments, model: nn.Module, optimizer, lr_scheduler) -> None:
+        unfrozen_parameters = set_requires_grad(model, self.find_parameter_names(step, model), requires_grad=True)
+        if not unfrozen_parameters:
+            return
+
+        # Split into parameter groups with and without weight decay in the same way as Trainer
+        decay_names = {name for name in get_parameter_names(model, ALL_LAYERNORM_LAYERS) if "bias" not in name}
+        unfrozen_ids = {id(param) for param in unfrozen_parameters}
+        decay_parameters, no_decay_parameters = [], []
+        for name, param in model.named_parameters():
+            if id(param) in unfrozen_ids:
+                (decay_parameters if name in decay_names else no_decay_parameters).append(param)
+
+        current_lr = lr_scheduler.get_last_lr()[0]
+        for parameters, weight_decay in [(decay_parameters, args.weight_decay), (no_decay_parameters, 0.0)]:
+            if not parameters:
+                continue
+            optimizer.add_param_group({"params": parameters, "weight_decay": weight_decay, "lr": current_lr})
+            # New group has to follow the same LR schedule as the rest of parameters
+            lr_scheduler.base_lrs.append(lr_scheduler.base_lrs[0])
+            if hasattr(lr_scheduler, "lr_lambdas"):
+                lr_scheduler.lr_lambdas.append(lr_scheduler.lr_lambdas[0])
+
+        num_unfrozen = sum(param.numel() for param in unfrozen_parameters)
+        LOGGER.info(f"Unfrozen layers {step.layers or 'all'} at epoch {step.epoch}: {num_unfrozen:,} parameters")
+
+
+def find_unfrozen_parameter_names(model: nn.Module, callbacks: list[TrainerCallback]) -> set[str]:
+    # Parameters which become trainable later in training by gradual unfreezing
+    parameter_names = set()
+    for callback in callbacks:
+        if isinstance(callback, GradualUnfreezingTrainerCallback):
+            for step in callback.schedule:
+                parameter_names.update(callback.find_parameter_names(step, model))
+    return {name for name, param in model.named_parameters() if name in parameter_names and not param.requires_grad}
+
+
+def check_freezing(model_type: str) -> bool:
+    config = create_tiny_config(model_type, num_hidden_layers=4)
+    if model_type == "t5":
+        model = T5ForConditionalGeneration(config)
+    else:
+        model = AutoModelForSequenceClassification.from_config(config)
+
+    layer_stacks = set(find_layer_stacks(model))
+    is_correct = layer_stacks == EXPECTED_LAYER_STACKS[model_type]
+    if not is_correct:
+        LOGGER.error(f"[{model_type}] Invalid layer stacks: {sorted(layer_stacks)}")
+
+    # For T5 the same layers as --freeze_weights of run_translation.py
+    stack_regex = "^encoder[.]" if model_type == "t5" else None
+    try:
+        apply_freezing(model, FreezingArguments(freeze_layers="0-3", freeze_layers_stack=stack_regex))
+    except ValueError as error:
+        LOGGER.error(f"[{model_type}] Freezing failed: {error}")
+        return False
+    frozen_names = {name for name, param in model.named_parameters() if not param.requires_grad}
+    expected_names = {
+        name
+        for name, _ in model.named_parameters()
+        if any(
+            name.startswith(f"{stack_name}.")
+            for stack_name in layer_stacks
+            if stack_regex is None or re.search(stack_regex, stack_name)
+        )
+    }
+    if frozen_names != expected_names:
+        LOGGER.error(f"[{model_type}] Invalid frozen parameters: {sorted(frozen_names ^ expected_names)}")
+        is_correct = False
+
+    LOGGER.info(f"[{model_type}] Freezing: {'OK' if is_correct else 'FAILED'}")
+    return is_correct
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    results = [check_freezing(model_type) for model_type in EXPECTED_LAYER_STACKS]
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
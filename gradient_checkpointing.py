@@ -0,0 +1,91 @@
+import logging
+import sys
+from dataclasses import dataclass, field
+
+import torch
+from transformers import HfArgumentParser, PreTrainedModel, TrainingArguments
+
+from custom_model import MODEL_NAME_TO_CLASS
+from tiny_models import create_random_batch, create_tiny_config
+
+LOGGER = logging.getLogger(__name__)
+
+
+def prepare_gradient_checkpointing(
+    model: PreTrainedModel, training_args: TrainingArguments, use_lora: bool = False
+) -> None:
+    # Non-reentrant checkpointing works with frozen inputs (LoRA, frozen embeddings) and with heads which read
+    # hidden states of all layers, reentrant version drops gradients in both cases
+    if training_args.gradient_checkpointing_kwargs is None:
+        training_args.gradient_checkpointing_kwargs = {"use_reentrant": False}
+    elif training_args.gradient_checkpointing_kwargs.get("use_reentrant", True) and use_lora:
+        # Reentrant checkpointing requires inputs with gradient to propagate it into LoRA weights
+        model.enable_input_require_grads()
+
+    # Cache is not used in training and is not compatible with recomputation
+    if getattr(model.config, "use_cache", False):
+        model.config.use_cache = False
+    LOGGER.info(f"Using gradient checkpointing with: {training_args.gradient_checkpointing_kwargs}")
+
+
+@dataclass
+class CheckGradientCheckpointingArguments:
+    max_seq_length: int = field(default=512, metadata={"help": "Sequence length used in check"})
+    batch_size: int = field(default=2, metadata={"help": "Batch size used in check"})
+    use_reentrant: bool = field(default=False, metadata={"help": "Use reentrant checkpointing"})
+    tolerance: float = field(default=1e-5, metadata={"help": "Absolute tolerance of gradient difference"})
+
+
+def compute_gradients(model: PreTrainedModel, batch: dict[str, torch.Tensor]) -> dict[str, torch.Tensor]:
+    model.zero_grad()
+    loss = model(**batch).loss
+    loss.backward()
+    return {name: param.grad.detach().clone() for name, param in model.named_parameters() if param.grad is not None}
+
+
+def check_model(model_name: str, check_args: CheckGradientCheckpointingArguments) -> bool:
+    torch.manual_seed(42)
+    # Without dropout - gradients have to be identical with and without recomputation
+    config = create_tiny_config(model_name, max_seq_length=check_args.max_seq_length, dropout=0.0)
+    model = MODEL_NAME_TO_CLASS[model_name](config)
+    model.train()
+    batch = create_random_batch(config, check_args.batch_size, check_args.max_seq_length)
+
+    expected_gradients = compute_gradients(model, batch)
+    model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": check_args.use_reentrant})
+    model.config.use_cache = False
+    gradients = compute_gradients(model, batch)
+
+    is_correct = expected_gradients.keys() == gradients.keys()
+    if not is_correct:
+        LOGGER.error(f"[{model_name}] Missing gradients: {sorted(expected_gradients.keys() - gradients.keys())}")
+    for name, expected_gradient in expected_gradients.items():
+        if name in gradients and not torch.allclose(expected_gradient, gradients[name], atol=check_args.tolerance):
+            LOGGER.error(f"[{model_name}] Gradient mismatch in: {name}")
+            is_correct = False
+
+    # Tuple outputs of custom forward implementations have to contain hidden states only if requested
+    if config.use_hidden_states:
+        with torch.no_grad():
+            outputs = model(**batch, return_dict=False)
+            outputs_hidden = model(**batch, return_dict=False, output_hidden_states=True)
+        if len(outputs_hidden) != len(outputs) + 1 or len(outputs_hidden[2]) != config.num_hidden_layers + 1:
+            LOGGER.error(f"[{model_name}] Invalid tuple output: {len(outputs)} / {len(outputs_hidden)} elements")
+            is_correct = False
+
+    LOGGER.info(f"[{model_name}] Gradient checkpointing: {'OK' if is_correct else 'FAILED'}")
+    return is_correct
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    parser = HfArgumentParser((CheckGradientCheckpointingArguments,))
+    check_args, = parser.parse_args_into_dataclasses()
+
+    results = [check_model(model_name, check_args) for model_name in MODEL_NAME_TO_CLASS]
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import json
+import logging
+import math
+import random
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from transformers import AutoTokenizer, HfArgumentParser
+
+LOGGER = logging.getLogger(__name__)
+
+# Sequence lengths are rounded up to multiple of it (tensor cores, padding of compiled models)
+LENGTH_MULTIPLE = 8
+
+
+@dataclass
+class LengthProfilerArguments:
+    tokenizer_name: str = field(metadata={"help": "Tokenizer name or path, e.g. roberta-base"})
+    data_file: str = field(default="data/train.json", metadata={"help": "JSON lines file with texts"})
+    text_column: str = field(default="text", metadata={"help": "Name of text field"})
+    source_prefix: str = field(
+        default="", metadata={"help": "Prefix added before every text, e.g. 'imdb classification: ' for T5"}
+    )
+    max_samples: Optional[int] = field(
+        default=10000, metadata={"help": "Number of texts sampled uniformly from file, all texts if not set"}
+    )
+    candidate_lengths: list[int] = field(
+        default_factory=lambda: [64, 128, 256, 384, 512],
+        metadata={"help": "Sequence lengths for which truncation and padding are reported"},
+    )
+    coverage: float = field(
+        default=0.95, metadata={"help": "Fraction of texts not truncated with recommended sequence length"}
+    )
+    batch_size: int = field(default=24, metadata={"help": "Training batch size used in padding cost"})
+    num_buckets: int = field(default=4, metadata={"help": "Number of recommended length buckets"})
+    histogram_bin_size: int = field(default=64, metadata={"help": "Width of bins of length histogram"})
+    tokenization_batch_size: int = field(default=1000, metadata={"help": "Number of texts tokenized at once"})
+    seed: int = field(default=42, metadata={"help": "Seed of sampling texts and batches"})
+    cache_dir: Optional[str] = field(default=None, metadata={"help": "Where to store downloaded tokenizer"})
+    output_file: Optional[str] = field(default=None, metadata={"help": "Path to JSON with profile"})
+
+
+def sample_texts(file_path: Path, text_column: str, max_samples: Optional[int], seed: int) -> tuple[list[str], int]:
+    # Reservoir sampling over lines - file is read once without keeping it in memory, only sampled lines are parsed
+    rng = random.Random(seed)
+    sampled_lines: list[str] = []
+    num_lines = 0
+    with open(file_path, "rt") as f_read:
+        for line in f_read:
+            if not line.strip():
+                continue
+            num_lines += 1
+            if max_samples is None or len(sampled_lines) < max_samples:
+                sampled_lines.append(line)
+            else:
+                index = rng.randrange(num_lines)
+                if index < max_samples:
+                    sampled_lines[index] = line
+    return [json.loads(line)[text_column] for line in sampled_lines], num_lines
+
+
+def compute_lengths(tokenizer, texts: list[str], batch_size: int) -> np.ndarray:
+    lengths = []
+    for i in range(0, len(texts), batch_size):
+        # Fast tokenizer encodes batch in parallel threads, without truncation - the full length is measured
+        encoded = tokenizer(texts[i:i + batch_size], verbose=False)
+        lengths.extend(len(input_ids) for input_ids in encoded["input_ids"])
+    return np.array(lengths)
+
+
+def round_up(lengths: np.ndarray) -> np.ndarray:
+    return np.ceil(lengths / LENGTH_MULTIPLE).astype(int) * LENGTH_MULTIPLE
+
+
+def compute_dynamic_padding_tokens(lengths: np.ndarray, batch_size: int, rng: np.random.Generator) -> int:
+    # Random batches (as in training) padded to the longest sequence of batch
+    shuffled = rng.permutation(lengths)
+    batches = [shuffled[i:i + batch_size] for i in range(0, len(shuffled), batch_size)]
+    return sum(int(batch.max()) * len(batch) for batch in batches)
+
+
+def compute_bucket_padding_tokens(lengths: np.ndarray, boundaries: list[int]) -> int:
+    # Each sequence is padded to the upper boundary of its bucket
+    return int(np.array(boundaries)[np.searchsorted(boundaries, lengths)].sum())
+
+
+def find_bucket_boundaries(lengths: np.ndarray, num_buckets: int) -> list[int]:
+    """Returns upper boundaries of buckets with the smallest number of padded tokens.
+
+    Boundaries are multiples of `LENGTH_MULTIPLE`, the last one is the longest (truncated) sequence.
+    """
+    values, counts = np.unique(round_up(lengths), return_counts=True)
+    num_values = len(values)
+    num_buckets = min(num_buckets, num_values)
+    cumulative_counts = np.concatenate([[0], np.cumsum(counts)])
+
+    # cost[k][j] - the smallest cost of values[:j + 1] in k + 1 buckets, the last bucket ends with values[j]
+    cost = np.full((num_buckets, num_values), np.inf)
+    previous = np.zeros((num_buckets, num_values), dtype=int)
+    cost[0] = values * cumulative_counts[1:]
+    for k in range(1, num_buckets):
+        for j in range(k, num_values):
+            # Previous bucket ends with values[i], the last bucket contains values[i + 1:j + 1]
+            candidates = cost[k - 1, k - 1:j] + values[j] * (cumulative_counts[j + 1] - cumulative_counts[k:j + 1])
+            best = int(np.argmin(candidates))
+            cost[k, j], previous[k, j] = candidates[best], best + k - 1
+
+    boundaries, j = [], num_values - 1
+    for k in range(num_buckets - 1, -1, -1):
+        boundaries.append(int(values[j]))
+        j = previous[k, j]
+    return boundaries[::-1]
+
+
+def create_histogram(lengths: np.ndarray, bin_size: int) -> list[dict[str, int]]:
+    num_bins = int(lengths.max()) // bin_size + 1
+    counts = np.bincount(lengths // bin_size, minlength=num_bins)
+    return [
+        {"start": i * bin_size, "end": (i + 1) * bin_size, "count": int(count)} for i, count in enumerate(counts)
+    ]
+
+
+def profile_lengths(
+    lengths: np.ndarray, profiler_args: LengthProfilerArguments, max_model_length: Optional[int]
+) -> dict:
+    rng = np.random.default_rng(profiler_args.seed)
+    recommended_length = int(round_up(np.quantile(lengths, profiler_args.coverage)))
+    if max_model_length is not None:
+        recommended_length = min(recommended_length, max_model_length)
+
+    candidate_lengths = sorted(set(profiler_args.candidate_lengths) | {recommended_length})
+    candidates = []
+    for max_length in candidate_lengths:
+        truncated_lengths = np.minimum(lengths, max_length)
+        num_tokens = int(truncated_lengths.sum())
+        boundaries = find_bucket_boundaries(truncated_lengths, profiler_args.num_buckets)
+        padded_tokens = {
+            "fixed": max_length * len(lengths),
+            "dynamic": compute_dynamic_padding_tokens(truncated_lengths, profiler_args.batch_size, rng),
+            "bucketed": compute_bucket_padding_tokens(truncated_lengths, boundaries),
+        }
+        candidates.append(
+            {
+                "max_length": max_length,
+                "truncated_fraction": round(float((lengths > max_length).mean()), 4),
+                "truncated_tokens_fraction": round(1 - num_tokens / int(lengths.sum()), 4),
+                "bucket_boundaries": boundaries,
+                # Tokens processed per sample and fraction of them which are not padding
+                "tokens_per_sample": {name: round(value / len(lengths), 1) for name, value in padded_tokens.items()},
+                "efficiency": {name: round(num_tokens / value, 4) for name, value in padded_tokens.items()},
+            }
+        )
+
+    return {
+        "num_samples": len(lengths),
+        "length_stats": {
+            "mean": round(float(lengths.mean()), 1),
+            "min": int(lengths.min()),
+            "max": int(lengths.max()),
+            **{f"p{q}": int(np.percentile(lengths, q)) for q in (50, 90, 95, 99)},
+        },
+        "histogram": create_histogram(lengths, profiler_args.histogram_bin_size),
+        "candidates": candidates,
+        "recommended_max_length": recommended_length,
+        "recommended_bucket_boundaries": next(
+            candidate["bucket_boundaries"] for candidate in candidates if candidate["max_length"] == recommended_length
+        ),
+    }
+
+
+def log_profile(profile: dict) -> None:
+    LOGGER.info(f"Length statistics of {profile['num_samples']} samples: {profile['length_stats']}")
+    max_count = max(histogram_bin["count"] for histogram_bin in profile["histogram"])
+    for histogram_bin in profile["histogram"]:
+        bar = "#" * math.ceil(50 * histogram_bin["count"] / max_count)
+        LOGGER.info(f"{histogram_bin['start']:>6}-{histogram_bin['end']:<6} {histogram_bin['count']:>7} {bar}")
+
+    LOGGER.info(
+        f"{'length':>7} {'truncated':>10} {'fixed':>8} {'dynamic':>8} {'bucketed':>9}  bucket boundaries"
+        " (efficiency - fraction of non-padding tokens)"
+    )
+    for candidate in profile["candidates"]:
+        efficiency = candidate["efficiency"]
+        LOGGER.info(
+            f"{candidate['max_length']:>7} {candidate['truncated_fraction']:>10.2%} {efficiency['fixed']:>8.2%}"
+            f" {efficiency['dynamic']:>8.2%} {efficiency['bucketed']:>9.2%}  {candidate['bucket_boundaries']}"
+        )
+    LOGGER.info(
+        f"Recommended max length: {profile['recommended_max_length']},"
+        f" bucket boundaries: {profile['recommended_bucket_boundaries']}"
+    )
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    parser = HfArgumentParser((LengthProfilerArguments,))
+    profiler_args, = parser.parse_args_into_dataclasses()
+
+    texts, num_lines = sample_texts(
+        Path(profiler_args.data_file), profiler_args.text_column, profiler_args.max_samples, profiler_args.seed
+    )
+    LOGGER.info(f"Sampled {len(texts)} of {num_lines} texts from: {profiler_args.data_file}")
+    texts = [profiler_args.source_prefix + text for text in texts]
+
+    tokenizer = AutoTokenizer.from_pretrained(profiler_args.tokenizer_name, cache_dir=profiler_args.cache_dir)
+    lengths = compute_lengths(tokenizer, texts, profiler_args.tokenization_batch_size)
+    # Tokenizers without limit have huge model_max_length
+    max_model_length = tokenizer.model_max_length if tokenizer.model_max_length < 1_000_000 else None
+    profile = profile_lengths(lengths, profiler_args, max_model_length)
+    profile["data_file"] = profiler_args.data_file
+    profile["tokenizer_name"] = profiler_args.tokenizer_name
+    log_profile(profile)
+
+    if profiler_args.output_file is not None:
+        Path(profiler_args.output_file).write_text(json.dumps(profile, indent=2))
+        LOGGER.info(f"Saved profile in: {profiler_args.output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Optional
+
+import torch
+from peft import LoraConfig, PeftModel, TaskType, get_peft_model
+from transformers import PreTrainedModel
+from transformers.pytorch_utils import Conv1D
+
+from lora_targets import create_lora_plan
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class LoraArguments:
+    use_lora: bool = field(default=False, metadata={"help": "Enable LoRA"})
+    lora_r: int = field(default=8, metadata={"help": "Lora attention dimension"})
+    lora_alpha: int = field(default=32, metadata={"help": "Lora alpha"})
+    lora_dropout: float = field(default=0.1, metadata={"help": "Lora dropout"})
+    use_all_linear_layers: bool = field(default=False, metadata={"help": "Apply LoRA for all linear layers"})
+    lora_regex_pattern: str | None = field(
+        default=None,
+        metadata={
+            "help": "Regex expression of the module names to replace with Lora,"
+            " e.g. '.*decoder.*(SelfAttention|EncDecAttention).*(q|v)$'"
+        },
+    )
+    lora_parameter_budget: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Maximum number of trainable LoRA parameters, target modules (Linear and Conv1D) and rank are"
+            " selected automatically to fit in it"
+        },
+    )
+    lora_rank_choices: list[int] = field(
+        default_factory=lambda: [4, 8, 16, 32, 64],
+        metadata={"help": "LoRA ranks to choose from when using --lora_parameter_budget"},
+    )
+
+
+def find_all_linear_names(model):
+    lora_module_names = set()
+    for name, module in model.named_modules():
+        if isinstance(module, (torch.nn.Linear, Conv1D)):
+            names = name.split('.')
+            lora_module_names.add(names[0] if len(names) == 1 else names[-1])
+
+    if 'lm_head' in lora_module_names:
+        lora_module_names.remove('lm_head')
+    return list(lora_module_names)
+
+
+def print_trained_parameters(model):
+    LOGGER.info(f"Training parameters: {model.__class__.__name__}")
+    for name, param in model.named_parameters():
+        if param.requires_grad:
+            LOGGER.info(name)
+    LOGGER.info("---")
+
+
+def apply_lora(model: PreTrainedModel, lora_args: LoraArguments, task_type: TaskType, seq_length: int) -> PeftModel:
+    LOGGER.info(f"Using LoRA for task: {task_type}")
+    lora_r = lora_args.lora_r
+    if lora_args.lora_regex_pattern:
+        target_modules = lora_args.lora_regex_pattern
+    elif lora_args.lora_parameter_budget is not None:
+        lora_plan = create_lora_plan(model, lora_args.lora_parameter_budget, lora_args.lora_rank_choices, seq_length)
+        target_modules, lora_r = lora_plan.target_modules, lora_plan.rank
+    elif lora_args.use_all_linear_layers:
+        target_modules = find_all_linear_names(model)
+    else:
+        # Default target modules for model type defined in PEFT
+        target_modules = None
+
+    peft_config = LoraConfig(
+        task_type=task_type,
+        inference_mode=False,
+        r=lora_r,
+        lora_alpha=lora_args.lora_alpha,
+        lora_dropout=lora_args.lora_dropout,
+        target_modules=target_modules,
+    )
+    model = get_peft_model(model, peft_config)
+    model.print_trainable_parameters()
+    print_trained_parameters(model)
+    return model
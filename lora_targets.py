@@ -0,0 +1,166 @@
+import logging
+import re
+from dataclasses import dataclass, field
+
+from torch import nn
+from transformers import AutoModelForSequenceClassification, HfArgumentParser, PreTrainedModel
+from transformers.pytorch_utils import Conv1D
+
+LOGGER = logging.getLogger(__name__)
+
+# Classification heads are trained in full by PEFT (modules_to_save), LM head is tied with embeddings
+EXCLUDED_MODULE_NAMES = {"lm_head", "classifier", "score"}
+
+
+@dataclass
+class LoraTargetCandidate:
+    name: str
+    module_type: str
+    in_features: int
+    out_features: int
+
+    @property
+    def group(self) -> str:
+        # The same module in every layer, e.g. transformer.h.*.attn.c_attn
+        return re.sub(r"[.][0-9]+[.]", ".*.", self.name)
+
+    @property
+    def parameters(self) -> int:
+        return self.in_features * self.out_features
+
+    @property
+    def flops_per_token(self) -> int:
+        return 2 * self.parameters
+
+    def lora_parameters(self, rank: int) -> int:
+        return rank * (self.in_features + self.out_features)
+
+    def lora_flops_per_token(self, rank: int) -> int:
+        return 2 * self.lora_parameters(rank)
+
+
+@dataclass
+class LoraTargetPlan:
+    rank: int
+    candidates: list[LoraTargetCandidate]
+
+    @property
+    def target_modules(self) -> list[str]:
+        return [candidate.name for candidate in self.candidates]
+
+    @property
+    def trainable_parameters(self) -> int:
+        return sum(candidate.lora_parameters(self.rank) for candidate in self.candidates)
+
+    @property
+    def flops_per_token(self) -> int:
+        return sum(candidate.lora_flops_per_token(self.rank) for candidate in self.candidates)
+
+
+def find_lora_candidates(model: nn.Module) -> list[LoraTargetCandidate]:
+    candidates = []
+    for name, module in model.named_modules():
+        if EXCLUDED_MODULE_NAMES.intersection(name.split(".")):
+            continue
+
+        if isinstance(module, nn.Linear):
+            in_features, out_features = module.in_features, module.out_features
+        elif isinstance(module, Conv1D):
+            # GPT-2 Conv1D keeps transposed weight: (in_features, out_features)
+            in_features, out_features = module.weight.shape
+        else:
+            continue
+        candidates.append(LoraTargetCandidate(name, module.__class__.__name__, in_features, out_features))
+    return candidates
+
+
+def group_candidates(candidates: list[LoraTargetCandidate]) -> dict[str, list[LoraTargetCandidate]]:
+    groups: dict[str, list[LoraTargetCandidate]] = {}
+    for candidate in candidates:
+        groups.setdefault(candidate.group, []).append(candidate)
+    return groups
+
+
+def plan_lora_targets(
+    candidates: list[LoraTargetCandidate], parameter_budget: int, rank_choices: list[int]
+) -> LoraTargetPlan:
+    groups = group_candidates(candidates)
+    selected_groups = list(groups.keys())
+    min_rank = min(rank_choices)
+    while selected_groups:
+        selected = [candidate for group in selected_groups for candidate in groups[group]]
+        # Prefer covering more modules, then the highest rank which fits in budget
+        for rank in sorted(rank_choices, reverse=True):
+            plan = LoraTargetPlan(rank, selected)
+            if plan.trainable_parameters <= parameter_budget:
+                return plan
+
+        # Drop module group with the most expensive adapters
+        most_expensive_group = max(
+            selected_groups, key=lambda g: sum(c.lora_flops_per_token(min_rank) for c in groups[g])
+        )
+        selected_groups.remove(most_expensive_group)
+
+    raise ValueError(f"LoRA parameter budget {parameter_budget} is too small for any target module at rank {min_rank}")
+
+
+def log_lora_candidates(candidates: list[LoraTargetCandidate], seq_length: int, rank: int) -> None:
+    LOGGER.info(f"LoRA target candidates (FLOPs for sequence length {seq_length}, LoRA rank {rank}):")
+    for group, group_modules in group_candidates(candidates).items():
+        candidate = group_modules[0]
+        LOGGER.info(
+            f"  {group} ({candidate.module_type} {candidate.in_features}x{candidate.out_features}, "
+            f"{len(group_modules)} modules): "
+            f"params={candidate.parameters * len(group_modules):,} "
+            f"GFLOPs={candidate.flops_per_token * len(group_modules) * seq_length / 1e9:.3f} "
+            f"LoRA params={candidate.lora_parameters(rank) * len(group_modules):,} "
+            f"LoRA GFLOPs={candidate.lora_flops_per_token(rank) * len(group_modules) * seq_length / 1e9:.3f}"
+        )
+
+
+def log_lora_plan(plan: LoraTargetPlan, seq_length: int) -> None:
+    groups = list(group_candidates(plan.candidates).keys())
+    LOGGER.info(
+        f"LoRA plan: rank={plan.rank} modules={len(plan.candidates)} trainable params={plan.trainable_parameters:,} "
+        f"extra GFLOPs per sequence={plan.flops_per_token * seq_length / 1e9:.3f}"
+    )
+    LOGGER.info(f"LoRA target groups: {groups}")
+
+
+def create_lora_plan(
+    model: PreTrainedModel, parameter_budget: int, rank_choices: list[int], seq_length: int
+) -> LoraTargetPlan:
+    candidates = find_lora_candidates(model)
+    log_lora_candidates(candidates, seq_length, min(rank_choices))
+    plan = plan_lora_targets(candidates, parameter_budget, rank_choices)
+    log_lora_plan(plan, seq_length)
+    return plan
+
+
+@dataclass
+class LoraPlanArguments:
+    model_name_or_path: str = field(
+        metadata={"help": "Path to pretrained model or model identifier from huggingface.co/models"}
+    )
+    lora_parameter_budget: int = field(metadata={"help": "Maximum number of trainable LoRA parameters"})
+    lora_rank_choices: list[int] = field(
+        default_factory=lambda: [4, 8, 16, 32, 64], metadata={"help": "LoRA ranks to choose from"}
+    )
+    max_seq_length: int = field(default=128, metadata={"help": "Sequence length used to report FLOPs"})
+    cache_dir: str | None = field(
+        default=None,
+        metadata={"help": "Where do you want to store the pretrained models downloaded from huggingface.co"},
+    )
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    parser = HfArgumentParser((LoraPlanArguments,))
+    plan_args, = parser.parse_args_into_dataclasses()
+
+    model = AutoModelForSequenceClassification.from_pretrained(plan_args.model_name_or_path, cache_dir=plan_args.cache_dir)
+    create_lora_plan(model, plan_args.lora_parameter_budget, plan_args.lora_rank_choices, plan_args.max_seq_length)
+
+
+if __name__ == "__main__":
+    main()
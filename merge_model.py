@@ -2,11 +2,16 @@ import logging
 from dataclasses import dataclass, field
 from typing import Optional
 
-from peft import PeftModel
-from transformers import AutoModelForSequenceClassification, AutoTokenizer, HfArgumentParser
+from peft import PeftConfig, PeftModel
+from transformers import AutoModelForSeq2SeqLM, AutoModelForSequenceClassification, AutoTokenizer, HfArgumentParser
 
 LOGGER = logging.getLogger(__name__)
 
+TASK_TYPE_TO_MODEL_CLASS = {
+    "SEQ_CLS": AutoModelForSequenceClassification,
+    "SEQ_2_SEQ_LM": AutoModelForSeq2SeqLM,
+}
+
 
 @dataclass
 class MergeLoraArguments:
@@ -30,8 +35,13 @@ def main() -> None:
     parser = HfArgumentParser((MergeLoraArguments,))
     merge_lora_arguments, = parser.parse_args_into_dataclasses()
 
-    LOGGER.info(f"Loading base model: {merge_lora_arguments.base_model_name_or_path}")
-    model = AutoModelForSequenceClassification.from_pretrained(merge_lora_arguments.base_model_name_or_path, cache_dir=merge_lora_arguments.cache_dir)
+    peft_config = PeftConfig.from_pretrained(merge_lora_arguments.peft_model_name_or_path, cache_dir=merge_lora_arguments.cache_dir)
+    if peft_config.task_type not in TASK_TYPE_TO_MODEL_CLASS:
+        raise ValueError(f"Unsupported PEFT task type: {peft_config.task_type}")
+    model_cls = TASK_TYPE_TO_MODEL_CLASS[peft_config.task_type]
+
+    LOGGER.info(f"Loading base model: {merge_lora_arguments.base_model_name_or_path} ({model_cls.__name__})")
+    model = model_cls.from_pretrained(merge_lora_arguments.base_model_name_or_path, cache_dir=merge_lora_arguments.cache_dir)
     tokenizer = AutoTokenizer.from_pretrained(merge_lora_arguments.base_model_name_or_path, cache_dir=merge_lora_arguments.cache_dir)
 
     LOGGER.info(f"Loading PEFT model: {merge_lora_arguments.peft_model_name_or_path}")
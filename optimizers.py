@@ -0,0 +1,218 @@
+import logging
+import math
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+import torch
+import torch.nn.functional as F
+from transformers import Trainer, TrainingArguments
+from transformers.training_args import OptimizerNames
+
+LOGGER = logging.getLogger(__name__)
+
+MEMORY_EFFICIENT_OPTIMIZERS = ["adafactor", "adamw_8bit"]
+
+
+@dataclass
+class OptimizerArguments:
+    memory_efficient_optimizer: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Optimizer with smaller state than AdamW (8 bytes per parameter): adafactor (factored second moment,"
+                " used in pre-training of T5) or adamw_8bit (block-wise quantized moments, 2 bytes per parameter)."
+                " If not set, --optim is used"
+            ),
+            "choices": MEMORY_EFFICIENT_OPTIMIZERS,
+        },
+    )
+    quantization_block_size: int = field(
+        default=256, metadata={"help": "Number of values sharing one scale in adamw_8bit"}
+    )
+    min_quantized_size: int = field(
+        default=4096, metadata={"help": "Smaller tensors (biases, layer norms) keep fp32 moments in adamw_8bit"}
+    )
+
+
+def quantize_blockwise(tensor: torch.Tensor, block_size: int, signed: bool) -> tuple[torch.Tensor, torch.Tensor]:
+    flat = tensor.flatten()
+    blocks = F.pad(flat, (0, -flat.numel() % block_size)).view(-1, block_size)
+    absmax = blocks.abs().amax(dim=1, keepdim=True)
+    normalized = blocks / absmax.clamp(min=torch.finfo(absmax.dtype).tiny)
+    if signed:
+        # Cube root companding - finer steps for small values, first moment is mostly close to zero
+        codes = (normalized.sign() * normalized.abs().pow(1 / 3) * 127).round().to(torch.int8)
+    else:
+        # Fourth root companding (second moment spans squared range of gradients), positive values are not rounded
+        # to zero - denominator of update would be only epsilon
+        codes = (normalized.pow(1 / 4) * 255).round()
+        codes = torch.where(normalized > 0, codes.clamp(min=1), codes).to(torch.uint8)
+    return codes, absmax
+
+
+def dequantize_blockwise(codes: torch.Tensor, absmax: torch.Tensor, shape: torch.Size, signed: bool) -> torch.Tensor:
+    if signed:
+        normalized = (codes.float() / 127).pow(3)
+    else:
+        normalized = (codes.float() / 255).pow(4)
+    return (normalized * absmax).flatten()[:math.prod(shape)].view(shape)
+
+
+class AdamW8bit(torch.optim.Optimizer):
+    """AdamW with moments quantized block-wise to 8 bits, implemented in PyTorch (works on CPU).
+
+    Each block of moments is scaled by its absolute maximum and stored as 8-bit codes with non-linear (companded)
+    levels. Moments are dequantized for the update and quantized again after it. Tensors smaller than
+    `min_quantized_size` keep fp32 moments. State is created only for parameters with gradients.
+    """
+
+    def __init__(
+        self,
+        params,
+        lr: float = 1e-3,
+        betas: tuple[float, float] = (0.9, 0.999),
+        eps: float = 1e-8,
+        weight_decay: float = 0.0,
+        block_size: int = 256,
+        min_quantized_size: int = 4096,
+    ) -> None:
+        defaults = dict(
+            lr=lr,
+            betas=betas,
+            eps=eps,
+            weight_decay=weight_decay,
+            block_size=block_size,
+            min_quantized_size=min_quantized_size,
+        )
+        super().__init__(params, defaults)
+
+    @staticmethod
+    def load_moment(state: dict[str, Any], name: str, shape: torch.Size, signed: bool) -> torch.Tensor:
+        if f"{name}_absmax" not in state:
+            return state[name]
+        return dequantize_blockwise(state[name], state[f"{name}_absmax"], shape, signed)
+
+    @staticmethod
+    def store_moment(state: dict[str, Any], name: str, moment: torch.Tensor, block_size: int, signed: bool) -> None:
+        if f"{name}_absmax" in state:
+            state[name], state[f"{name}_absmax"] = quantize_blockwise(moment, block_size, signed)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+            for param in group["params"]:
+                if param.grad is None:
+                    continue
+
+                state = self.state[param]
+                if not state:
+                    state["step"] = 0
+                    zeros = torch.zeros_like(param, dtype=torch.float32, memory_format=torch.preserve_format)
+                    if param.numel() >= group["min_quantized_size"]:
+                        block_size = group["block_size"]
+                        state["exp_avg"], state["exp_avg_absmax"] = quantize_blockwise(zeros, block_size, True)
+                        state["exp_avg_sq"], state["exp_avg_sq_absmax"] = quantize_blockwise(zeros, block_size, False)
+                    else:
+                        state["exp_avg"], state["exp_avg_sq"] = zeros, zeros.clone()
+
+                state["step"] += 1
+                grad = param.grad.float()
+                exp_avg = self.load_moment(state, "exp_avg", param.shape, signed=True)
+                exp_avg_sq = self.load_moment(state, "exp_avg_sq", param.shape, signed=False)
+                exp_avg.lerp_(grad, 1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+
+                bias_correction1 = 1 - beta1 ** state["step"]
+                bias_correction2 = 1 - beta2 ** state["step"]
+                denominator = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(group["eps"])
+                update = (exp_avg / denominator).mul_(group["lr"] / bias_correction1)
+                # Decoupled weight decay
+                if group["weight_decay"] != 0:
+                    param.mul_(1 - group["lr"] * group["weight_decay"])
+                param.sub_(update.to(param.dtype))
+
+                self.store_moment(state, "exp_avg", exp_avg, group["block_size"], signed=True)
+                self.store_moment(state, "exp_avg_sq", exp_avg_sq, group["block_size"], signed=False)
+        return loss
+
+
+class AdamW8bitTrainerMixin:
+    """Trainer creating `AdamW8bit` optimizer, parameter groups (weight decay) are created by Trainer."""
+
+    optimizer_args: OptimizerArguments
+
+    def get_optimizer_cls_and_kwargs(
+        self, args: TrainingArguments, model: Optional[torch.nn.Module] = None
+    ) -> tuple[type[torch.optim.Optimizer], dict[str, Any]]:
+        optimizer_kwargs = {
+            "lr": args.learning_rate,
+            "betas": (args.adam_beta1, args.adam_beta2),
+            "eps": args.adam_epsilon,
+            "block_size": self.optimizer_args.quantization_block_size,
+            "min_quantized_size": self.optimizer_args.min_quantized_size,
+        }
+        return AdamW8bit, optimizer_kwargs
+
+
+def apply_optimizer(
+    optimizer_args: OptimizerArguments, training_args: TrainingArguments, trainer_cls: type[Trainer]
+) -> type[Trainer]:
+    """Returns Trainer class which creates selected optimizer.
+
+    Frozen parameters (`requires_grad=False`) are not passed to optimizer by Trainer - they have no state with any
+    optimizer. Parameter groups added by gradual unfreezing get their state with the first gradient.
+    """
+    optimizer_name = optimizer_args.memory_efficient_optimizer
+    if optimizer_name is None:
+        return trainer_cls
+
+    LOGGER.info(f"Using optimizer: {optimizer_name}")
+    if optimizer_name == "adafactor":
+        # Transformers implementation, with learning rate and schedule from training arguments
+        training_args.optim = OptimizerNames.ADAFACTOR
+        return trainer_cls
+
+    # Keep name of original class in logs
+    return type(trainer_cls.__name__, (AdamW8bitTrainerMixin, trainer_cls), {"optimizer_args": optimizer_args})
+
+
+def estimate_optimizer_state_bytes(
+    parameters: list[torch.Tensor], optimizer_args: OptimizerArguments, training_args: TrainingArguments
+) -> int:
+    # Optimizer is created by Trainer after batch size probe - its state is estimated from shapes of parameters
+    optimizer_name = optimizer_args.memory_efficient_optimizer
+    if optimizer_name is None and training_args.optim == OptimizerNames.ADAFACTOR:
+        optimizer_name = "adafactor"
+
+    state_bytes = 0
+    for parameter in parameters:
+        shape, num_values = parameter.shape, parameter.numel()
+        if optimizer_name == "adafactor":
+            # Without first moment, second moment of matrices is factored into rows and columns
+            if len(shape) >= 2:
+                num_values = math.prod(shape[:-1]) + math.prod(shape[:-2]) * shape[-1]
+            state_bytes += 4 * num_values
+        elif optimizer_name == "adamw_8bit" and num_values >= optimizer_args.min_quantized_size:
+            # 8-bit codes of both moments and fp32 absolute maximum of each block
+            num_blocks = math.ceil(num_values / optimizer_args.quantization_block_size)
+            state_bytes += 2 * num_values + 2 * 4 * num_blocks
+        else:
+            # Two fp32 moments of AdamW (other optimizers of --optim are estimated in the same way)
+            state_bytes += 2 * 4 * num_values
+    return state_bytes
+
+
+def get_optimizer_state_mb(optimizer: torch.optim.Optimizer) -> float:
+    state_bytes = sum(
+        value.numel() * value.element_size()
+        for state in optimizer.state.values()
+        for value in state.values()
+        if isinstance(value, torch.Tensor)
+    )
+    return state_bytes / 2**20
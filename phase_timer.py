@@ -0,0 +1,20 @@
+import json
+import os
+import time
+from pathlib import Path
+
+# Path to JSON file where wall clock times of script phases are saved, used by benchmark_recipes.py
+PHASE_TIMINGS_ENV = "PHASE_TIMINGS_FILE"
+
+
+class PhaseTimer:
+    def __init__(self) -> None:
+        timings_path = os.environ.get(PHASE_TIMINGS_ENV)
+        self.timings_path = Path(timings_path) if timings_path else None
+        self.marks: dict[str, float] = {}
+
+    def mark(self, phase_end: str) -> None:
+        if self.timings_path is None:
+            return
+        self.marks[phase_end] = time.time()
+        self.timings_path.write_text(json.dumps(self.marks))
@@ -0,0 +1,64 @@
+import logging
+import os
+from pathlib import Path
+
+import torch
+from transformers import TrainingArguments
+
+LOGGER = logging.getLogger(__name__)
+
+PRECISION_CHOICES = ["auto", "fp32", "fp16", "bf16"]
+
+# CPU flags which provide native bf16 matmul kernels (oneDNN uses them for autocast on CPU)
+CPU_BF16_FLAGS = {"amx_bf16", "avx512_bf16"}
+
+
+def read_cpu_flags() -> set[str]:
+    cpuinfo_path = Path("/proc/cpuinfo")
+    if not cpuinfo_path.exists():
+        return set()
+
+    for line in cpuinfo_path.read_text().split("\n"):
+        if line.startswith("flags"):
+            return set(line.split(":", 1)[1].split())
+    return set()
+
+
+def has_cpu_bf16_acceleration() -> bool:
+    return len(read_cpu_flags() & CPU_BF16_FLAGS) > 0
+
+
+def uses_cuda(training_args: TrainingArguments) -> bool:
+    return torch.cuda.is_available() and not training_args.use_cpu
+
+
+def resolve_precision(precision: str, training_args: TrainingArguments) -> str:
+    use_cuda = uses_cuda(training_args)
+    if precision == "auto":
+        if use_cuda:
+            precision = "bf16" if torch.cuda.is_bf16_supported() else "fp16"
+        elif has_cpu_bf16_acceleration():
+            precision = "bf16"
+        else:
+            precision = "fp32"
+
+    if precision == "fp16" and not use_cuda:
+        raise ValueError("Mixed precision fp16 is supported only on GPU, use bf16 on CPU")
+    if precision == "bf16" and use_cuda and not torch.cuda.is_bf16_supported():
+        raise ValueError("Mixed precision bf16 is not supported by GPU, use fp16")
+    return precision
+
+
+def apply_precision(precision: str | None, training_args: TrainingArguments) -> None:
+    # Keep --fp16/--bf16 flags from TrainingArguments when precision is not selected
+    if precision is None:
+        return
+
+    precision = resolve_precision(precision, training_args)
+    training_args.fp16 = precision == "fp16"
+    training_args.bf16 = precision == "bf16"
+    # Accelerator reads mixed precision from environment, which TrainingArguments sets only on initialization
+    os.environ["ACCELERATE_MIXED_PRECISION"] = "no" if precision == "fp32" else precision
+    if precision == "bf16" and not uses_cuda(training_args):
+        LOGGER.info(f"Using bf16 autocast on CPU, native bf16 kernels: {has_cpu_bf16_acceleration()}")
+    LOGGER.info(f"Using mixed precision: {precision}")
@@ -6,6 +6,8 @@ from pathlib import Path
 
 from datasets import load_dataset
 
+from subset_selection import SubsetSelectionArguments, select_subset
+
 LOGGER = logging.getLogger(__name__)
 
 MAP_LABEL_TRANSLATION = {
@@ -14,12 +16,20 @@ MAP_LABEL_TRANSLATION = {
 }
 
 
+def normalize_source_prefix(source_prefix: str) -> str:
+    # Seq2seq models are trained with prefix "imdb classification: " - the same input format is used in inference
+    prefix = source_prefix.strip()
+    if not prefix:
+        return ""
+    if not prefix.endswith(":"):
+        prefix += ":"
+    return prefix + " "
+
+
 def save_limited_data(file_path: Path) -> None:
-    all_text = file_path.read_text().split("\n")
-    text = all_text[:2500] + all_text[-2500:]
+    # Stratified by label, length and n-gram clusters - not biased by order of file (first and last lines)
     save_path = file_path.parent / f"{file_path.stem}-5k.json"
-    save_path.write_text("\n".join(text))
-    LOGGER.info(f"Saved limited ({len(text)}) version in: {save_path}")
+    select_subset(file_path, save_path, SubsetSelectionArguments(input_file=str(file_path), subset_size=5000))
 
 
 def save_as_translations(original_save_path: Path, data_to_save: list[dict]) -> None:
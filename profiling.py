@@ -0,0 +1,213 @@
+import csv
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Optional
+
+import torch
+from transformers import TrainerCallback, TrainerControl, TrainerState, TrainingArguments
+
+LOGGER = logging.getLogger(__name__)
+
+PERFORMANCE_LOG_COLUMNS = [
+    "step",
+    "data_time",
+    "forward_time",
+    "backward_time",
+    "optimizer_time",
+    "step_time",
+    "tokens",
+    "padded_tokens",
+    "tokens_per_second",
+    "real_tokens_ratio",
+    "rss_mb",
+    "peak_allocated_mb",
+]
+
+
+@dataclass
+class ProfilingArguments:
+    profile_performance: bool = field(
+        default=False,
+        metadata={"help": "Record per step timings, throughput and memory usage into CSV file"},
+    )
+    performance_log_file: Optional[str] = field(
+        default=None,
+        metadata={"help": "Path to CSV file with per step performance, default: OUTPUT_DIR/performance.csv"},
+    )
+    profiler_steps: Optional[str] = field(
+        default=None,
+        metadata={"help": "Range of training steps traced with torch.profiler, e.g. '100-110'"},
+    )
+
+
+def parse_step_range(steps_spec: str) -> tuple[int, int]:
+    start, end = steps_spec.split("-")
+    return int(start), int(end)
+
+
+def read_rss_mb() -> float:
+    # Current resident set size - ru_maxrss is the maximum over lifetime of process, it never drops between steps
+    with open("/proc/self/statm", "rt") as f_read:
+        resident_pages = int(f_read.read().split()[1])
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def create_profiling_callbacks(profiling_args: ProfilingArguments, output_dir: str) -> list[TrainerCallback]:
+    if not profiling_args.profile_performance and profiling_args.profiler_steps is None:
+        return []
+
+    log_path = Path(profiling_args.performance_log_file or Path(output_dir) / "performance.csv")
+    profiler_steps = parse_step_range(profiling_args.profiler_steps) if profiling_args.profiler_steps else None
+    return [PerformanceProfilerTrainerCallback(log_path, profiler_steps, Path(output_dir) / "profiler_trace.json")]
+
+
+class PerformanceProfilerTrainerCallback(TrainerCallback):
+    def __init__(self, log_path: Path, profiler_steps: Optional[tuple[int, int]], trace_path: Path) -> None:
+        self.log_path = log_path
+        self.profiler_steps = profiler_steps
+        self.trace_path = trace_path
+        self.use_cuda = torch.cuda.is_available()
+
+        self.log_file = None
+        self.csv_writer = None
+        self.hooks = []
+        self.profiler = None
+        self.in_step = False
+        self.last_event_time = 0.0
+        self.reset_step()
+
+    def reset_step(self) -> None:
+        self.step_begin_time = 0.0
+        self.data_time = 0.0
+        self.forward_begin_time = 0.0
+        self.forward_time = 0.0
+        self.pre_optimizer_time = 0.0
+        self.tokens = 0
+        self.padded_tokens = 0
+
+    def now(self) -> float:
+        # Wait for queued kernels - otherwise GPU timings are assigned to the next synchronizing operation
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def forward_pre_hook(self, module: torch.nn.Module, args: tuple, kwargs: dict) -> None:
+        if not (self.in_step and module.training):
+            return
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        attention_mask = kwargs.get("attention_mask")
+        if input_ids is not None:
+            self.padded_tokens += input_ids.numel()
+            self.tokens += int(attention_mask.sum()) if attention_mask is not None else input_ids.numel()
+        self.forward_begin_time = self.now()
+
+    def forward_hook(self, module: torch.nn.Module, args: tuple, kwargs: dict, output: Any) -> None:
+        if self.in_step and module.training:
+            self.forward_time += self.now() - self.forward_begin_time
+
+    def on_train_begin(
+        self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs: Any
+    ) -> None:
+        model = kwargs["model"]
+        self.hooks = [
+            model.register_forward_pre_hook(self.forward_pre_hook, with_kwargs=True),
+            model.register_forward_hook(self.forward_hook, with_kwargs=True),
+        ]
+        if state.is_world_process_zero:
+            self.log_path.parent.mkdir(parents=True, exist_ok=True)
+            self.log_file = open(self.log_path, "wt", newline="")
+            self.csv_writer = csv.writer(self.log_file)
+            self.csv_writer.writerow(PERFORMANCE_LOG_COLUMNS)
+            LOGGER.info(f"Saving performance log into: {self.log_path}")
+        self.last_event_time = self.now()
+
+    def on_step_begin(
+        self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs: Any
+    ) -> None:
+        self.reset_step()
+        self.step_begin_time = self.now()
+        # Batches are fetched between previous step and this one (evaluation and saving are excluded)
+        self.data_time = self.step_begin_time - self.last_event_time
+        self.in_step = True
+        if self.use_cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+        if self.profiler_steps is not None and state.global_step == self.profiler_steps[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.use_cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.profiler.start()
+            LOGGER.info(f"Started torch.profiler at step: {state.global_step}")
+
+    def on_pre_optimizer_step(
+        self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs: Any
+    ) -> None:
+        self.pre_optimizer_time = self.now()
+
+    def on_step_end(
+        self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs: Any
+    ) -> None:
+        step_end_time = self.now()
+        self.in_step = False
+        step_time = step_end_time - self.step_begin_time
+        compute_time = (self.pre_optimizer_time or step_end_time) - self.step_begin_time
+
+        if self.csv_writer is not None:
+            peak_allocated_mb = torch.cuda.max_memory_allocated() / 2**20 if self.use_cuda else 0.0
+            self.csv_writer.writerow(
+                [
+                    state.global_step,
+                    f"{self.data_time:.6f}",
+                    f"{self.forward_time:.6f}",
+                    f"{max(compute_time - self.forward_time, 0.0):.6f}",
+                    f"{step_end_time - (self.pre_optimizer_time or step_end_time):.6f}",
+                    f"{step_time:.6f}",
+                    self.tokens,
+                    self.padded_tokens,
+                    f"{self.tokens / step_time if step_time > 0 else 0.0:.1f}",
+                    f"{self.tokens / self.padded_tokens if self.padded_tokens > 0 else 0.0:.4f}",
+                    f"{read_rss_mb():.1f}",
+                    f"{peak_allocated_mb:.1f}",
+                ]
+            )
+
+        if self.profiler is not None and state.global_step >= self.profiler_steps[1]:
+            self.stop_profiler()
+        self.last_event_time = self.now()
+
+    def on_log(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs: Any) -> None:
+        if self.log_file is not None:
+            self.log_file.flush()
+        self.last_event_time = self.now()
+
+    def on_evaluate(
+        self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs: Any
+    ) -> None:
+        self.last_event_time = self.now()
+
+    def on_save(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs: Any) -> None:
+        self.last_event_time = self.now()
+
+    def on_train_end(
+        self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs: Any
+    ) -> None:
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+        if self.profiler is not None:
+            self.stop_profiler()
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+            self.csv_writer = None
+
+    def stop_profiler(self) -> None:
+        self.profiler.stop()
+        self.profiler.export_chrome_trace(str(self.trace_path))
+        LOGGER.info(f"Saved torch.profiler trace in: {self.trace_path}")
+        LOGGER.info(self.profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=20))
+        self.profiler = None
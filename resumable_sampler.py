@@ -0,0 +1,252 @@
+import json
+import logging
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+import torch
+from torch.utils.data import DataLoader, Sampler
+from transformers import (
+    AutoModelForSequenceClassification,
+    Trainer,
+    TrainerCallback,
+    TrainerControl,
+    TrainerState,
+    TrainingArguments,
+)
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR, get_last_checkpoint, has_length
+
+from tiny_models import create_random_batch, create_tiny_config
+
+LOGGER = logging.getLogger(__name__)
+
+SAMPLER_STATE_NAME = "sampler_state.json"
+
+
+class ResumableRandomSampler(Sampler[int]):
+    """Random sampler which can start iteration from any position of any epoch.
+
+    Permutation of epoch is generated from `seed + epoch`, so the state is only the epoch and position in its
+    permutation. Each iteration is one epoch.
+    """
+
+    def __init__(self, num_samples: int, seed: int) -> None:
+        self.num_samples = num_samples
+        self.seed = seed
+        self.epoch = 0
+        # Position in permutation where the next iteration starts, reset after the resumed epoch
+        self.start_index = 0
+        # Epoch and start position of the last started iteration
+        self.num_iterations = 0
+        self.iteration_epoch = 0
+        self.iteration_start_index = 0
+
+    def __iter__(self) -> Iterator[int]:
+        self.num_iterations += 1
+        self.iteration_epoch, self.iteration_start_index = self.epoch, self.start_index
+        self.start_index = 0
+        generator = torch.Generator().manual_seed(self.seed + self.iteration_epoch)
+        permutation = torch.randperm(self.num_samples, generator=generator)
+        yield from permutation[self.iteration_start_index:].tolist()
+        self.epoch = self.iteration_epoch + 1
+
+    def __len__(self) -> int:
+        # Length of the whole epoch also in resumed one - Trainer computes number of steps per epoch from it
+        return self.num_samples
+
+    def state_dict(self, num_consumed_samples: int) -> dict[str, int]:
+        epoch, start_index = self.iteration_epoch, self.iteration_start_index + num_consumed_samples
+        if start_index >= self.num_samples:
+            epoch, start_index = epoch + 1, 0
+        return {"seed": self.seed, "num_samples": self.num_samples, "epoch": epoch, "start_index": start_index}
+
+    def load_state_dict(self, state: dict[str, int]) -> None:
+        if state["seed"] != self.seed or state["num_samples"] != self.num_samples:
+            raise ValueError(
+                f"Sampler state of {state['num_samples']} samples with seed {state['seed']} does not match"
+                f" training data: {self.num_samples} samples with seed {self.seed}"
+            )
+        self.epoch, self.start_index = state["epoch"], state["start_index"]
+
+
+class ResumedEpochTrainerCallback(TrainerCallback):
+    """Adds batches trained before the checkpoint to epoch of resumed training.
+
+    Trainer computes progress of epoch from batches of the current run (and skipped batches), batches not iterated by
+    the resumed sampler are not counted.
+    """
+
+    def __init__(self) -> None:
+        self.skipped_epoch_fraction = 0.0
+
+    def on_step_end(
+        self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs: Any
+    ) -> None:
+        state.epoch += self.skipped_epoch_fraction
+
+
+class ResumableSamplerTrainerMixin:
+    """Trainer saving position of training sampler in checkpoints, resumed training starts directly from it.
+
+    Checkpoints without saved position (e.g. saved by other trainer) are resumed by skipping trained batches.
+    Gradient accumulation is not supported - Trainer would count trained epochs and accumulated batches from the
+    beginning of the resumed epoch.
+    """
+
+    resumable_sampler: Optional[ResumableRandomSampler] = None
+    sampler_state: Optional[dict[str, int]] = None
+    rng_state_checkpoint: Optional[str] = None
+    counted_iteration: int = 0
+    trained_batches: int = 0
+    num_epoch_batches: int = 0
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.resumed_epoch_callback = ResumedEpochTrainerCallback()
+        # Before other callbacks - they see the corrected epoch (e.g. gradual unfreezing)
+        self.callback_handler.callbacks.insert(0, self.resumed_epoch_callback)
+
+    def _get_train_sampler(self) -> Optional[Sampler]:
+        if self.args.group_by_length or not has_length(self.train_dataset):
+            return super()._get_train_sampler()
+
+        seed = self.args.data_seed if self.args.data_seed is not None else self.args.seed
+        self.resumable_sampler = ResumableRandomSampler(len(self.train_dataset), seed)
+        if self.sampler_state is not None:
+            self.resumable_sampler.load_state_dict(self.sampler_state)
+        return self.resumable_sampler
+
+    def get_train_dataloader(self) -> DataLoader:
+        dataloader = super().get_train_dataloader()
+        # Number of steps in epoch used by Trainer for epoch of state
+        self.num_epoch_batches = len(dataloader) if has_length(dataloader) else 0
+        return dataloader
+
+    def train(self, resume_from_checkpoint: Optional[str | bool] = None, *args: Any, **kwargs: Any):
+        if self.args.gradient_accumulation_steps > 1:
+            raise ValueError(
+                "Resumable sampler does not support gradient accumulation (--gradient_accumulation_steps"
+                f" {self.args.gradient_accumulation_steps}), increase --per_device_train_batch_size instead"
+            )
+
+        if isinstance(resume_from_checkpoint, bool) and resume_from_checkpoint:
+            resume_from_checkpoint = get_last_checkpoint(self.args.output_dir)
+
+        if resume_from_checkpoint is not None and (Path(resume_from_checkpoint) / SAMPLER_STATE_NAME).exists():
+            self.sampler_state = json.loads((Path(resume_from_checkpoint) / SAMPLER_STATE_NAME).read_text())
+            self.rng_state_checkpoint = resume_from_checkpoint
+            # Sampler starts from saved position - trained batches are not skipped
+            self.args.ignore_data_skip = True
+            LOGGER.info(
+                f"Resuming sampler at epoch {self.sampler_state['epoch']},"
+                f" sample {self.sampler_state['start_index']}/{self.sampler_state['num_samples']}"
+            )
+        return super().train(resume_from_checkpoint, *args, **kwargs)
+
+    def training_step(self, model, inputs, *args: Any, **kwargs: Any):
+        if self.rng_state_checkpoint is not None:
+            # Restored before the first trained batch - the same place as when Trainer skips batches
+            self._load_rng_state(self.rng_state_checkpoint)
+            self.rng_state_checkpoint = None
+        if self.resumable_sampler is not None:
+            if self.counted_iteration != self.resumable_sampler.num_iterations:
+                self.counted_iteration, self.trained_batches = self.resumable_sampler.num_iterations, 0
+                # Batches of resumed epoch trained before the checkpoint
+                num_skipped_batches = self.resumable_sampler.iteration_start_index // (
+                    self.args.train_batch_size * self.args.world_size
+                )
+                self.resumed_epoch_callback.skipped_epoch_fraction = (
+                    num_skipped_batches / self.num_epoch_batches if self.num_epoch_batches else 0.0
+                )
+            self.trained_batches += 1
+        return super().training_step(model, inputs, *args, **kwargs)
+
+    def _save_checkpoint(self, model, trial, *args: Any, **kwargs: Any) -> None:
+        super()._save_checkpoint(model, trial, *args, **kwargs)
+        if self.resumable_sampler is None or not self.args.should_save:
+            return
+
+        # Batches of all processes are consecutive parts of the sampler permutation
+        num_consumed_samples = self.trained_batches * self.args.train_batch_size * self.args.world_size
+        checkpoint_dir = Path(self._get_output_dir(trial=trial)) / f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}"
+        state = self.resumable_sampler.state_dict(num_consumed_samples)
+        (checkpoint_dir / SAMPLER_STATE_NAME).write_text(json.dumps(state, indent=2))
+
+
+def create_resumable_trainer_cls(trainer_cls: type[Trainer]) -> type[Trainer]:
+    # Keep name of original class in logs
+    return type(trainer_cls.__name__, (ResumableSamplerTrainerMixin, trainer_cls), {})
+
+
+def train_tiny_model(
+    output_dir: Path, dataset: list[dict[str, torch.Tensor]], resume_from_checkpoint: Optional[str] = None
+) -> tuple[dict[str, torch.Tensor], list[dict[str, float]]]:
+    torch.manual_seed(42)
+    model = AutoModelForSequenceClassification.from_config(create_tiny_config("roberta"))
+    training_args = TrainingArguments(
+        output_dir=str(output_dir),
+        per_device_train_batch_size=8,
+        num_train_epochs=2,
+        learning_rate=1e-3,
+        save_strategy="steps",
+        save_steps=3,
+        logging_steps=1,
+        use_cpu=True,
+        report_to=[],
+        disable_tqdm=True,
+    )
+    trainer = create_resumable_trainer_cls(Trainer)(model=model, args=training_args, train_dataset=dataset)
+    trainer.train(resume_from_checkpoint=resume_from_checkpoint)
+    # Losses and epochs of trained steps
+    log_history = [entry for entry in trainer.state.log_history if "loss" in entry]
+    return {name: param.detach().clone() for name, param in model.named_parameters()}, log_history
+
+
+def check_resumed_training() -> bool:
+    # Last batch of epoch is not full (50 samples in batches of 8) - 7 steps per epoch, checkpoint every 3 steps
+    config = create_tiny_config("roberta")
+    batch = create_random_batch(config, 50, 32)
+    dataset = [{key: value[i] for key, value in batch.items()} for i in range(50)]
+
+    is_correct = True
+    with tempfile.TemporaryDirectory() as work_dir:
+        expected_weights, expected_log_history = train_tiny_model(Path(work_dir) / "uninterrupted", dataset)
+        checkpoints = sorted(
+            Path(work_dir, "uninterrupted").glob(f"{PREFIX_CHECKPOINT_DIR}-*"),
+            key=lambda path: int(path.name.rsplit("-", 1)[-1]),
+        )
+        for checkpoint in checkpoints:
+            weights, log_history = train_tiny_model(Path(work_dir) / checkpoint.name, dataset, str(checkpoint))
+            for name, expected_weight in expected_weights.items():
+                if not torch.allclose(expected_weight, weights[name], atol=1e-6):
+                    LOGGER.error(f"[{checkpoint.name}] Weights of resumed training differ in: {name}")
+                    is_correct = False
+                    break
+
+            # Log history of resumed training contains also steps loaded from the checkpoint
+            if len(log_history) != len(expected_log_history):
+                LOGGER.error(f"[{checkpoint.name}] Invalid number of steps: {len(log_history)}")
+                is_correct = False
+            for expected_entry, entry in zip(expected_log_history, log_history):
+                if (
+                    entry["step"] != expected_entry["step"]
+                    or abs(entry["epoch"] - expected_entry["epoch"]) > 1e-6
+                    or abs(entry["loss"] - expected_entry["loss"]) > 1e-4
+                ):
+                    LOGGER.error(f"[{checkpoint.name}] Resumed training logged: {entry}, expected: {expected_entry}")
+                    is_correct = False
+                    break
+
+    LOGGER.info(f"Resumed training from {len(checkpoints)} checkpoints: {'OK' if is_correct else 'FAILED'}")
+    return is_correct
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    if not check_resumed_training():
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+#!/usr/bin/env bash
+
+# Compare eager and compiled custom models, graph_breaks of results should be 0
+python benchmark_models.py \
+  --backends eager inductor \
+  --batch_sizes 8 32 \
+  --seq_lengths 128 512 \
+  --output_file out/benchmark/models-compile.json \
+  "$@"
@@ -0,0 +1,8 @@
+#!/usr/bin/env bash
+
+# Compare with previous revision: bash run/benchmark_models.sh --compare_file out/benchmark/models-previous.json
+python benchmark_models.py \
+  --batch_sizes 1 8 32 \
+  --seq_lengths 128 512 \
+  --output_file out/benchmark/models.json \
+  "$@"
@@ -0,0 +1,11 @@
+#!/usr/bin/env bash
+
+# Metrics from `evaluate` (accuracy, sacrebleu) have to be in HF cache already - run any recipe once with network access
+export HF_HOME=.cache/hf
+export TOKENIZERS_PARALLELISM='true'
+
+python benchmark_recipes.py \
+  --work_dir out/benchmark/recipes \
+  --num_train_samples 500 \
+  --num_eval_samples 100 \
+  "$@"
@@ -0,0 +1,16 @@
+#!/usr/bin/env bash
+
+export HF_HOME=.cache/hf
+export TOKENIZERS_PARALLELISM='true'
+
+python benchmark_tokenization.py \
+  --cache_dir .cache_training \
+  --tokenizer_name roberta-base \
+  --data_file data/train.json \
+  --max_length 128
+
+python benchmark_tokenization.py \
+  --cache_dir .cache_training \
+  --tokenizer_name google/t5-v1_1-small \
+  --data_file data/s2s-train.json \
+  --max_length 256
@@ -0,0 +1,5 @@
+#!/usr/bin/env bash
+
+python gradient_checkpointing.py \
+  --max_seq_length 512 \
+  --batch_size 2
@@ -0,0 +1,21 @@
+#!/usr/bin/env bash
+
+export HF_HOME=.cache/hf
+export TOKENIZERS_PARALLELISM='true'
+
+if [ "$#" -lt 1 ]; then
+  echo >&2 'Missing training output directory! Example:'
+  echo >&2 " bash $0 out/imdb-5k/roberta"
+  echo >&2 " bash $0 out/imdb-5k/t5_v1_1 --source_prefix 'imdb classification' --max_seq_length 256"
+  exit 1
+fi
+
+OUTPUT_DIR="$1"
+shift
+
+python evaluate_checkpoints.py \
+  --output_dir "${OUTPUT_DIR}" \
+  --test_file data/test-5k.json \
+  --batch_size 24 \
+  --max_seq_length 128 \
+  "$@"
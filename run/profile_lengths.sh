@@ -0,0 +1,17 @@
+#!/usr/bin/env bash
+
+export HF_HOME=.cache/hf
+export TOKENIZERS_PARALLELISM='true'
+
+python length_profiler.py \
+  --cache_dir .cache_training \
+  --tokenizer_name roberta-base \
+  --data_file data/train.json \
+  --output_file data/lengths-roberta.json
+
+python length_profiler.py \
+  --cache_dir .cache_training \
+  --tokenizer_name google/t5-v1_1-small \
+  --data_file data/s2s-train.json \
+  --source_prefix "imdb classification: " \
+  --output_file data/lengths-t5.json
@@ -0,0 +1,23 @@
+#!/usr/bin/env bash
+
+export HF_HOME=.cache/hf
+export TOKENIZERS_PARALLELISM='true'
+
+# Classification model trained by run/roberta_baseline.sh
+python embedding_pruning.py \
+  --model_name_or_path out/imdb-5k/roberta \
+  --output_dir out/imdb-5k/roberta-pruned \
+  --train_files data/train-5k.json data/valid-5k.json \
+  --test_file data/test-5k.json \
+  --max_seq_length 128
+
+# Seq2seq model trained by run/t5_1_1_baseline.sh - targets and source prefix have to be kept too
+python embedding_pruning.py \
+  --model_name_or_path out/imdb-5k/t5_v1_1 \
+  --output_dir out/imdb-5k/t5_v1_1-pruned \
+  --train_files data/s2s-train-5k.json data/s2s-valid-5k.json \
+  --text_keys text label \
+  --extra_texts 'imdb classification: ' \
+  --test_file data/s2s-test-5k.json \
+  --source_prefix 'imdb classification: ' \
+  --max_seq_length 256
@@ -0,0 +1,37 @@
+#!/usr/bin/env bash
+
+export HF_HOME=.cache/hf
+# Each process has its own cores - no extra tokenizer threads
+export TOKENIZERS_PARALLELISM='false'
+
+# Scaling benchmark of 1, 2, 4 and 8 processes: bash run/roberta_cpu_ddp.sh --scaling_benchmark --num_processes 8
+rm -rf out/imdb-5k/roberta-cpu-ddp
+
+python cpu_launcher.py \
+  --num_processes 4 \
+  --script run_glue.py \
+  --cache_dir .cache_training \
+  --model_name_or_path roberta-base \
+  --train_file data/train-5k.json  \
+  --validation_file data/valid-5k.json \
+  --per_device_train_batch_size 8 \
+  --per_device_eval_batch_size 24 \
+  --do_train \
+  --do_eval \
+  --max_seq_length 128 \
+  --learning_rate 2e-5 \
+  --num_train_epochs 1 \
+  --mixed_precision auto \
+  --save_strategy steps \
+  --save_steps 1000 \
+  --save_total_limit 5 \
+  --logging_strategy steps \
+  --logging_steps 50 \
+  --eval_steps 1000 \
+  --evaluation_strategy steps \
+  --metric_for_best_model 'accuracy' \
+  --greater_is_better 'True' \
+  --load_best_model_at_end 'True' \
+  --report_to=none \
+  --output_dir out/imdb-5k/roberta-cpu-ddp \
+  "$@"
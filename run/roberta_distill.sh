@@ -0,0 +1,51 @@
+#!/usr/bin/env bash
+
+export HF_HOME=.cache/hf
+export TOKENIZERS_PARALLELISM='true'
+
+# Teacher: trained model from run/roberta_baseline.sh, or T5 from run/t5_1_1_baseline.sh with its source prefix:
+#  bash run/roberta_distill.sh out/imdb-5k/t5_v1_1 'imdb classification'
+# Seq2seq teacher uses max_source_length of its training (saved in its config)
+TEACHER_PATH="${1:-out/imdb-5k/roberta}"
+TEACHER_SOURCE_PREFIX="${2:-}"
+
+rm -rf out/imdb-5k/roberta_distill
+
+python run_glue.py \
+  --cache_dir .cache_training \
+  --model_name_or_path roberta-base \
+  --teacher_model_name_or_path "${TEACHER_PATH}" \
+  --teacher_source_prefix "${TEACHER_SOURCE_PREFIX}" \
+  --teacher_logits_file out/imdb-5k/teacher_logits/roberta.npy \
+  --student_num_hidden_layers 4 \
+  --distillation_temperature 2.0 \
+  --distillation_alpha 0.5 \
+  --train_file data/train-5k.json  \
+  --validation_file data/valid-5k.json \
+  --per_device_train_batch_size 24 \
+  --per_device_eval_batch_size 24 \
+  --do_train \
+  --do_eval \
+  --max_seq_length 128 \
+  --learning_rate 5e-5 \
+  --num_train_epochs 2 \
+  --save_strategy steps \
+  --save_steps 1000 \
+  --save_total_limit 5 \
+  --logging_strategy steps \
+  --logging_steps 50 \
+  --eval_steps 1000 \
+  --evaluation_strategy steps \
+  --metric_for_best_model 'accuracy' \
+  --greater_is_better 'True' \
+  --load_best_model_at_end 'True' \
+  --report_to=none \
+  --output_dir out/imdb-5k/roberta_distill
+
+python distillation_report.py \
+  --teacher_model_name_or_path "${TEACHER_PATH}" \
+  --teacher_source_prefix "${TEACHER_SOURCE_PREFIX}" \
+  --student_model_name_or_path out/imdb-5k/roberta_distill \
+  --test_file data/test-5k.json \
+  --max_seq_length 128 \
+  --output_file out/imdb-5k/roberta_distill/distillation_report.json
@@ -0,0 +1,39 @@
+#!/usr/bin/env bash
+
+export HF_HOME=.cache/hf
+export TOKENIZERS_PARALLELISM='true'
+
+# adamw - default optimizer of Trainer
+for OPTIMIZER in adamw adafactor adamw_8bit; do
+  rm -rf "out/imdb-5k/roberta_${OPTIMIZER}"
+
+  OPTIMIZER_ARGS=()
+  if [ "${OPTIMIZER}" != "adamw" ]; then
+    OPTIMIZER_ARGS=(--memory_efficient_optimizer "${OPTIMIZER}")
+  fi
+
+  python run_glue.py \
+    --cache_dir .cache_training \
+    --model_name_or_path roberta-base \
+    "${OPTIMIZER_ARGS[@]}" \
+    --train_file data/train-5k.json  \
+    --validation_file data/valid-5k.json \
+    --per_device_train_batch_size 24 \
+    --per_device_eval_batch_size 24 \
+    --do_train \
+    --do_eval \
+    --max_seq_length 128 \
+    --learning_rate 2e-5 \
+    --num_train_epochs 1 \
+    --save_strategy no \
+    --logging_strategy steps \
+    --logging_steps 50 \
+    --report_to=none \
+    --output_dir "out/imdb-5k/roberta_${OPTIMIZER}"
+done
+
+# Optimizer state memory vs accuracy summary
+for OPTIMIZER in adamw adafactor adamw_8bit; do
+  python -c "import json, sys; r = json.load(open(sys.argv[2])); print(f\"{sys.argv[1]}\toptimizer_state_mb={r['optimizer_state_mb']:.1f}\ttrain_samples_per_second={r['train_samples_per_second']}\teval_accuracy={r['eval_accuracy']:.4f}\")" \
+    "${OPTIMIZER}" "out/imdb-5k/roberta_${OPTIMIZER}/all_results.json"
+done
@@ -0,0 +1,36 @@
+#!/usr/bin/env bash
+
+export HF_HOME=.cache/hf
+export TOKENIZERS_PARALLELISM='true'
+
+CUSTOM_MODEL="${1:-roberta_hidden}"
+
+for PRECISION in fp32 bf16; do
+  rm -rf "out/imdb-5k/${CUSTOM_MODEL}_${PRECISION}"
+
+  python run_glue.py \
+    --cache_dir .cache_training \
+    --model_name_or_path roberta-base \
+    --custom_model "${CUSTOM_MODEL}" \
+    --mixed_precision "${PRECISION}" \
+    --train_file data/train-5k.json  \
+    --validation_file data/valid-5k.json \
+    --per_device_train_batch_size 24 \
+    --per_device_eval_batch_size 24 \
+    --do_train \
+    --do_eval \
+    --max_seq_length 128 \
+    --learning_rate 2e-5 \
+    --num_train_epochs 1 \
+    --save_strategy no \
+    --logging_strategy steps \
+    --logging_steps 50 \
+    --report_to=none \
+    --output_dir "out/imdb-5k/${CUSTOM_MODEL}_${PRECISION}"
+done
+
+# Throughput vs accuracy summary
+for PRECISION in fp32 bf16; do
+  python -c "import json, sys; r = json.load(open(sys.argv[2])); print(f\"{sys.argv[1]}\ttrain_samples_per_second={r['train_samples_per_second']}\teval_samples_per_second={r['eval_samples_per_second']}\teval_accuracy={r['eval_accuracy']:.4f}\")" \
+    "${PRECISION}" "out/imdb-5k/${CUSTOM_MODEL}_${PRECISION}/all_results.json"
+done
@@ -0,0 +1,12 @@
+#!/usr/bin/env bash
+
+# Representative 10k subsets of training data (the 5k subsets are created by prepare_imdb.py)
+python subset_selection.py \
+  --input_file data/train.json \
+  --output_file data/train-10k.json \
+  --subset_size 10000
+
+python subset_selection.py \
+  --input_file data/s2s-train.json \
+  --output_file data/s2s-train-10k.json \
+  --subset_size 10000
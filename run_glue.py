@@ -26,11 +26,10 @@ from typing import Optional
 import datasets
 import evaluate
 import numpy as np
-import torch
 from datasets import load_dataset
 
 import transformers
-from peft import LoraConfig, get_peft_model, TaskType
+from peft import TaskType
 from transformers import (
     AutoConfig,
     AutoModelForSequenceClassification,
@@ -48,22 +47,23 @@ from transformers.trainer_utils import get_last_checkpoint
 from transformers.utils import check_min_version, send_example_telemetry
 from transformers.utils.versions import require_version
 
-from custom_model import (
-    GPT2ForSequenceClassificationCustom,
-    GPT2ForSequenceClassificationCustomSimple,
-    RobertaForSequenceClassificationCustom,
-    RobertaForSequenceClassificationCustomAlternative,
-    RobertaForSequenceClassificationCustomSimple,
-)
+from batch_size_tuner import BatchSizeTunerArguments, apply_batch_size_tuning
+from checkpoint_store import create_checkpoint_store_trainer_cls
+from compilation import COMPILE_BACKEND_CHOICES, apply_compile
+from custom_model import HIDDEN_STATES_NAMES, MODEL_NAME_TO_CLASS, ROBERTA_HEAD_NAME_TO_CLASS
+from distillation import SAMPLE_INDEX_COLUMN, DistillationArguments, DistillationTrainer, load_teacher_logits
+from embedding_pruning import create_remapped_tokenizer
+from freezing import FreezingArguments, apply_freezing, find_unfrozen_parameter_names
+from gradient_checkpointing import prepare_gradient_checkpointing
+from lora import LoraArguments, apply_lora
+from optimizers import OptimizerArguments, apply_optimizer, get_optimizer_state_mb
+from phase_timer import PhaseTimer
+from precision import PRECISION_CHOICES, apply_precision
+from profiling import ProfilingArguments, create_profiling_callbacks
+from resumable_sampler import create_resumable_trainer_cls
 from save_on_end_epoch import SaveOnEndEpochTrainerCallback
-
-MODEL_NAME_TO_CLASS = {
-    "roberta_simple": RobertaForSequenceClassificationCustomSimple,
-    "roberta_hidden": RobertaForSequenceClassificationCustom,
-    "roberta_hidden_v2": RobertaForSequenceClassificationCustomAlternative,
-    "gpt2_simple": GPT2ForSequenceClassificationCustomSimple,
-    "gpt2_hidden": GPT2ForSequenceClassificationCustom,
-}
+from sliding_window import SlidingWindowArguments, predict_with_sliding_windows
+from truncation import TRUNCATION_STRATEGIES, TextTruncator
 
 # Will error if the minimal version of Transformers is not installed. Remove at your own risks.
 check_min_version("4.46.0")
@@ -160,6 +160,33 @@ class DataTrainingArguments:
         default=None, metadata={"help": "A csv or a json file containing the validation data."}
     )
     test_file: Optional[str] = field(default=None, metadata={"help": "A csv or a json file containing the test data."})
+    truncation_strategy: str = field(
+        default="none",
+        metadata={
+            "help": (
+                "Tokenize only part of long texts which is kept after truncation: head, tail or head_tail (beginning"
+                " and end of text). Default none tokenizes full texts"
+            ),
+            "choices": TRUNCATION_STRATEGIES,
+        },
+    )
+    truncation_chars_per_token: float = field(
+        default=8.0,
+        metadata={"help": "Number of characters per token used to cut texts before tokenization"},
+    )
+    truncation_head_ratio: float = field(
+        default=0.25,
+        metadata={"help": "Fraction of tokens taken from beginning of text in head_tail truncation strategy"},
+    )
+    resumable_sampler: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Save position of training sampler in checkpoints, resumed training starts from it without"
+                " iterating over trained batches. Not supported with gradient accumulation"
+            )
+        },
+    )
 
     def __post_init__(self):
         if self.task_name is not None:
@@ -236,42 +263,54 @@ class ModelArguments:
             "choices": list(MODEL_NAME_TO_CLASS.keys()),
         },
     )
-
-
-@dataclass
-class LoraArguments:
-    use_lora: bool = field(default=False, metadata={"help": "Enable LoRA"})
-    lora_r: int = field(default=8, metadata={"help": "Lora attention dimension"})
-    lora_alpha: int = field(default=32, metadata={"help": "Lora alpha"})
-    lora_dropout: float = field(default=0.1, metadata={"help": "Lora dropout"})
-    use_all_linear_layers: bool = field(default=False, metadata={"help": "Apply LoRA for all linear layers"})
-    lora_regex_pattern: str | None = field(
+    early_exit_threshold: Optional[float] = field(
         default=None,
         metadata={
-            "help": "Regex expression of the module names to replace with Lora,"
-            " e.g. '.*decoder.*(SelfAttention|EncDecAttention).*(q|v)$'"
+            "help": (
+                "Probability of predicted class which stops encoder in inference of roberta_early_exit custom model,"
+                " all layers are used if not set"
+            )
+        },
+    )
+    multi_head_names: Optional[list[str]] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Heads trained together on one backbone by roberta_multi_head custom model, default: roberta_simple"
+                " roberta_hidden roberta_hidden_v2"
+            ),
+            "choices": list(ROBERTA_HEAD_NAME_TO_CLASS.keys()),
+        },
+    )
+    mixed_precision: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Autocast precision: fp32, fp16 (GPU), bf16 (GPU or CPU with AMX/AVX512) or auto to select the best"
+                " one available on the host. If not set, the --fp16/--bf16 flags are used."
+            ),
+            "choices": PRECISION_CHOICES,
+        },
+    )
+    deduplicate_checkpoints: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Save weights of checkpoints in content addressed store (OUTPUT_DIR/tensor_store), tensors which do"
+                " not change between checkpoints (e.g. frozen layers) are written once"
+            )
+        },
+    )
+    compile_backend: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Compile model with torch.compile and the selected backend, inputs are padded to a multiple of 8"
+                " to limit recompilations. If not set, the --torch_compile flags are used."
+            ),
+            "choices": COMPILE_BACKEND_CHOICES,
         },
     )
-
-
-def find_all_linear_names(model):
-    lora_module_names = set()
-    for name, module in model.named_modules():
-        if isinstance(module, torch.nn.Linear):
-            names = name.split('.')
-            lora_module_names.add(names[0] if len(names) == 1 else names[-1])
-
-    if 'lm_head' in lora_module_names:
-        lora_module_names.remove('lm_head')
-    return list(lora_module_names)
-
-
-def print_trained_parameters(model):
-    logger.info(f"Training parameters: {model.__class__.__name__}")
-    for name, param in model.named_parameters():
-        if param.requires_grad:
-            logger.info(name)
-    logger.info("---")
 
 
 def main():
@@ -279,13 +318,52 @@ def main():
     # or by passing the --help flag to this script.
     # We now keep distinct sets of args, for a cleaner separation of concerns.
 
-    parser = HfArgumentParser((ModelArguments, DataTrainingArguments, TrainingArguments, LoraArguments))
+    parser = HfArgumentParser(
+        (
+            ModelArguments,
+            DataTrainingArguments,
+            TrainingArguments,
+            LoraArguments,
+            FreezingArguments,
+            ProfilingArguments,
+            SlidingWindowArguments,
+            DistillationArguments,
+            BatchSizeTunerArguments,
+            OptimizerArguments,
+        )
+    )
     if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
         # If we pass only one argument to the script and it's the path to a json file,
         # let's parse it to get our arguments.
-        model_args, data_args, training_args, lora_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+        (
+            model_args,
+            data_args,
+            training_args,
+            lora_args,
+            freezing_args,
+            profiling_args,
+            window_args,
+            distillation_args,
+            tuner_args,
+            optimizer_args,
+        ) = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
     else:
-        model_args, data_args, training_args, lora_args = parser.parse_args_into_dataclasses()
+        (
+            model_args,
+            data_args,
+            training_args,
+            lora_args,
+            freezing_args,
+            profiling_args,
+            window_args,
+            distillation_args,
+            tuner_args,
+            optimizer_args,
+        ) = parser.parse_args_into_dataclasses()
+
+    phase_timer = PhaseTimer()
+    apply_precision(model_args.mixed_precision, training_args)
+    apply_compile(model_args.compile_backend, training_args)
 
     # Sending telemetry. Tracking the example usage helps us better allocate resources to maintain them. The
     # information sent is the one passed as arguments along with your Python/PyTorch versions.
@@ -312,7 +390,7 @@ def main():
     # Log on each process the small summary:
     logger.warning(
         f"Process rank: {training_args.local_rank}, device: {training_args.device}, n_gpu: {training_args.n_gpu}, "
-        + f"distributed training: {training_args.parallel_mode.value == 'distributed'}, 16-bits training: {training_args.fp16}"
+        + f"distributed training: {training_args.parallel_mode.value == 'distributed'}, 16-bits training: {training_args.fp16 or training_args.bf16}"
     )
     logger.info(f"Training/evaluation parameters {training_args}")
 
@@ -436,6 +514,10 @@ def main():
         token=model_args.token,
         trust_remote_code=model_args.trust_remote_code,
     )
+    if distillation_args.student_num_hidden_layers is not None:
+        # Pretrained weights are loaded only for the first layers
+        logger.info(f'Using {distillation_args.student_num_hidden_layers} layers of student model')
+        config.num_hidden_layers = distillation_args.student_num_hidden_layers
     tokenizer = AutoTokenizer.from_pretrained(
         model_args.tokenizer_name if model_args.tokenizer_name else model_args.model_name_or_path,
         cache_dir=model_args.cache_dir,
@@ -444,6 +526,9 @@ def main():
         token=model_args.token,
         trust_remote_code=model_args.trust_remote_code,
     )
+    if getattr(config, "pruned_token_ids", None):
+        # Model with pruned embeddings uses remapped token IDs
+        tokenizer = create_remapped_tokenizer(tokenizer, config.pruned_token_ids)
     custom_model = model_args.custom_model
     if custom_model is not None:
         # Check model and implementation is the same
@@ -453,8 +538,12 @@ def main():
             raise RuntimeError('Model and custom implementation should be the same type: GPT-2')
 
         # Set custom configuration in model configuration
-        config.use_hidden_states = 'hidden' in custom_model
+        config.use_hidden_states = custom_model in HIDDEN_STATES_NAMES
         logger.info(f'Using hidden states in model: {config.use_hidden_states}')
+        if model_args.early_exit_threshold is not None:
+            config.early_exit_threshold = model_args.early_exit_threshold
+        if model_args.multi_head_names is not None:
+            config.multi_head_names = model_args.multi_head_names
 
         # Get class to initialize model
         model_cls = MODEL_NAME_TO_CLASS[custom_model]
@@ -473,25 +562,32 @@ def main():
         ignore_mismatched_sizes=model_args.ignore_mismatched_sizes,
     )
 
+    freezing_callbacks = apply_freezing(model, freezing_args, training_args.world_size)
+
+    if training_args.gradient_checkpointing:
+        prepare_gradient_checkpointing(model, training_args, use_lora=lora_args.use_lora)
+
     if lora_args.use_lora:
-        logger.info("Using LoRA")
-        peft_config = LoraConfig(
-            task_type=TaskType.SEQ_CLS,
-            inference_mode=False,
-            r=lora_args.lora_r,
-            lora_alpha=lora_args.lora_alpha,
-            lora_dropout=lora_args.lora_dropout,
-            target_modules=lora_args.lora_regex_pattern if lora_args.lora_regex_pattern else find_all_linear_names(model) if lora_args.use_all_linear_layers else None,
-        )
-        model = get_peft_model(model, peft_config)
-        model.print_trainable_parameters()
-        print_trained_parameters(model)
+        model = apply_lora(model, lora_args, TaskType.SEQ_CLS, data_args.max_seq_length)
 
     if 'gpt2' in tokenizer.name_or_path and tokenizer.pad_token is None:
         logger.info(f'Set PAD token to EOS: {tokenizer.eos_token}')
         tokenizer._pad_token = tokenizer.eos_token
         model.config.pad_token_id = model.config.eos_token_id
 
+    if training_args.do_train:
+        apply_batch_size_tuning(
+            model,
+            model_args.model_name_or_path,
+            data_args.max_seq_length,
+            tuner_args,
+            training_args,
+            unfrozen_parameter_names=find_unfrozen_parameter_names(model, freezing_callbacks),
+            optimizer_args=optimizer_args,
+        )
+
+    phase_timer.mark("model_loaded")
+
     # Preprocessing the raw_datasets
     if data_args.task_name is not None:
         sentence1_key, sentence2_key = task_to_keys[data_args.task_name]
@@ -506,6 +602,11 @@ def main():
             else:
                 sentence1_key, sentence2_key = non_label_column_names[0], None
 
+    if window_args.sliding_window_inference and sentence2_key is not None:
+        raise ValueError("Sliding window inference supports only single sentence tasks")
+    if window_args.sliding_window_inference and getattr(model.config, "multi_head_names", None):
+        raise ValueError("Sliding window inference does not support multi-head models")
+
     # Padding strategy
     if data_args.pad_to_max_length:
         padding = "max_length"
@@ -547,12 +648,25 @@ def main():
         )
     max_seq_length = min(data_args.max_seq_length, tokenizer.model_max_length)
 
+    text_truncator = None
+    if data_args.truncation_strategy != "none":
+        text_truncator = TextTruncator(
+            tokenizer,
+            max_seq_length,
+            data_args.truncation_strategy,
+            chars_per_token=data_args.truncation_chars_per_token,
+            head_ratio=data_args.truncation_head_ratio,
+        )
+
     def preprocess_function(examples):
         # Tokenize the texts
         args = (
             (examples[sentence1_key],) if sentence2_key is None else (examples[sentence1_key], examples[sentence2_key])
         )
-        result = tokenizer(*args, padding=padding, max_length=max_seq_length, truncation=True)
+        if text_truncator is not None and sentence2_key is None:
+            result = text_truncator(examples[sentence1_key], padding=padding)
+        else:
+            result = tokenizer(*args, padding=padding, max_length=max_seq_length, truncation=True)
 
         # Map labels to IDs (not necessary for GLUE tasks)
         if label_to_id is not None and "label" in examples:
@@ -566,6 +680,7 @@ def main():
             load_from_cache_file=not data_args.overwrite_cache,
             desc="Running tokenizer on dataset",
         )
+    phase_timer.mark("tokenized")
     if training_args.do_train:
         if "train" not in raw_datasets:
             raise ValueError("--do_train requires a train dataset")
@@ -574,6 +689,16 @@ def main():
             max_train_samples = min(len(train_dataset), data_args.max_train_samples)
             train_dataset = train_dataset.select(range(max_train_samples))
 
+    teacher_logits = None
+    if training_args.do_train and distillation_args.teacher_model_name_or_path is not None:
+        if is_regression or sentence2_key is not None:
+            raise ValueError("Distillation supports only single sentence classification tasks")
+        with training_args.main_process_first(desc="teacher logits"):
+            teacher_logits = load_teacher_logits(
+                distillation_args, train_dataset[sentence1_key], label_list, max_seq_length, training_args.output_dir
+            )
+        train_dataset = train_dataset.add_column(SAMPLE_INDEX_COLUMN, list(range(len(train_dataset))))
+
     if training_args.do_eval:
         if "validation" not in raw_datasets and "validation_matched" not in raw_datasets:
             raise ValueError("--do_eval requires a validation dataset")
@@ -605,25 +730,52 @@ def main():
 
     # You can define your custom compute_metrics function. It takes an `EvalPrediction` object (a namedtuple with a
     # predictions and label_ids field) and has to return a dictionary string to float.
-    def compute_metrics(p: EvalPrediction):
-        preds = p.predictions[0] if isinstance(p.predictions, tuple) else p.predictions
+    def compute_head_metrics(preds, label_ids):
         preds = np.squeeze(preds) if is_regression else np.argmax(preds, axis=1)
-        result = metric.compute(predictions=preds, references=p.label_ids)
+        result = metric.compute(predictions=preds, references=label_ids)
         if len(result) > 1:
             result["combined_score"] = np.mean(list(result.values())).item()
         return result
 
+    def compute_metrics(p: EvalPrediction):
+        preds = p.predictions[0] if isinstance(p.predictions, tuple) else p.predictions
+        if preds.ndim == 2:
+            return compute_head_metrics(preds, p.label_ids)
+
+        # Multi-head model - metrics of each head and their mean (used for selection of the best checkpoint)
+        result = {}
+        head_results = [compute_head_metrics(preds[:, i], p.label_ids) for i in range(preds.shape[1])]
+        for head_name, head_result in zip(model.config.multi_head_names, head_results):
+            result.update({f"{head_name}_{k}": v for k, v in head_result.items()})
+        for key in head_results[0]:
+            result[key] = np.mean([head_result[key] for head_result in head_results]).item()
+        return result
+
     # Data collator will default to DataCollatorWithPadding when the tokenizer is passed to Trainer, so we change it if
     # we already did the padding.
     if data_args.pad_to_max_length:
         data_collator = default_data_collator
-    elif training_args.fp16:
+    elif training_args.fp16 or training_args.bf16 or training_args.torch_compile:
+        # Compiled graphs are specialized on shapes - fewer distinct lengths, fewer recompilations
         data_collator = DataCollatorWithPadding(tokenizer, pad_to_multiple_of=8)
     else:
         data_collator = None
 
     # Initialize our Trainer
-    trainer = Trainer(
+    trainer_cls, trainer_kwargs = Trainer, {}
+    if teacher_logits is not None:
+        trainer_cls = DistillationTrainer
+        trainer_kwargs = {
+            "teacher_logits": teacher_logits,
+            "temperature": distillation_args.distillation_temperature,
+            "alpha": distillation_args.distillation_alpha,
+        }
+    if data_args.resumable_sampler:
+        trainer_cls = create_resumable_trainer_cls(trainer_cls)
+    if model_args.deduplicate_checkpoints:
+        trainer_cls = create_checkpoint_store_trainer_cls(trainer_cls)
+    trainer_cls = apply_optimizer(optimizer_args, training_args, trainer_cls)
+    trainer = trainer_cls(
         model=model,
         args=training_args,
         train_dataset=train_dataset if training_args.do_train else None,
@@ -632,6 +784,9 @@ def main():
         processing_class=tokenizer,
         data_collator=data_collator,
         callbacks=[SaveOnEndEpochTrainerCallback()]
+        + freezing_callbacks
+        + create_profiling_callbacks(profiling_args, training_args.output_dir),
+        **trainer_kwargs,
     )
 
     # Training
@@ -642,17 +797,20 @@ def main():
         elif last_checkpoint is not None:
             checkpoint = last_checkpoint
         train_result = trainer.train(resume_from_checkpoint=checkpoint)
+        phase_timer.mark("trained")
         metrics = train_result.metrics
         max_train_samples = (
             data_args.max_train_samples if data_args.max_train_samples is not None else len(train_dataset)
         )
         metrics["train_samples"] = min(max_train_samples, len(train_dataset))
+        metrics["optimizer_state_mb"] = get_optimizer_state_mb(trainer.optimizer)
 
         trainer.save_model()  # Saves the tokenizer too for easy upload
 
         trainer.log_metrics("train", metrics)
         trainer.save_metrics("train", metrics)
         trainer.save_state()
+        phase_timer.mark("saved")
 
     # Evaluation
     if training_args.do_eval:
@@ -671,7 +829,18 @@ def main():
             combined = {}
 
         for eval_dataset, task in zip(eval_datasets, tasks):
-            metrics = trainer.evaluate(eval_dataset=eval_dataset)
+            if window_args.sliding_window_inference:
+                logits = predict_with_sliding_windows(
+                    trainer, eval_dataset, tokenizer, sentence1_key, max_seq_length, window_args, padding=padding
+                )
+                metrics = {
+                    f"eval_{k}": v
+                    for k, v in compute_metrics(
+                        EvalPrediction(predictions=logits, label_ids=np.array(eval_dataset["label"]))
+                    ).items()
+                }
+            else:
+                metrics = trainer.evaluate(eval_dataset=eval_dataset)
 
             max_eval_samples = (
                 data_args.max_eval_samples if data_args.max_eval_samples is not None else len(eval_dataset)
@@ -686,6 +855,8 @@ def main():
             trainer.log_metrics("eval", metrics)
             trainer.save_metrics("eval", combined if task is not None and "mnli" in task else metrics)
 
+    phase_timer.mark("evaluated")
+
     if training_args.do_predict:
         logger.info("*** Predict ***")
 
@@ -699,20 +870,35 @@ def main():
         for predict_dataset, task in zip(predict_datasets, tasks):
             # Removing the `label` columns because it contains -1 and Trainer won't like that.
             predict_dataset = predict_dataset.remove_columns("label")
-            predictions = trainer.predict(predict_dataset, metric_key_prefix="predict").predictions
-            predictions = np.squeeze(predictions) if is_regression else np.argmax(predictions, axis=1)
-
-            output_predict_file = os.path.join(training_args.output_dir, f"predict_results_{task}.txt")
-            if trainer.is_world_process_zero():
-                with open(output_predict_file, "w") as writer:
-                    logger.info(f"***** Predict results {task} *****")
-                    writer.write("index\tprediction\n")
-                    for index, item in enumerate(predictions):
-                        if is_regression:
-                            writer.write(f"{index}\t{item:3.3f}\n")
-                        else:
-                            item = label_list[item]
-                            writer.write(f"{index}\t{item}\n")
+            if window_args.sliding_window_inference:
+                predictions = predict_with_sliding_windows(
+                    trainer, predict_dataset, tokenizer, sentence1_key, max_seq_length, window_args, padding=padding
+                )
+            else:
+                predictions = trainer.predict(predict_dataset, metric_key_prefix="predict").predictions
+            # Multi-head model - separate file for each head
+            if predictions.ndim == 3:
+                file_suffixes = [f"_{head_name}" for head_name in model.config.multi_head_names]
+                head_predictions = [predictions[:, i] for i in range(predictions.shape[1])]
+            else:
+                file_suffixes, head_predictions = [""], [predictions]
+
+            for file_suffix, predictions in zip(file_suffixes, head_predictions):
+                predictions = np.squeeze(predictions) if is_regression else np.argmax(predictions, axis=1)
+
+                output_predict_file = os.path.join(
+                    training_args.output_dir, f"predict_results_{task}{file_suffix}.txt"
+                )
+                if trainer.is_world_process_zero():
+                    with open(output_predict_file, "w") as writer:
+                        logger.info(f"***** Predict results {task}{file_suffix} *****")
+                        writer.write("index\tprediction\n")
+                        for index, item in enumerate(predictions):
+                            if is_regression:
+                                writer.write(f"{index}\t{item:3.3f}\n")
+                            else:
+                                item = label_list[item]
+                                writer.write(f"{index}\t{item}\n")
 
     kwargs = {"finetuned_from": model_args.model_name_or_path, "tasks": "text-classification"}
     if data_args.task_name is not None:
@@ -725,6 +911,7 @@ def main():
         trainer.push_to_hub(**kwargs)
     else:
         trainer.create_model_card(**kwargs)
+    phase_timer.mark("finished")
 
 
 def _mp_fn(index):
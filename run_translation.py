@@ -27,10 +27,10 @@ from typing import Optional
 import datasets
 import evaluate
 import numpy as np
-import torch
 from datasets import load_dataset
 
 import transformers
+from peft import TaskType
 from transformers import (
     AutoConfig,
     AutoModelForSeq2SeqLM,
@@ -51,7 +51,26 @@ from transformers.trainer_utils import get_last_checkpoint
 from transformers.utils import check_min_version, send_example_telemetry
 from transformers.utils.versions import require_version
 
+from batch_size_tuner import BatchSizeTunerArguments, apply_batch_size_tuning
+from checkpoint_store import create_checkpoint_store_trainer_cls
+from embedding_pruning import create_remapped_tokenizer
+from freezing import FreezingArguments, apply_freezing, find_unfrozen_parameter_names
+from gradient_checkpointing import prepare_gradient_checkpointing
+from lora import LoraArguments, apply_lora
+from optimizers import OptimizerArguments, apply_optimizer, get_optimizer_state_mb
+from phase_timer import PhaseTimer
+from precision import PRECISION_CHOICES, apply_precision
+from prepare_imdb import normalize_source_prefix
+from profiling import ProfilingArguments, create_profiling_callbacks
 from save_on_end_epoch import SaveOnEndEpochTrainerCallback
+from truncation import TRUNCATION_STRATEGIES, TextTruncator
+from vocab_trimming import (
+    T5ForConditionalGenerationTrimmed,
+    find_output_token_ids,
+    from_output_ids,
+    to_output_ids,
+    trim_output_vocabulary,
+)
 
 # Will error if the minimal version of Transformers is not installed. Remove at your own risks.
 check_min_version("4.46.0")
@@ -116,7 +135,35 @@ class ModelArguments:
     )
     freeze_weights: bool = field(
         default=False,
-        metadata={"help": "Freeze encoder weights"},
+        metadata={"help": "Freeze first 4 encoder layers, alias for: --freeze_layers 0-3 --freeze_layers_stack '^encoder[.]'"},
+    )
+    trim_output_vocabulary: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Restrict decoder vocabulary (embeddings and lm_head) to tokens of targets from data files, model is"
+                " saved with trimmed vocabulary"
+            )
+        },
+    )
+    mixed_precision: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Autocast precision: fp32, fp16 (GPU), bf16 (GPU or CPU with AMX/AVX512) or auto to select the best"
+                " one available on the host. If not set, the --fp16/--bf16 flags are used."
+            ),
+            "choices": PRECISION_CHOICES,
+        },
+    )
+    deduplicate_checkpoints: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Save weights of checkpoints in content addressed store (OUTPUT_DIR/tensor_store), tensors which do"
+                " not change between checkpoints (e.g. frozen layers) are written once"
+            )
+        },
     )
 
 
@@ -237,6 +284,24 @@ class DataTrainingArguments:
     source_prefix: Optional[str] = field(
         default=None, metadata={"help": "A prefix to add before every source text (useful for T5 models)."}
     )
+    truncation_strategy: str = field(
+        default="none",
+        metadata={
+            "help": (
+                "Tokenize only part of long texts which is kept after truncation: head, tail or head_tail (beginning"
+                " and end of text). Default none tokenizes full texts"
+            ),
+            "choices": TRUNCATION_STRATEGIES,
+        },
+    )
+    truncation_chars_per_token: float = field(
+        default=8.0,
+        metadata={"help": "Number of characters per token used to cut texts before tokenization"},
+    )
+    truncation_head_ratio: float = field(
+        default=0.25,
+        metadata={"help": "Fraction of tokens taken from beginning of text in head_tail truncation strategy"},
+    )
     forced_bos_token: Optional[str] = field(
         default=None,
         metadata={
@@ -268,23 +333,36 @@ class DataTrainingArguments:
             self.val_max_target_length = self.max_target_length
 
 
-def freeze_model_weights(model: torch.nn.Module) -> None:
-    for param in model.parameters():
-        param.requires_grad = False
-
-
 def main():
     # See all possible arguments in src/transformers/training_args.py
     # or by passing the --help flag to this script.
     # We now keep distinct sets of args, for a cleaner separation of concerns.
 
-    parser = HfArgumentParser((ModelArguments, DataTrainingArguments, Seq2SeqTrainingArguments))
+    parser = HfArgumentParser(
+        (
+            ModelArguments,
+            DataTrainingArguments,
+            Seq2SeqTrainingArguments,
+            LoraArguments,
+            FreezingArguments,
+            ProfilingArguments,
+            BatchSizeTunerArguments,
+            OptimizerArguments,
+        )
+    )
     if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
         # If we pass only one argument to the script and it's the path to a json file,
         # let's parse it to get our arguments.
-        model_args, data_args, training_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+        (
+            model_args, data_args, training_args, lora_args, freezing_args, profiling_args, tuner_args, optimizer_args
+        ) = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
     else:
-        model_args, data_args, training_args = parser.parse_args_into_dataclasses()
+        (
+            model_args, data_args, training_args, lora_args, freezing_args, profiling_args, tuner_args, optimizer_args
+        ) = parser.parse_args_into_dataclasses()
+
+    phase_timer = PhaseTimer()
+    apply_precision(model_args.mixed_precision, training_args)
 
     # Sending telemetry. Tracking the example usage helps us better allocate resources to maintain them. The
     # information sent is the one passed as arguments along with your Python/PyTorch versions.
@@ -311,7 +389,7 @@ def main():
     # Log on each process the small summary:
     logger.warning(
         f"Process rank: {training_args.local_rank}, device: {training_args.device}, n_gpu: {training_args.n_gpu}, "
-        + f"distributed training: {training_args.parallel_mode.value == 'distributed'}, 16-bits training: {training_args.fp16}"
+        + f"distributed training: {training_args.parallel_mode.value == 'distributed'}, 16-bits training: {training_args.fp16 or training_args.bf16}"
     )
     logger.info(f"Training/evaluation parameters {training_args}")
 
@@ -407,7 +485,14 @@ def main():
         token=model_args.token,
         trust_remote_code=model_args.trust_remote_code,
     )
-    model = AutoModelForSeq2SeqLM.from_pretrained(
+    if getattr(config, "pruned_token_ids", None):
+        # Model with pruned embeddings uses remapped token IDs
+        tokenizer = create_remapped_tokenizer(tokenizer, config.pruned_token_ids)
+    # Model saved with trimmed output vocabulary can not be loaded by auto class
+    model_cls = AutoModelForSeq2SeqLM
+    if getattr(config, "output_token_ids", None):
+        model_cls = T5ForConditionalGenerationTrimmed
+    model = model_cls.from_pretrained(
         model_args.model_name_or_path,
         from_tf=bool(".ckpt" in model_args.model_name_or_path),
         config=config,
@@ -417,15 +502,23 @@ def main():
         trust_remote_code=model_args.trust_remote_code,
     )
 
-    if model_args.freeze_weights:
+    if model_args.trim_output_vocabulary and not getattr(config, "output_token_ids", None):
+        target_column = data_args.target_lang.split("_")[0]
+        targets = sorted({target for dataset in raw_datasets.values() for target in dataset.unique(target_column)})
+        model = trim_output_vocabulary(model, find_output_token_ids(tokenizer, targets))
+    # Decoder of trimmed model uses indexes of output tokens instead of token IDs
+    output_token_ids = getattr(model.config, "output_token_ids", None)
+
+    if model_args.freeze_weights and freezing_args.freeze_layers is None:
         logger.info("Freezing encoder weights")
 
-        # Freeze whole encoder
-        # freeze_model_weights(model.encoder)
+        # Freeze first 4 layers in encoder, use `--freeze_regex '^encoder[.]'` to freeze whole encoder
+        freezing_args.freeze_layers = "0-3"
+        freezing_args.freeze_layers_stack = "^encoder[.]"
+    freezing_callbacks = apply_freezing(model, freezing_args, training_args.world_size)
 
-        # Freeze first 4 layers in encoder
-        for i in range(4):
-            freeze_model_weights(model.encoder.block[i])
+    if training_args.gradient_checkpointing:
+        prepare_gradient_checkpointing(model, training_args, use_lora=lora_args.use_lora)
 
     # We resize the embeddings only when necessary to avoid index errors. If you are creating a model from scratch
     # on a small vocab and want a smaller embedding size, remove this test.
@@ -442,14 +535,30 @@ def main():
 
     if model.config.decoder_start_token_id is None:
         raise ValueError("Make sure that `config.decoder_start_token_id` is correctly defined")
+    # Saved with model - seq2seq teacher in distillation gets inputs of the same length as in training
+    model.config.max_source_length = data_args.max_source_length
+
+    if lora_args.use_lora:
+        model = apply_lora(model, lora_args, TaskType.SEQ_2_SEQ_LM, data_args.max_source_length)
+
+    if training_args.do_train:
+        apply_batch_size_tuning(
+            model,
+            model_args.model_name_or_path,
+            data_args.max_source_length,
+            tuner_args,
+            training_args,
+            target_length=data_args.max_target_length,
+            unfrozen_parameter_names=find_unfrozen_parameter_names(model, freezing_callbacks),
+            optimizer_args=optimizer_args,
+        )
+
+    phase_timer.mark("model_loaded")
 
     prefix = data_args.source_prefix if data_args.source_prefix is not None else ""
     if 'classification' not in prefix:
         raise RuntimeError('Not found "classification" prefix!')
-    prefix = prefix.strip()
-    if not prefix.endswith(':'):
-        prefix += ':'
-    prefix += ' '
+    prefix = normalize_source_prefix(prefix)
     logger.info(f'Using translation prefix: "{prefix!r}"')
 
     # Preprocessing the datasets.
@@ -509,11 +618,25 @@ def main():
             f"`{model.__class__.__name__}`. This will lead to loss being calculated twice and will take up more memory"
         )
 
+    text_truncator = None
+    if data_args.truncation_strategy != "none":
+        text_truncator = TextTruncator(
+            tokenizer,
+            data_args.max_source_length,
+            data_args.truncation_strategy,
+            chars_per_token=data_args.truncation_chars_per_token,
+            head_ratio=data_args.truncation_head_ratio,
+        )
+
     def preprocess_function(examples):
         inputs = [ex for ex in examples[source_lang]]
         targets = [ex for ex in examples[target_lang]]
-        inputs = [prefix + inp for inp in inputs]
-        model_inputs = tokenizer(inputs, max_length=data_args.max_source_length, padding=padding, truncation=True)
+        if text_truncator is not None:
+            # Prefix is kept whole also for tail truncation
+            model_inputs = text_truncator(inputs, padding=padding, prefix=prefix)
+        else:
+            inputs = [prefix + inp for inp in inputs]
+            model_inputs = tokenizer(inputs, max_length=data_args.max_source_length, padding=padding, truncation=True)
 
         # Tokenize targets with the `text_target` keyword argument
         labels = tokenizer(text_target=targets, max_length=max_target_length, padding=padding, truncation=True)
@@ -526,6 +649,8 @@ def main():
             ]
 
         model_inputs["labels"] = labels["input_ids"]
+        if output_token_ids is not None:
+            model_inputs["labels"] = to_output_ids(model_inputs["labels"], output_token_ids)
         return model_inputs
 
     if training_args.do_train:
@@ -581,6 +706,8 @@ def main():
                 desc="Running tokenizer on prediction dataset",
             )
 
+    phase_timer.mark("tokenized")
+
     # Data collator
     label_pad_token_id = -100 if data_args.ignore_pad_token_for_loss else tokenizer.pad_token_id
     if data_args.pad_to_max_length:
@@ -590,7 +717,7 @@ def main():
             tokenizer,
             model=model,
             label_pad_token_id=label_pad_token_id,
-            pad_to_multiple_of=8 if training_args.fp16 else None,
+            pad_to_multiple_of=8 if training_args.fp16 or training_args.bf16 else None,
         )
 
     # Metric
@@ -607,6 +734,8 @@ def main():
         preds, labels = eval_preds
         if isinstance(preds, tuple):
             preds = preds[0]
+        if output_token_ids is not None:
+            preds, labels = from_output_ids(preds, output_token_ids), from_output_ids(labels, output_token_ids)
         # Replace -100s used for padding as we can't decode them
         preds = np.where(preds != -100, preds, tokenizer.pad_token_id)
         decoded_preds = tokenizer.batch_decode(preds, skip_special_tokens=True)
@@ -628,7 +757,11 @@ def main():
         return result
 
     # Initialize our Trainer
-    trainer = Seq2SeqTrainer(
+    trainer_cls = Seq2SeqTrainer
+    if model_args.deduplicate_checkpoints:
+        trainer_cls = create_checkpoint_store_trainer_cls(trainer_cls)
+    trainer_cls = apply_optimizer(optimizer_args, training_args, trainer_cls)
+    trainer = trainer_cls(
         model=model,
         args=training_args,
         train_dataset=train_dataset if training_args.do_train else None,
@@ -636,7 +769,9 @@ def main():
         processing_class=tokenizer,
         data_collator=data_collator,
         compute_metrics=compute_metrics if training_args.predict_with_generate else None,
-        callbacks=[SaveOnEndEpochTrainerCallback()],
+        callbacks=[SaveOnEndEpochTrainerCallback()]
+        + freezing_callbacks
+        + create_profiling_callbacks(profiling_args, training_args.output_dir),
     )
 
     # Training
@@ -647,6 +782,7 @@ def main():
         elif last_checkpoint is not None:
             checkpoint = last_checkpoint
         train_result = trainer.train(resume_from_checkpoint=checkpoint)
+        phase_timer.mark("trained")
         trainer.save_model()  # Saves the tokenizer too for easy upload
 
         metrics = train_result.metrics
@@ -654,10 +790,12 @@ def main():
             data_args.max_train_samples if data_args.max_train_samples is not None else len(train_dataset)
         )
         metrics["train_samples"] = min(max_train_samples, len(train_dataset))
+        metrics["optimizer_state_mb"] = get_optimizer_state_mb(trainer.optimizer)
 
         trainer.log_metrics("train", metrics)
         trainer.save_metrics("train", metrics)
         trainer.save_state()
+        phase_timer.mark("saved")
 
     # Evaluation
     results = {}
@@ -677,6 +815,8 @@ def main():
         trainer.log_metrics("eval", metrics)
         trainer.save_metrics("eval", metrics)
 
+    phase_timer.mark("evaluated")
+
     if training_args.do_predict:
         logger.info("*** Predict ***")
 
@@ -695,6 +835,8 @@ def main():
         if trainer.is_world_process_zero():
             if training_args.predict_with_generate:
                 predictions = predict_results.predictions
+                if output_token_ids is not None:
+                    predictions = from_output_ids(predictions, output_token_ids)
                 predictions = np.where(predictions != -100, predictions, tokenizer.pad_token_id)
                 predictions = tokenizer.batch_decode(
                     predictions, skip_special_tokens=True, clean_up_tokenization_spaces=True
@@ -721,6 +863,7 @@ def main():
         trainer.push_to_hub(**kwargs)
     else:
         trainer.create_model_card(**kwargs)
+    phase_timer.mark("finished")
 
     return results
 
@@ -0,0 +1,139 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Optional, Union
+
+import numpy as np
+from datasets import Dataset
+from transformers import PreTrainedTokenizerBase, Trainer
+
+LOGGER = logging.getLogger(__name__)
+
+WINDOW_AGGREGATIONS = ["mean", "max", "attention"]
+
+
+@dataclass
+class SlidingWindowArguments:
+    sliding_window_inference: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Evaluate and predict on overlapping windows covering whole texts instead of truncated texts, logits"
+                " of windows are aggregated per text"
+            )
+        },
+    )
+    window_overlap: int = field(default=32, metadata={"help": "Number of tokens shared by consecutive windows"})
+    window_aggregation: str = field(
+        default="mean",
+        metadata={
+            "help": (
+                "Aggregation of window logits: mean, max or attention (mean weighted by softmax over windows of"
+                " confidence - margin between two best logits)"
+            ),
+            "choices": WINDOW_AGGREGATIONS,
+        },
+    )
+    window_attention_temperature: float = field(
+        default=1.0, metadata={"help": "Temperature of softmax over windows in attention aggregation"}
+    )
+    max_windows_per_text: Optional[int] = field(
+        default=None, metadata={"help": "Use only first N windows of each text, all windows if not set"}
+    )
+
+
+def create_window_dataset(
+    dataset: Dataset,
+    tokenizer: PreTrainedTokenizerBase,
+    text_key: str,
+    max_length: int,
+    window_args: SlidingWindowArguments,
+    padding: Union[bool, str] = False,
+) -> Dataset:
+    if not tokenizer.is_fast:
+        raise ValueError("Sliding window inference requires fast tokenizer (overflowing tokens of batch)")
+
+    def tokenize_windows(examples, indexes):
+        result = tokenizer(
+            examples[text_key],
+            padding=padding,
+            max_length=max_length,
+            truncation=True,
+            stride=window_args.window_overlap,
+            return_overflowing_tokens=True,
+        )
+        result["text_index"] = [indexes[i] for i in result.pop("overflow_to_sample_mapping")]
+        return result
+
+    windows = dataset.map(
+        tokenize_windows,
+        batched=True,
+        with_indices=True,
+        remove_columns=dataset.column_names,
+        desc="Running tokenizer on windows",
+    )
+
+    text_indexes = np.array(windows["text_index"])
+    keep = np.ones(len(windows), dtype=bool)
+    if window_args.max_windows_per_text is not None:
+        # Windows of a text are consecutive - position of window in text is distance from the first one
+        starts = np.flatnonzero(np.r_[True, np.diff(text_indexes) != 0])
+        positions = np.arange(len(text_indexes)) - np.repeat(starts, np.diff(np.r_[starts, len(text_indexes)]))
+        keep = positions < window_args.max_windows_per_text
+
+    # Windows of different texts are batched together, sorting by length keeps padding only in the last batches
+    lengths = np.array([len(input_ids) for input_ids in windows["input_ids"]])
+    order = np.flatnonzero(keep)[np.argsort(-lengths[keep], kind="stable")]
+    LOGGER.info(f"Created {len(order)} windows for {len(dataset)} texts")
+    return windows.select(order)
+
+
+def aggregate_window_logits(
+    logits: np.ndarray, text_indexes: np.ndarray, num_texts: int, aggregation: str, temperature: float = 1.0
+) -> np.ndarray:
+    logits = logits.astype(np.float64)
+    if aggregation == "max":
+        result = np.full((num_texts, logits.shape[1]), -np.inf)
+        np.maximum.at(result, text_indexes, logits)
+        return result
+
+    if aggregation == "mean" or (aggregation == "attention" and logits.shape[1] == 1):
+        # Regression has single logit without confidence - attention is the same as mean
+        scores = np.zeros(len(logits))
+    elif aggregation == "attention":
+        # Confidence of window - margin between two best logits
+        sorted_logits = np.sort(logits, axis=1)
+        scores = (sorted_logits[:, -1] - sorted_logits[:, -2]) / temperature
+    else:
+        raise ValueError(f"Unknown window aggregation: {aggregation}")
+
+    # Softmax over windows of each text, maximum is subtracted for numerical stability
+    max_scores = np.full(num_texts, -np.inf)
+    np.maximum.at(max_scores, text_indexes, scores)
+    weights = np.exp(scores - max_scores[text_indexes])
+    weighted_sums = np.zeros((num_texts, logits.shape[1]))
+    np.add.at(weighted_sums, text_indexes, logits * weights[:, None])
+    weight_sums = np.zeros(num_texts)
+    np.add.at(weight_sums, text_indexes, weights)
+    return weighted_sums / weight_sums[:, None]
+
+
+def predict_with_sliding_windows(
+    trainer: Trainer,
+    dataset: Dataset,
+    tokenizer: PreTrainedTokenizerBase,
+    text_key: str,
+    max_length: int,
+    window_args: SlidingWindowArguments,
+    padding: Union[bool, str] = False,
+) -> np.ndarray:
+    windows = create_window_dataset(dataset, tokenizer, text_key, max_length, window_args, padding=padding)
+    text_indexes = np.array(windows["text_index"])
+    predictions = trainer.predict(windows.remove_columns("text_index"), metric_key_prefix="windows").predictions
+    logits = predictions[0] if isinstance(predictions, tuple) else predictions
+    return aggregate_window_logits(
+        logits.reshape(len(text_indexes), -1),
+        text_indexes,
+        len(dataset),
+        window_args.window_aggregation,
+        window_args.window_attention_temperature,
+    )
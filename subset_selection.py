@@ -0,0 +1,166 @@
+import heapq
+import json
+import logging
+import math
+import random
+import zlib
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Hashable, Optional
+
+import numpy as np
+from transformers import HfArgumentParser
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class SubsetSelectionArguments:
+    input_file: str = field(metadata={"help": "JSON lines file with texts, e.g. data/train.json"})
+    output_file: Optional[str] = field(default=None, metadata={"help": "Path of subset, default: <input>-subset.json"})
+    subset_size: int = field(default=5000, metadata={"help": "Number of selected lines"})
+    text_column: str = field(default="text", metadata={"help": "Name of text field"})
+    label_column: Optional[str] = field(default="label", metadata={"help": "Name of label field, not used if empty"})
+    ngram_size: int = field(default=2, metadata={"help": "Longest word n-gram used in text features"})
+    num_cluster_bits: int = field(
+        default=3, metadata={"help": "Number of random hyperplanes, texts are grouped into 2^bits clusters"}
+    )
+    warmup_size: int = field(
+        default=1000, metadata={"help": "Number of first texts used to estimate the center of features"}
+    )
+    seed: int = field(default=42, metadata={"help": "Seed of sampling"})
+
+
+def hash_ngrams(text: str, ngram_size: int) -> np.ndarray:
+    words = text.lower().split()
+    ngrams = {" ".join(words[i:i + n]) for n in range(1, ngram_size + 1) for i in range(len(words) - n + 1)}
+    # Stable hash (built-in hash of strings differs between processes)
+    return np.fromiter((zlib.crc32(ngram.encode()) for ngram in ngrams), dtype=np.uint32, count=len(ngrams))
+
+
+def project_ngrams(hashes: np.ndarray, num_bits: int) -> np.ndarray:
+    # Bits of n-gram hash are signs of its random projection (SimHash), mean over n-grams does not depend on length
+    if len(hashes) == 0:
+        return np.zeros(num_bits)
+    bits = (hashes[:, None] >> np.arange(num_bits, dtype=np.uint32)) & 1
+    return bits.mean(axis=0) * 2 - 1
+
+
+def get_length_bucket(text: str) -> int:
+    return int(math.log2(max(len(text.split()), 1)))
+
+
+class StratifiedReservoir:
+    """Uniform sample of each stratum of stream, sizes of strata are known only at the end of stream.
+
+    Each item gets random key, stratum keeps `capacity` items with the smallest keys - its first n items are uniform
+    sample of the stratum for any n <= capacity.
+    """
+
+    def __init__(self, capacity: int, seed: int) -> None:
+        self.capacity = capacity
+        self.rng = random.Random(seed)
+        # Stratum -> max heap of (-key, item)
+        self.reservoirs: dict[Hashable, list[tuple[float, int]]] = {}
+        self.counts: Counter = Counter()
+
+    def add(self, stratum: Hashable, item: int) -> None:
+        self.counts[stratum] += 1
+        reservoir = self.reservoirs.setdefault(stratum, [])
+        key = self.rng.random()
+        if len(reservoir) < self.capacity:
+            heapq.heappush(reservoir, (-key, item))
+        elif key < -reservoir[0][0]:
+            heapq.heapreplace(reservoir, (-key, item))
+
+    def allocate(self, size: int) -> dict[Hashable, int]:
+        # Proportional to sizes of strata, remaining items go to strata with the largest remainders
+        total = sum(self.counts.values())
+        quotas = {stratum: size * count / total for stratum, count in self.counts.items()}
+        allocation = {stratum: int(quota) for stratum, quota in quotas.items()}
+        remaining = size - sum(allocation.values())
+        for stratum in sorted(quotas, key=lambda stratum: quotas[stratum] - allocation[stratum], reverse=True):
+            if remaining == 0:
+                break
+            allocation[stratum] += 1
+            remaining -= 1
+        return allocation
+
+    def sample(self, size: int) -> list[int]:
+        if size >= sum(self.counts.values()):
+            return sorted(item for reservoir in self.reservoirs.values() for _, item in reservoir)
+        items = []
+        for stratum, stratum_size in self.allocate(size).items():
+            items.extend(item for _, item in heapq.nlargest(stratum_size, self.reservoirs[stratum]))
+        return sorted(items)
+
+
+def select_subset(file_path: Path, save_path: Path, selection_args: SubsetSelectionArguments) -> None:
+    """Selects representative subset of JSON lines file in one pass.
+
+    Lines are stratified by label, length bucket (log2 of number of words) and cluster of hashed n-grams (signs of
+    random projections of features centered by their running mean). Strata have the same fractions in subset as in
+    file. Lines are kept in original order.
+    """
+    reservoir = StratifiedReservoir(selection_args.subset_size, selection_args.seed)
+    feature_sum, num_texts = np.zeros(selection_args.num_cluster_bits), 0
+    pending: list[tuple[tuple, np.ndarray, int]] = []
+    bit_weights = 2 ** np.arange(selection_args.num_cluster_bits)
+
+    def add_pending() -> None:
+        feature_mean = feature_sum / num_texts
+        for stratum, features, offset in pending:
+            cluster = int(((features > feature_mean) * bit_weights).sum())
+            reservoir.add((*stratum, cluster), offset)
+        pending.clear()
+
+    # Binary mode - offsets of lines are read back after selection
+    with open(file_path, "rb") as f_read:
+        offset = 0
+        for line in f_read:
+            if line.strip():
+                data = json.loads(line)
+                text = data[selection_args.text_column]
+                label = data[selection_args.label_column] if selection_args.label_column else None
+                features = project_ngrams(
+                    hash_ngrams(text, selection_args.ngram_size), selection_args.num_cluster_bits
+                )
+                feature_sum += features
+                num_texts += 1
+                pending.append(((label, get_length_bucket(text)), features, offset))
+                # Center is estimated on first texts before any of them is assigned to cluster
+                if num_texts >= selection_args.warmup_size:
+                    add_pending()
+            offset += len(line)
+        if pending:
+            add_pending()
+
+        offsets = reservoir.sample(selection_args.subset_size)
+        lines = []
+        for offset in offsets:
+            f_read.seek(offset)
+            lines.append(f_read.readline().rstrip(b"\n"))
+    save_path.write_bytes(b"\n".join(lines) + b"\n")
+    LOGGER.info(
+        f"Saved representative subset ({len(lines)} of {num_texts} lines, {len(reservoir.counts)} strata) in:"
+        f" {save_path}"
+    )
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    parser = HfArgumentParser((SubsetSelectionArguments,))
+    selection_args, = parser.parse_args_into_dataclasses()
+
+    file_path = Path(selection_args.input_file)
+    save_path = (
+        Path(selection_args.output_file)
+        if selection_args.output_file is not None
+        else file_path.parent / f"{file_path.stem}-subset.json"
+    )
+    select_subset(file_path, save_path, selection_args)
+
+
+if __name__ == "__main__":
+    main()
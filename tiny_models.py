@@ -0,0 +1,119 @@
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, processors
+from transformers import GPT2Config, PretrainedConfig, PreTrainedTokenizerFast, RobertaConfig, T5Config
+
+from custom_model import HIDDEN_STATES_NAMES
+
+TINY_VOCAB_SIZE = 1000
+# Words of synthetic corpus, all of them are in vocabulary of tiny tokenizers
+TINY_WORDS = [f"w{i}" for i in range(900)] + ["imdb", "classification", ":", "positive", "negative"]
+
+# Special tokens in order of IDs expected by model configurations
+SPECIAL_TOKENS = {
+    "roberta": {
+        "bos_token": "<s>",
+        "pad_token": "<pad>",
+        "eos_token": "</s>",
+        "unk_token": "<unk>",
+        "mask_token": "<mask>",
+    },
+    "gpt2": {"eos_token": "<|endoftext|>"},
+    "t5": {"pad_token": "<pad>", "eos_token": "</s>", "unk_token": "<unk>"},
+}
+
+
+def create_tiny_config(
+    model_name: str,
+    num_labels: int = 2,
+    max_seq_length: int = 128,
+    dropout: float = 0.1,
+    hidden_size: int = 64,
+    num_hidden_layers: int = 2,
+    num_attention_heads: int = 2,
+) -> PretrainedConfig:
+    # Small random configuration used for offline checks and benchmarks, `model_name` is a key from
+    # MODEL_NAME_TO_CLASS or a base model type (roberta, gpt2)
+    if model_name.startswith("roberta"):
+        config = RobertaConfig(
+            vocab_size=TINY_VOCAB_SIZE,
+            hidden_size=hidden_size,
+            num_hidden_layers=num_hidden_layers,
+            num_attention_heads=num_attention_heads,
+            intermediate_size=4 * hidden_size,
+            # RoBERTa position IDs start after padding index
+            max_position_embeddings=max_seq_length + 2,
+            hidden_dropout_prob=dropout,
+            attention_probs_dropout_prob=dropout,
+            pad_token_id=1,
+            num_labels=num_labels,
+        )
+    elif model_name.startswith("gpt2"):
+        config = GPT2Config(
+            vocab_size=TINY_VOCAB_SIZE,
+            n_embd=hidden_size,
+            n_layer=num_hidden_layers,
+            n_head=num_attention_heads,
+            n_positions=max_seq_length,
+            resid_pdrop=dropout,
+            embd_pdrop=dropout,
+            attn_pdrop=dropout,
+            bos_token_id=0,
+            eos_token_id=0,
+            pad_token_id=0,
+            num_labels=num_labels,
+        )
+    elif model_name.startswith("t5"):
+        config = T5Config(
+            vocab_size=TINY_VOCAB_SIZE,
+            d_model=hidden_size,
+            d_kv=hidden_size // num_attention_heads,
+            d_ff=4 * hidden_size,
+            num_layers=num_hidden_layers,
+            num_heads=num_attention_heads,
+            dropout_rate=dropout,
+            feed_forward_proj="gated-gelu",
+            tie_word_embeddings=False,
+            pad_token_id=0,
+            eos_token_id=1,
+            decoder_start_token_id=0,
+        )
+    else:
+        raise ValueError(f"Unknown model type: {model_name}")
+
+    config.use_hidden_states = model_name in HIDDEN_STATES_NAMES
+    return config
+
+
+def create_random_batch(
+    config: PretrainedConfig, batch_size: int, seq_length: int, seed: int = 42
+) -> dict[str, torch.Tensor]:
+    generator = torch.Generator().manual_seed(seed)
+    # Skip special tokens at the beginning of vocabulary - no padding inside of sequence
+    input_ids = torch.randint(3, config.vocab_size, (batch_size, seq_length), generator=generator)
+    labels = torch.randint(0, config.num_labels, (batch_size,), generator=generator)
+    return {
+        "input_ids": input_ids,
+        "attention_mask": torch.ones_like(input_ids),
+        "labels": labels,
+    }
+
+
+def create_tiny_tokenizer(model_type: str) -> PreTrainedTokenizerFast:
+    # Word level tokenizer over synthetic corpus words - does not need any download
+    special_tokens = SPECIAL_TOKENS[model_type]
+    unk_token = special_tokens.get("unk_token", special_tokens["eos_token"])
+    vocab = {token: i for i, token in enumerate(dict.fromkeys(list(special_tokens.values()) + TINY_WORDS))}
+    tokenizer = Tokenizer(models.WordLevel(vocab=vocab, unk_token=unk_token))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+
+    if model_type == "roberta":
+        tokenizer.post_processor = processors.TemplateProcessing(
+            single="<s> $A </s>",
+            pair="<s> $A </s> </s> $B </s>",
+            special_tokens=[("<s>", vocab["<s>"]), ("</s>", vocab["</s>"])],
+        )
+    elif model_type == "t5":
+        tokenizer.post_processor = processors.TemplateProcessing(
+            single="$A </s>", pair="$A </s> $B </s>", special_tokens=[("</s>", vocab["</s>"])]
+        )
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, model_max_length=512, **special_tokens)
@@ -0,0 +1,96 @@
+import re
+from typing import Union
+
+from transformers import BatchEncoding, PreTrainedTokenizerBase
+
+TRUNCATION_STRATEGIES = ["none", "head", "tail", "head_tail"]
+
+WHITESPACE_AT_END_REGEX = re.compile(r"\s+\S*$")
+WHITESPACE_REGEX = re.compile(r"\s")
+
+
+def cut_head(text: str, num_chars: int) -> str:
+    if len(text) <= num_chars:
+        return text
+    text = text[:num_chars + 1]
+    # Cut on whitespace - words before it are tokenized in the same way as in full text
+    match = WHITESPACE_AT_END_REGEX.search(text)
+    return text[:match.start()] if match is not None and match.start() > 0 else text
+
+
+def cut_tail(text: str, num_chars: int) -> str:
+    if len(text) <= num_chars:
+        return text
+    text = text[-num_chars - 1:]
+    # Keep leading whitespace - byte level BPE attaches it to the first word
+    match = WHITESPACE_REGEX.search(text)
+    return text[match.start():] if match is not None else text
+
+
+class TextTruncator:
+    """Tokenizes only a character prefix/suffix of long texts which is expected to give enough tokens.
+
+    Texts for which the cut part gives fewer tokens than needed are tokenized again in full, so the result is the
+    same as tokenization of the full text with truncation.
+    """
+
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizerBase,
+        max_length: int,
+        strategy: str,
+        chars_per_token: float = 8.0,
+        head_ratio: float = 0.25,
+    ) -> None:
+        if strategy not in TRUNCATION_STRATEGIES[1:]:
+            raise ValueError(f"Unknown truncation strategy: {strategy}")
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.strategy = strategy
+        self.chars_per_token = chars_per_token
+        self.head_ratio = head_ratio
+        self.num_fallbacks = 0
+
+    def tokenize(self, texts: list[str]) -> list[list[int]]:
+        return self.tokenizer(texts, add_special_tokens=False)["input_ids"]
+
+    def tokenize_cut(self, texts: list[str], num_tokens: int, from_head: bool) -> list[list[int]]:
+        num_chars = int(num_tokens * self.chars_per_token)
+        cut_texts = [cut_head(text, num_chars) if from_head else cut_tail(text, num_chars) for text in texts]
+        all_ids = self.tokenize(cut_texts)
+
+        # Fallback - cut text is too short to fill all tokens
+        fallback_indexes = [
+            i for i, (text, cut_text, ids) in enumerate(zip(texts, cut_texts, all_ids))
+            if len(ids) < num_tokens and len(cut_text) < len(text)
+        ]
+        if fallback_indexes:
+            self.num_fallbacks += len(fallback_indexes)
+            for i, ids in zip(fallback_indexes, self.tokenize([texts[i] for i in fallback_indexes])):
+                all_ids[i] = ids
+        return [ids[:num_tokens] if from_head else ids[max(len(ids) - num_tokens, 0):] for ids in all_ids]
+
+    def __call__(self, texts: list[str], padding: Union[bool, str] = False, prefix: str = "") -> BatchEncoding:
+        # Prefix is tokenized separately without trailing space (SentencePiece adds it before first word of text)
+        prefix_ids = self.tokenize([prefix.strip()])[0] if prefix else []
+        num_tokens = self.max_length - self.tokenizer.num_special_tokens_to_add(pair=False) - len(prefix_ids)
+
+        if self.strategy == "head":
+            all_ids = self.tokenize_cut(texts, num_tokens, from_head=True)
+        elif self.strategy == "tail":
+            all_ids = self.tokenize_cut(texts, num_tokens, from_head=False)
+        else:
+            num_head_tokens = int(num_tokens * self.head_ratio)
+            num_tail_tokens = num_tokens - num_head_tokens
+            head_ids = self.tokenize_cut(texts, num_tokens, from_head=True)
+            tail_ids = self.tokenize_cut(texts, num_tail_tokens, from_head=False)
+            all_ids = []
+            for head, tail in zip(head_ids, tail_ids):
+                # Short text fits in limit (head contains everything) - keep as is
+                if len(head) < num_tokens:
+                    all_ids.append(head)
+                else:
+                    all_ids.append(head[:num_head_tokens] + tail)
+
+        input_ids = [self.tokenizer.build_inputs_with_special_tokens(prefix_ids + ids) for ids in all_ids]
+        return self.tokenizer.pad({"input_ids": input_ids}, padding=padding, max_length=self.max_length)
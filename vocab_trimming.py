@@ -0,0 +1,117 @@
+import copy
+import logging
+from dataclasses import dataclass, field
+
+import numpy as np
+from torch import nn
+from transformers import (
+    AutoTokenizer,
+    HfArgumentParser,
+    PreTrainedTokenizerBase,
+    T5Config,
+    T5ForConditionalGeneration,
+)
+
+from prepare_imdb import MAP_LABEL_TRANSLATION
+
+LOGGER = logging.getLogger(__name__)
+
+SPECIAL_TOKEN_ID_NAMES = ["pad_token_id", "eos_token_id", "decoder_start_token_id"]
+
+
+class T5ForConditionalGenerationTrimmed(T5ForConditionalGeneration):
+    """T5 with decoder vocabulary (decoder input embeddings and `lm_head`) restricted to `config.output_token_ids`.
+
+    Encoder uses full vocabulary. Decoder inputs, labels and generated sequences are indexes of `output_token_ids`,
+    use `to_output_ids`/`from_output_ids` to convert them from/to tokenizer IDs.
+    """
+
+    def __init__(self, config: T5Config):
+        super().__init__(config)
+        num_output_tokens = len(config.output_token_ids)
+        self.decoder.embed_tokens = nn.Embedding(num_output_tokens, config.d_model)
+        self.lm_head = nn.Linear(config.d_model, num_output_tokens, bias=False)
+
+        # Initialize weights and apply final processing
+        self.post_init()
+
+
+def find_output_token_ids(tokenizer: PreTrainedTokenizerBase, targets: list[str]) -> list[int]:
+    token_ids = set()
+    for input_ids in tokenizer(text_target=targets)["input_ids"]:
+        token_ids.update(input_ids)
+    # Only special tokens used by decoder, T5 has also 100 sentinel tokens which are not generated
+    token_ids.update(
+        token_id
+        for token_id in [tokenizer.pad_token_id, tokenizer.eos_token_id, tokenizer.unk_token_id]
+        if token_id is not None
+    )
+    return sorted(token_ids)
+
+
+def trim_output_vocabulary(
+    model: T5ForConditionalGeneration, output_token_ids: list[int]
+) -> T5ForConditionalGenerationTrimmed:
+    output_token_ids = sorted(set(output_token_ids))
+    token_id_to_index = {token_id: i for i, token_id in enumerate(output_token_ids)}
+    config = copy.deepcopy(model.config)
+    for name in SPECIAL_TOKEN_ID_NAMES:
+        if getattr(config, name) not in token_id_to_index:
+            raise ValueError(f"Missing {name} ({getattr(config, name)}) in output tokens: {output_token_ids}")
+        setattr(config, name, token_id_to_index[getattr(config, name)])
+
+    lm_head_weight = model.lm_head.weight.data[output_token_ids]
+    if config.tie_word_embeddings:
+        # Tied T5 rescales decoder output before projection - untied weights have to include the scale
+        lm_head_weight = lm_head_weight * config.d_model**-0.5
+    config.tie_word_embeddings = False
+    config.output_token_ids = output_token_ids
+    config.architectures = [T5ForConditionalGenerationTrimmed.__name__]
+
+    state_dict = model.state_dict()
+    state_dict["lm_head.weight"] = lm_head_weight
+    state_dict["decoder.embed_tokens.weight"] = model.get_input_embeddings().weight.data[output_token_ids]
+    trimmed_model = T5ForConditionalGenerationTrimmed(config)
+    trimmed_model.load_state_dict(state_dict)
+    LOGGER.info(f"Trimmed output vocabulary from {model.config.vocab_size} to {len(output_token_ids)} tokens")
+    return trimmed_model.to(device=model.device, dtype=model.dtype)
+
+
+def to_output_ids(token_ids: list[list[int]], output_token_ids: list[int]) -> list[list[int]]:
+    token_id_to_index = {token_id: i for i, token_id in enumerate(output_token_ids)}
+    # Ignored positions (-100) are kept
+    return [[token_id_to_index[i] if i >= 0 else i for i in ids] for ids in token_ids]
+
+
+def from_output_ids(ids: np.ndarray, output_token_ids: list[int]) -> np.ndarray:
+    output_token_ids = np.asarray(output_token_ids)
+    # Ignored positions (-100) are kept
+    return np.where(ids >= 0, output_token_ids[np.maximum(ids, 0)], ids)
+
+
+@dataclass
+class TrimVocabularyArguments:
+    model_name_or_path: str = field(metadata={"help": "Path to trained T5 model"})
+    output_dir: str = field(metadata={"help": "Where to save model with trimmed output vocabulary"})
+    targets: list[str] = field(
+        default_factory=lambda: list(MAP_LABEL_TRANSLATION.values()),
+        metadata={"help": "All texts generated by model"},
+    )
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    parser = HfArgumentParser((TrimVocabularyArguments,))
+    trim_args, = parser.parse_args_into_dataclasses()
+
+    tokenizer = AutoTokenizer.from_pretrained(trim_args.model_name_or_path)
+    model = T5ForConditionalGeneration.from_pretrained(trim_args.model_name_or_path)
+    output_token_ids = find_output_token_ids(tokenizer, trim_args.targets)
+    model = trim_output_vocabulary(model, output_token_ids)
+    model.save_pretrained(trim_args.output_dir)
+    tokenizer.save_pretrained(trim_args.output_dir)
+    LOGGER.info(f"Saved model with output tokens {output_token_ids} in: {trim_args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()